@@ -3,10 +3,10 @@ INSERT INTO "users" VALUES(2,'M','pwd1',101,'uusi user', 0);
 INSERT INTO "users" VALUES(3,'Dakka','pass',101,'AAAAAAAAAAA', 1);
 INSERT INTO "users" VALUES(4,'Sekoitus','pppppppp',101,'wololoo', 0);
 
-INSERT INTO "exercise" VALUES(1,2,'M','run',101,'m', '12.12.2012', 1,'h');
-INSERT INTO "exercise" VALUES(2,2,'M','jog',1010000,'m', '12.12.2012', 1,'h');
-INSERT INTO "exercise" VALUES(3,4,'Sekoitus','a',222,'km', '1.1.2012', 1010,'h');
-INSERT INTO "exercise" VALUES(4,1,'Mystery','jump',1,'m', '12.12.2012', 0,'h');
+INSERT INTO "exercise"(exercise_id,user_id,username,type,value,valueunit,date,time,timeunit) VALUES(1,2,'M','run',101,'m', '12.12.2012', 1,'h');
+INSERT INTO "exercise"(exercise_id,user_id,username,type,value,valueunit,date,time,timeunit) VALUES(2,2,'M','jog',1010000,'m', '12.12.2012', 1,'h');
+INSERT INTO "exercise"(exercise_id,user_id,username,type,value,valueunit,date,time,timeunit) VALUES(3,4,'Sekoitus','a',222,'km', '1.1.2012', 1010,'h');
+INSERT INTO "exercise"(exercise_id,user_id,username,type,value,valueunit,date,time,timeunit) VALUES(4,1,'Mystery','jump',1,'m', '12.12.2012', 0,'h');
 
 INSERT INTO "friends" VALUES(1,1);
 INSERT INTO "friends" VALUES(1,2);
@@ -5,6 +5,7 @@ engine= database.Engine()
 engine.create_users_table()
 engine.create_exercise_table()
 engine.create_friends_table()
+engine.migrate()
 
 con = sqlite3.connect('db/forum.db')
 
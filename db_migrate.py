@@ -0,0 +1,7 @@
+import forum.database as database
+#Applies the pending schema migrations to db/forum.db. It can be run while
+#the application is using the database.
+engine = database.Engine()
+print "Schema version %d" % engine.schema_version()
+for version in engine.migrate():
+    print "Applied migration %d" % version
@@ -0,0 +1,12 @@
+import sys
+import forum.database as database
+#Checks the exercise rollups of db/forum.db against the exercise table.
+#With --rebuild the rollups are computed again from the exercises.
+engine = database.Engine()
+if "--rebuild" in sys.argv[1:]:
+    print "Rebuilt %d rollup rows" % engine.rebuild_rollups()
+wrong = engine.check_rollups()
+for key in wrong:
+    print "Wrong rollup %s" % (key,)
+print "%d wrong rollup rows" % len(wrong)
+sys.exit(1 if wrong else 0)
@@ -0,0 +1,318 @@
+'''
+Created on 18.10.2026
+
+Columnar analytics over the ``exercise`` table. The exercises are read in
+chunks straight into NumPy arrays, with the users and the types dictionary
+encoded as small integer codes, and they are aggregated with vectorized
+operations instead of a dictionary per row.
+
+NumPy is an optional dependency: this module can be imported without it,
+but :py:func:`load_exercises` raises ImportError.
+
+@authors: Toni Narhi & Ville Kemppainen
+'''
+
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import database
+
+#Number of rows converted to arrays at a time
+DEFAULT_CHUNK_SIZE = 65536
+#Columns that can be aggregated
+MEASURES = ('value_si', 'time_si')
+#Groups of the aggregations. The periods are named like in
+#Connection.get_exercise_stats: a week after its Monday.
+GROUPS = ('user', 'type', 'day', 'week', 'month')
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('forum.analytics needs NumPy, '
+                          'install it with "pip install numpy"')
+
+
+def _encode(values, codes):
+    '''
+    Dictionary encodes a chunk of values.
+
+    :param values: sequence of hashable values
+    :param dict codes: value => code of the values seen so far. The new
+        values are added to it.
+    :return: array with the code of each value
+    '''
+    for value in sorted(set(values).difference(codes)):
+        codes[value] = len(codes)
+    return numpy.fromiter(itertools.imap(codes.__getitem__, values),
+                          dtype=numpy.int32, count=len(values))
+
+
+def _labels(codes):
+    '''
+    :return: list with the value of each code of ``codes``
+    '''
+    labels = [None] * len(codes)
+    for value, code in codes.iteritems():
+        labels[code] = value
+    return labels
+
+
+def _dates(values):
+    '''
+    Converts a chunk of ``date_iso`` values to an array of days. The values
+    that are not valid dates, for instance ``2012-02-30`` in rows written
+    without the Connection, become NaT.
+
+    :return: datetime64[D] array
+    '''
+    try:
+        return numpy.array(values, dtype='datetime64[D]')
+    except ValueError:
+        dates = numpy.empty(len(values), dtype='datetime64[D]')
+        for index, value in enumerate(values):
+            try:
+                dates[index] = value
+            except (TypeError, ValueError):
+                dates[index] = 'NaT'
+        return dates
+
+
+def load_exercises(connection, start=None, end=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Reads the exercises into an :py:class:`ExerciseColumns`.
+
+    :param connection: :py:class:`database.Connection` used to read
+    :param str start: If given only the exercises done on this date or later
+        are read. ``dd.mm.yyyy`` or ``yyyy-mm-dd`` format.
+    :param str end: If given only the exercises done on this date or before
+        are read.
+    :param int chunk_size: Number of rows fetched and converted at a time.
+    :raises ValueError: if ``start`` or ``end`` are not valid dates
+    :raises ImportError: if NumPy is not installed
+    '''
+    _require_numpy()
+    query = 'SELECT exercise_id, user_id, type, value_si, time_si, date_iso \
+             FROM exercise'
+    conditions = []
+    pvalue = []
+    for value, condition in ((start, 'date_iso >= ?'),
+                             (end, 'date_iso <= ?')):
+        if value is not None:
+            if database.iso_date(value) is None:
+                raise ValueError('Wrong date %s' % value)
+            conditions.append(condition)
+            pvalue.append(database.iso_date(value))
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    cur = connection.con.cursor()
+    #Plain tuples, the rows are only unpacked into columns
+    cur.row_factory = None
+    cur.execute(query, pvalue)
+    user_codes = {}
+    type_codes = {}
+    chunks = []
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        ids, users, types, values, times, dates = zip(*rows)
+        chunks.append((numpy.array(ids, dtype=numpy.int64),
+                       _encode(users, user_codes),
+                       _encode(types, type_codes),
+                       numpy.array(values, dtype=numpy.float64),
+                       numpy.array(times, dtype=numpy.float64),
+                       _dates(dates)))
+    dtypes = (numpy.int64, numpy.int32, numpy.int32, numpy.float64,
+              numpy.float64, 'datetime64[D]')
+    columns = [numpy.concatenate([chunk[index] for chunk in chunks])
+               if chunks else numpy.array([], dtype=dtype)
+               for index, dtype in enumerate(dtypes)]
+    return ExerciseColumns(columns[0], columns[1], _labels(user_codes),
+                           columns[2], _labels(type_codes), columns[3],
+                           columns[4], columns[5])
+
+
+class ExerciseColumns(object):
+    '''
+    Exercises stored column by column in NumPy arrays. Created by
+    :py:func:`load_exercises`.
+
+    The aggregations take the name of a measure (``value_si`` or
+    ``time_si``, in metres and seconds) and the groups ``by``: one of
+    :py:data:`GROUPS` or a tuple of them. They return a dictionary with the
+    result of each group, whose key is the user id, the type, the period
+    (``yyyy-mm-dd``, ``yyyy-mm`` for months) or a tuple of them. Exercises
+    without date are not in the period groups and missing measures (NaN)
+    are ignored.
+
+    :ivar exercise_id: exercise ids (int64)
+    :ivar user: user codes (int32), their user ids are ``users[code]``
+    :ivar type: type codes (int32), their types are ``types[code]``
+    :ivar value_si: values in metres (float64, NaN if unknown)
+    :ivar time_si: times in seconds (float64, NaN if unknown)
+    :ivar date: dates (datetime64[D], NaT if unknown)
+    '''
+    def __init__(self, exercise_id, user, users, type, types, value_si,
+                 time_si, date):
+        super(ExerciseColumns, self).__init__()
+        self.exercise_id = exercise_id
+        self.user = user
+        self.users = users
+        self.type = type
+        self.types = types
+        self.value_si = value_si
+        self.time_si = time_si
+        self.date = date
+
+    def __len__(self):
+        return len(self.exercise_id)
+
+    def _codes(self, name):
+        '''
+        :return: tuple (codes, labels) of the group ``name``. The code is -1
+            for the rows out of every group.
+        '''
+        if name == 'user':
+            return self.user, self.users
+        if name == 'type':
+            return self.type, self.types
+        if name not in GROUPS:
+            raise ValueError('Wrong group %s' % name)
+        valid = ~numpy.isnat(self.date)
+        dates = self.date[valid]
+        if name == 'week':
+            days = dates.astype(numpy.int64)
+            #1970-01-01 was a Thursday
+            dates = (days - (days + 3) % 7).astype('datetime64[D]')
+        elif name == 'month':
+            dates = dates.astype('datetime64[M]')
+        periods, inverse = numpy.unique(dates, return_inverse=True)
+        codes = numpy.full(len(self), -1, dtype=numpy.int64)
+        codes[valid] = inverse
+        return codes, [str(period) for period in periods]
+
+    def _group(self, by):
+        '''
+        Computes the groups of the rows.
+
+        :return: tuple (mask of the rows in a group, group code of those
+            rows, key of each group code)
+        '''
+        names = (by,) if isinstance(by, basestring) else tuple(by)
+        mask = numpy.ones(len(self), dtype=bool)
+        combined = numpy.zeros(len(self), dtype=numpy.int64)
+        parts = []
+        for name in names:
+            codes, labels = self._codes(name)
+            mask &= codes >= 0
+            combined = combined * max(len(labels), 1) + numpy.maximum(codes, 0)
+            parts.append(labels)
+        groups, inverse = numpy.unique(combined[mask], return_inverse=True)
+        keys = []
+        for group in groups:
+            key = []
+            for labels in reversed(parts):
+                group, code = divmod(int(group), max(len(labels), 1))
+                key.append(labels[code])
+            key.reverse()
+            keys.append(key[0] if isinstance(by, basestring) else tuple(key))
+        return mask, inverse, keys
+
+    def _measure(self, column, by):
+        '''
+        :return: tuple (group code, value, date, key of each group code) of
+            the rows in a group with a known ``column``
+        '''
+        if column not in MEASURES:
+            raise ValueError('Wrong measure %s' % column)
+        mask, codes, keys = self._group(by)
+        values = getattr(self, column)[mask]
+        known = ~numpy.isnan(values)
+        return codes[known], values[known], self.date[mask][known], keys
+
+    def count(self, by):
+        '''
+        :return: dictionary with the number of exercises of each group
+        '''
+        _, codes, keys = self._group(by)
+        return dict(zip(keys, numpy.bincount(codes,
+                                             minlength=len(keys)).tolist()))
+
+    def sum(self, column, by):
+        '''
+        :return: dictionary with the total of ``column`` in each group
+        '''
+        codes, values, _, keys = self._measure(column, by)
+        totals = numpy.bincount(codes, weights=values, minlength=len(keys))
+        return dict(zip(keys, totals.tolist()))
+
+    def mean(self, column, by):
+        '''
+        :return: dictionary with the mean of ``column`` in each group, NaN if
+            the group has no known ``column``
+        '''
+        codes, values, _, keys = self._measure(column, by)
+        totals = numpy.bincount(codes, weights=values, minlength=len(keys))
+        counts = numpy.bincount(codes, minlength=len(keys))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            means = totals / counts
+        return dict(zip(keys, means.tolist()))
+
+    def percentile(self, column, q, by):
+        '''
+        :param float q: percentile between 0 and 100. The values between two
+            rows are interpolated linearly, like ``numpy.percentile``.
+        :return: dictionary with the percentile ``q`` of ``column`` in each
+            group, NaN if the group has no known ``column``
+        '''
+        if not 0 <= q <= 100:
+            raise ValueError('Wrong percentile %s' % q)
+        codes, values, _, keys = self._measure(column, by)
+        #Values sorted inside each group, the groups one after the other
+        order = numpy.lexsort((values, codes))
+        values = values[order]
+        sizes = numpy.bincount(codes, minlength=len(keys))
+        starts = numpy.cumsum(sizes) - sizes
+        result = numpy.full(len(keys), numpy.nan)
+        present = sizes > 0
+        position = starts[present] + (sizes[present] - 1) * (q / 100.0)
+        low = numpy.floor(position).astype(numpy.int64)
+        high = numpy.minimum(low + 1, starts[present] + sizes[present] - 1)
+        fraction = position - low
+        result[present] = (values[low] * (1 - fraction) +
+                           values[high] * fraction)
+        return dict(zip(keys, result.tolist()))
+
+    def rolling_sum(self, column, window, by='user'):
+        '''
+        Totals of ``column`` over a sliding window of days.
+
+        :param int window: Number of days of the window, the day itself and
+            the ``window - 1`` days before.
+        :return: tuple (days, dictionary). ``days`` is an array with every
+            day (datetime64[D]) from the first to the last exercise. The
+            dictionary has an array per group with the total of the window
+            ending at each day.
+        '''
+        if window < 1:
+            raise ValueError('Wrong window %s' % window)
+        codes, values, dates, keys = self._measure(column, by)
+        dated = ~numpy.isnat(dates)
+        codes, values = codes[dated], values[dated]
+        days = dates[dated].astype(numpy.int64)
+        if not len(days):
+            return numpy.array([], dtype='datetime64[D]'), {}
+        first = days.min()
+        width = days.max() - first + 1
+        daily = numpy.bincount(codes * width + (days - first), weights=values,
+                               minlength=len(keys) * width)
+        totals = numpy.cumsum(daily.reshape(len(keys), width), axis=1)
+        rolling = totals.copy()
+        rolling[:, window:] -= totals[:, :-window]
+        all_days = numpy.arange(first, first + width).astype('datetime64[D]')
+        return all_days, dict(zip(keys, rolling))
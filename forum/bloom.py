@@ -0,0 +1,85 @@
+'''
+Created on 18.10.2026
+
+Bloom filter used by the database API to discard unknown usernames without
+querying the database.
+
+@authors: Toni Narhi & Ville Kemppainen
+'''
+
+import hashlib, math, struct
+
+
+class BloomFilter(object):
+    '''
+    Fixed size Bloom filter of strings.
+
+    A Bloom filter answers if a key *might* have been added: ``key in
+    bloom`` is always True for added keys and is False for most of the other
+    keys. The proportion of wrong True answers (false positives) grows with
+    the number of added keys; it is about ``error_rate`` when ``capacity``
+    keys have been added.
+
+    The filter is not thread safe: calls to :py:meth:`add` must be
+    serialized by the caller.
+
+    :param int capacity: Number of keys the filter is sized for.
+    :param float error_rate: Expected false positive rate at ``capacity``
+        keys.
+    '''
+    def __init__(self, capacity, error_rate=0.01):
+        super(BloomFilter, self).__init__()
+        if capacity < 1:
+            raise ValueError('The capacity must be at least 1')
+        if not 0 < error_rate < 1:
+            raise ValueError('The error rate must be between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        #Optimal number of bits and hash functions
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.size) / capacity *
+                                       math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        '''
+        Positions of the bits of ``key``. They are derived from one MD5
+        digest with double hashing.
+        '''
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + index * second) % self.size
+                for index in range(self.hashes)]
+
+    def add(self, key, count=True):
+        '''
+        Adds ``key`` to the filter.
+
+        :param bool count: False to set the bits of ``key`` without counting
+            it in :py:attr:`count`, for instance because it is counted by a
+            later call.
+        '''
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        if count:
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def estimated_error_rate(self):
+        '''
+        :return: the expected false positive rate with the keys added so far
+        '''
+        return (1 - math.exp(-float(self.hashes) * self.count /
+                             self.size)) ** self.hashes
@@ -9,11 +9,1597 @@ Provides the database API to access the forum persistent data.
 '''
 
 #from datetime import datetime
-import time, sqlite3, os#, re
+import time, sqlite3, os, threading, Queue, urllib, json, base64, collections#, re
+import datetime, heapq, itertools
+from bloom import BloomFilter
+from graph import FriendGraph
+import units
 #Default paths for .db and .sql files to create and populate the database.
 DEFAULT_DB_PATH = 'db/forum.db'
 DEFAULT_SCHEMA = "db/forum_schema_dump.sql"
 DEFAULT_DATA_DUMP = "db/forum_data_dump.sql"
+#Default values for the connection pool of the Engine.
+#Maximum number of sqlite3 connections kept by the pool
+DEFAULT_POOL_SIZE = 5
+#Seconds an unused connection stays in the pool before it is closed
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+#Seconds a checkout waits for a free connection when the pool is exhausted
+DEFAULT_POOL_WAIT_TIMEOUT = 5
+#Milliseconds a statement waits for a lock before failing with SQLITE_BUSY
+DEFAULT_BUSY_TIMEOUT = 5000
+#Number of prepared statements cached by each sqlite3 connection
+DEFAULT_STATEMENT_CACHE_SIZE = 256
+#Storage profiles of the Engine. Each one is a set of PRAGMA values applied
+#to every new connection:
+#  * default: SQLite defaults. Rollback journal, readers wait for writers.
+#  * durable: WAL journal, every commit is synced to disk.
+#  * balanced: WAL journal, synced at checkpoints only. A power loss can lose
+#    the last commits but never corrupts the database.
+#  * throughput: balanced plus bigger caches and less frequent checkpoints.
+#cache_size is given in KiB when negative and mmap_size in bytes.
+STORAGE_PROFILES = {
+    'default': {'journal_mode': 'DELETE', 'synchronous': 'FULL',
+                'cache_size': -2000, 'mmap_size': 0,
+                'temp_store': 'DEFAULT', 'wal_autocheckpoint': 1000},
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL',
+                'cache_size': -8000, 'mmap_size': 0,
+                'temp_store': 'DEFAULT', 'wal_autocheckpoint': 1000},
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                 'cache_size': -16000, 'mmap_size': 64 * 1024 * 1024,
+                 'temp_store': 'MEMORY', 'wal_autocheckpoint': 1000},
+    'throughput': {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                   'cache_size': -64000, 'mmap_size': 256 * 1024 * 1024,
+                   'temp_store': 'MEMORY', 'wal_autocheckpoint': 10000},
+}
+DEFAULT_STORAGE_PROFILE = 'balanced'
+#Group commit of the writer thread: maximum number of operations committed
+#in one transaction and seconds the writer waits for more operations. With 0
+#the writer commits everything queued while the previous commit was running
+DEFAULT_COMMIT_BATCH_SIZE = 64
+DEFAULT_COMMIT_INTERVAL = 0
+#Number of rows fetched at a time by the iter_* generators of Connection
+DEFAULT_FETCH_SIZE = 100
+#Number of rows returned by the get_*_page methods of Connection
+DEFAULT_PAGE_SIZE = 50
+#Default values for the query cache of the Engine.
+#Maximum number of cached statements
+DEFAULT_QUERY_CACHE_SIZE = 1024
+#Seconds a cached result is valid, which bounds how long changes made
+#outside the Engine (other processes) can go unseen
+DEFAULT_QUERY_CACHE_TTL = 30
+#Maximum number of usernames kept by the identity map of the Engine
+DEFAULT_IDENTITY_MAP_SIZE = 10000
+#Number of friend suggestions returned by default
+DEFAULT_SUGGESTIONS = 10
+#Budgets of the friend path search: maximum length of the path and maximum
+#number of users visited
+DEFAULT_PATH_DEPTH = 6
+DEFAULT_PATH_VISITED = 5000
+#Default values for the username filter of the Engine.
+#False positive rate the Bloom filter is sized for
+DEFAULT_FILTER_ERROR_RATE = 0.01
+#Minimum number of usernames the Bloom filter is sized for
+DEFAULT_FILTER_CAPACITY = 1024
+#Deleted users after which the filter is rebuilt from the users table
+DEFAULT_FILTER_REBUILD_DELETES = 1000
+#Tables modified by each mutating method of Connection. Their versions in the
+#query cache are bumped when the method commits.
+WRITE_TABLES = {
+    'append_user': ('users',),
+    'append_users_many': ('users',),
+    'modify_user': ('users',),
+    #The exercises and friends of the user are deleted in cascade
+    'delete_user': ('users', 'exercise', 'friends', 'timeline_users'),
+    'create_exercise': ('exercise',),
+    'create_exercises_many': ('exercise',),
+    'modify_exercise': ('exercise',),
+    'delete_exercise': ('exercise',),
+    #add_friend enables the timeline of users with many friends
+    'add_friend': ('friends', 'timeline_users'),
+    'delete_friend': ('friends',),
+    'set_timeline': ('timeline_users',),
+}
+#Fields of a user that can be requested with the fields argument of the
+#Connection user methods. The public fields do not include the password and
+#the list fields do not include the avatar BLOB either: they are read from
+#the covering index users_list_idx without touching the table rows.
+USER_FIELDS = ('username', 'password', 'avatar', 'description', 'visibility')
+PUBLIC_USER_FIELDS = ('username', 'avatar', 'description', 'visibility')
+LIST_USER_FIELDS = ('username', 'description', 'visibility')
+#Maximum number of values bound in one IN (...) list. Old SQLite versions
+#do not accept more than 999 variables per statement
+MAX_IN_VARIABLES = 500
+#Columns with few different values. With compact rows their strings are
+#shared by all the rows instead of being a new object in every row.
+INTERNED_COLUMNS = frozenset(['type', 'valueunit', 'timeunit'])
+#Maximum number of different strings kept by the intern table
+MAX_INTERNED_STRINGS = 1024
+#Maximum number of compact row classes kept by compact_row_type
+MAX_COMPACT_ROW_TYPES = 256
+#Keys of the exercise dictionaries returned by the Connection
+EXERCISE_FIELDS = ('exercise_id', 'user_id', 'username', 'type', 'value',
+                   'valueunit', 'date', 'time', 'timeunit')
+#Periods of Connection.get_exercise_stats: SQL expression computing the
+#period of the date {0} (yyyy-mm-dd). A week is named after its Monday.
+STATS_PERIODS = {
+    'day': '{0}',
+    'week': "date({0}, 'weekday 0', '-6 days')",
+    'month': 'substr({0}, 1, 7)',
+}
+#Periods kept in the exercise_rollup table: SQL expressions of the first and
+#the last date of the period named {0}
+ROLLUP_PERIODS = {
+    'week': ('{0}', "date({0}, '+6 days')"),
+    'month': ("{0} || '-01'", "{0} || '-31'"),
+}
+#Measures of Connection.get_leaderboard: column of exercise they add up
+LEADERBOARD_MEASURES = {'distance': 'value_si', 'time': 'time_si'}
+#Number of users in a leaderboard by default
+DEFAULT_LEADERBOARD_SIZE = 10
+#Columns of exercise_rollup
+ROLLUP_COLUMNS = ('user_id', 'period_kind', 'period', 'type', 'valueunit',
+                  'timeunit', 'count', 'total_value', 'total_time',
+                  'max_value', 'max_time')
+#Number of friends from which the applications enable the timeline of a
+#user (see Engine timeline_friends)
+DEFAULT_TIMELINE_FRIENDS = 100
+#Friends whose exercises are read by one statement of Connection.get_feed.
+#Each friend binds 5 variables and a compound SELECT has at most 500 terms.
+FEED_MERGE_CHUNK = MAX_IN_VARIABLES // 5
+
+
+def encode_cursor(direction, key):
+    '''
+    Creates the opaque cursor used by the ``get_*_page`` methods of
+    :py:class:`Connection`.
+
+    :param str direction: ``next`` for the rows after ``key`` or ``prev``
+        for the rows before it.
+    :param key: Value of the ordering column of the last (``next``) or the
+        first (``prev``) row of the current page.
+    :return: an URL safe string
+    '''
+    return base64.urlsafe_b64encode(json.dumps([direction, key]))
+
+
+def decode_cursor(cursor):
+    '''
+    Inverse of :py:func:`encode_cursor`.
+
+    :return: tuple (direction, key)
+    :raises ValueError: if ``cursor`` was not created by
+        :py:func:`encode_cursor`.
+    '''
+    try:
+        direction, key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Malformed cursor %s' % cursor)
+    if direction not in ('next', 'prev'):
+        raise ValueError('Malformed cursor %s' % cursor)
+    return direction, key
+
+
+def iso_date(date):
+    '''
+    Converts the date of an exercise to the sortable ISO-8601 format stored
+    in the ``date_iso`` column.
+
+    :param str date: date in the ``dd.mm.yyyy`` format used by the API (the
+        day and month can have one digit) or already in ``yyyy-mm-dd``
+        format.
+    :return: the date as ``yyyy-mm-dd`` or None if ``date`` is not valid,
+        for instance ``30.2.2012``.
+    '''
+    if not date:
+        return None
+    try:
+        if '-' in date:
+            year, month, day = date.split('-')
+        else:
+            day, month, year = date.split('.')
+        return datetime.date(int(year), int(month), int(day)).isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+def _sql_iso_date(column):
+    '''
+    SQL version of :py:func:`iso_date` for ``dd.mm.yyyy`` dates, used by the
+    migrations and triggers that fill ``date_iso`` without Python.
+
+    :param str column: the column or expression holding the date
+    '''
+    rest = "substr({0}, instr({0}, '.') + 1)".format(column)
+    day = "substr({0}, 1, instr({0}, '.') - 1)".format(column)
+    month = "substr({0}, 1, instr({0}, '.') - 1)".format(rest)
+    year = "substr({0}, instr({0}, '.') + 1)".format(rest)
+    iso = "printf('%04d-%02d-%02d', {0}, {1}, {2})".format(year, month, day)
+    #date() gives NULL for a month or day out of range and moves the days
+    #after the end of the month (2012-02-30) to the next month
+    return ("CASE WHEN {0} GLOB '[0-9]*.[0-9]*.[0-9][0-9][0-9][0-9]' "
+            "AND CAST({1} AS INTEGER) > 0 AND date({2}, '+0 days') = {2} THEN {2} END").format(
+                column, year, iso)
+
+
+def _rollup_match(row, kind):
+    '''
+    SQL condition selecting the ``exercise_rollup`` row of the exercise
+    ``row`` (``NEW`` or ``OLD`` in a trigger) for the period ``kind``.
+    '''
+    return ("user_id = {0}.user_id AND period_kind = '{1}' "
+            "AND period = {2} AND type IS {0}.type "
+            "AND valueunit IS {0}.valueunit AND timeunit IS {0}.timeunit"
+            ).format(row, kind, STATS_PERIODS[kind].format(row + '.date_iso'))
+
+
+def _rollup_add(row):
+    '''
+    Trigger statements adding the exercise ``row`` to its rollups. Exercises
+    without user or valid date are not in the rollups.
+    '''
+    statements = []
+    for kind in sorted(ROLLUP_PERIODS):
+        statements.append(
+            "INSERT INTO exercise_rollup(%s) "
+            "SELECT {0}.user_id, '{1}', {2}, {0}.type, {0}.valueunit, "
+            "{0}.timeunit, 0, 0, 0, NULL, NULL "
+            "WHERE {0}.user_id IS NOT NULL AND {0}.date_iso IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM exercise_rollup WHERE {3})"
+            .format(row, kind, STATS_PERIODS[kind].format(row + '.date_iso'),
+                    _rollup_match(row, kind)) % ', '.join(ROLLUP_COLUMNS))
+        statements.append(
+            "UPDATE exercise_rollup SET count = count + 1, "
+            "total_value = total_value + IFNULL({0}.value, 0), "
+            "total_time = total_time + IFNULL({0}.time, 0), "
+            "max_value = CASE WHEN max_value >= {0}.value THEN max_value "
+            "ELSE IFNULL({0}.value, max_value) END, "
+            "max_time = CASE WHEN max_time >= {0}.time THEN max_time "
+            "ELSE IFNULL({0}.time, max_time) END "
+            "WHERE {1}".format(row, _rollup_match(row, kind)))
+    return statements
+
+
+def _rollup_remove(row):
+    '''
+    Trigger statements removing the exercise ``row`` from its rollups. The
+    maximum is read again, from the exercises of the period only, when the
+    removed exercise could be the maximum.
+    '''
+    statements = []
+    for kind in sorted(ROLLUP_PERIODS):
+        period = STATS_PERIODS[kind].format(row + '.date_iso')
+        first, last = [bound.format(period) for bound in ROLLUP_PERIODS[kind]]
+        group = ("FROM exercise WHERE user_id = {0}.user_id "
+                 "AND date_iso BETWEEN {1} AND {2} AND type IS {0}.type "
+                 "AND valueunit IS {0}.valueunit "
+                 "AND timeunit IS {0}.timeunit").format(row, first, last)
+        statements.append(
+            "UPDATE exercise_rollup SET count = count - 1, "
+            "total_value = total_value - IFNULL({0}.value, 0), "
+            "total_time = total_time - IFNULL({0}.time, 0), "
+            "max_value = CASE WHEN max_value > {0}.value THEN max_value "
+            "ELSE (SELECT MAX(value) {2}) END, "
+            "max_time = CASE WHEN max_time > {0}.time THEN max_time "
+            "ELSE (SELECT MAX(time) {2}) END "
+            "WHERE {1}".format(row, _rollup_match(row, kind), group))
+        statements.append("DELETE FROM exercise_rollup WHERE {0} "
+                          "AND count <= 0".format(_rollup_match(row, kind)))
+    return statements
+
+
+def _rollup_query():
+    '''
+    Query computing the content of ``exercise_rollup`` from the exercises.
+    Used to fill the table and to check it.
+    '''
+    selects = []
+    for kind in sorted(ROLLUP_PERIODS):
+        selects.append(
+            "SELECT user_id, '{0}', {1}, type, valueunit, timeunit, "
+            "COUNT(*), SUM(IFNULL(value, 0)), SUM(IFNULL(time, 0)), "
+            "MAX(value), MAX(time) FROM exercise "
+            "WHERE user_id IS NOT NULL AND date_iso IS NOT NULL "
+            "GROUP BY user_id, 3, type, valueunit, timeunit"
+            .format(kind, STATS_PERIODS[kind].format('date_iso')))
+    return ' UNION ALL '.join(selects)
+
+
+def _rollup_range(kind, start, end):
+    '''
+    Converts a date range to a range of ``exercise_rollup`` periods.
+
+    :param str kind: kind of period, ``week``, ``month`` or any other
+    :param str start: first date (``yyyy-mm-dd``) or None
+    :param str end: last date (``yyyy-mm-dd``) or None
+    :return: tuple (first period, last period), None meaning no limit. None
+        if there are no rollups of ``kind`` or if the range does not start
+        and end with a whole period.
+    '''
+    if kind not in ROLLUP_PERIODS:
+        return None
+    day = datetime.timedelta(days=1)
+    first = last = None
+    try:
+        if start is not None:
+            start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+        if end is not None:
+            end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+    except ValueError:
+        #Dates like 2012-02-31, the exercises are aggregated without rollups
+        return None
+    if start is not None:
+        if (start.weekday() if kind == 'week' else start.day - 1) != 0:
+            return None
+        first = start.isoformat() if kind == 'week' else start.isoformat()[:7]
+    if end is not None:
+        if kind == 'week':
+            if end.weekday() != 6:
+                return None
+            last = (end - 6 * day).isoformat()
+        else:
+            if (end + day).day != 1:
+                return None
+            last = end.isoformat()[:7]
+    return first, last
+
+
+def _period_bounds(kind, date):
+    '''
+    :param str kind: ``week`` or ``month``
+    :param datetime.date date: a day of the period
+    :return: tuple (name, first day, last day) of the period with the dates
+        in ``yyyy-mm-dd`` format. The periods are named like in
+        :py:data:`STATS_PERIODS`.
+    '''
+    if kind == 'week':
+        first = date - datetime.timedelta(days=date.weekday())
+        last = first + datetime.timedelta(days=6)
+        return first.isoformat(), first.isoformat(), last.isoformat()
+    first = date.replace(day=1)
+    last = (first + datetime.timedelta(days=31)).replace(day=1)
+    last -= datetime.timedelta(days=1)
+    return first.isoformat()[:7], first.isoformat(), last.isoformat()
+
+
+def _rollup_trigger(name, event, body):
+    return 'CREATE TRIGGER IF NOT EXISTS %s %s ON exercise BEGIN %s; END' % (
+        name, event, '; '.join(body))
+
+
+def _recreate_triggers(names):
+    '''
+    Migration step that drops and creates again the triggers ``names``, in
+    this order, with their current SQL. SQLite runs the triggers of an event
+    from the newest to the oldest, so a migration replacing a trigger uses
+    it to keep the triggers created after it newer.
+    '''
+    def step(cur):
+        for name in names:
+            cur.execute("SELECT sql FROM sqlite_master "
+                        "WHERE type = 'trigger' AND name = ?", (name,))
+            sql = cur.fetchone()[0]
+            cur.execute('DROP TRIGGER %s' % name)
+            cur.execute(sql)
+    return step
+
+
+def _sql_value_si(prefix):
+    '''
+    SQL version of :py:func:`units.value_si` for the columns of the exercise
+    row ``prefix`` (``''``, ``'NEW.'``).
+    '''
+    return units.REGISTRY.sql_to_si(prefix + 'value', prefix + 'valueunit',
+                                    units.DISTANCE)
+
+
+def _sql_time_si(prefix):
+    '''
+    SQL version of :py:func:`units.time_si`, see :py:func:`_sql_value_si`.
+    '''
+    return units.REGISTRY.sql_to_si(prefix + 'time', prefix + 'timeunit',
+                                    units.DURATION)
+
+
+def _chunks(values, size=MAX_IN_VARIABLES):
+    '''
+    Splits a list in consecutive lists of at most ``size`` elements.
+    '''
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class CompactRow(tuple):
+    '''
+    Base class of the compact rows returned when the :py:class:`Engine` is
+    created with ``compact_rows=True``. A compact row is a named tuple
+    without instance dictionary: the column names are stored once in its
+    class. Like :py:class:`sqlite3.Row` the values can be read by position or
+    by column name (``row['username']``) and also as attributes
+    (``row.username``).
+
+    The :py:class:`Connection` methods return them with the same keys as
+    the dictionaries (see :py:meth:`project`). They are still tuples, so
+    ``json`` writes them as arrays: use :py:meth:`asdict` to serialize
+    them.
+    '''
+    __slots__ = ()
+    #Position of every column name, set by compact_row_type
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise IndexError('No item with that key')
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        '''
+        :return: list with the column names, like :py:meth:`sqlite3.Row.keys`
+        '''
+        return list(self._columns)
+
+    def get(self, key, default=None):
+        '''
+        :return: the value of the column ``key`` or ``default`` if the row
+            does not have that column
+        '''
+        if key in self._index:
+            return self[key]
+        return default
+
+    def asdict(self):
+        '''
+        :return: a new dictionary with the columns of the row
+        '''
+        return dict(zip(self._columns, self))
+
+    def project(self, columns):
+        '''
+        :param tuple columns: column names of the row
+        :return: a compact row with only the columns ``columns``, in that
+            order
+        '''
+        return tuple.__new__(compact_row_type(columns),
+                             [self[column] for column in columns])
+
+
+_compact_row_types = {}
+_interned_strings = {}
+
+
+def compact_row_type(columns):
+    '''
+    Returns the :py:class:`CompactRow` subclass of the rows with the column
+    names ``columns``. The classes are created once and cached, at most
+    :py:data:`MAX_COMPACT_ROW_TYPES` of them; the others are created again
+    for every statement.
+
+    :param tuple columns: column names of the result set
+    '''
+    try:
+        return _compact_row_types[columns]
+    except KeyError:
+        pass
+    #rename=True because expressions like COUNT(*) are not identifiers
+    base = collections.namedtuple('Row', columns, rename=True)
+    index = {}
+    for position, column in enumerate(columns):
+        index.setdefault(column, position)
+    row_type = type('Row', (base, CompactRow),
+                    {'__slots__': (), '_index': index, '_columns': columns})
+    if len(_compact_row_types) < MAX_COMPACT_ROW_TYPES:
+        _compact_row_types[columns] = row_type
+    return row_type
+
+
+def intern_string(value):
+    '''
+    Returns a shared copy of the string ``value`` so equal strings of many
+    rows are stored once. At most :py:data:`MAX_INTERNED_STRINGS` strings
+    are kept; others are returned unchanged.
+    '''
+    try:
+        return _interned_strings[value]
+    except KeyError:
+        if len(_interned_strings) < MAX_INTERNED_STRINGS:
+            _interned_strings[value] = value
+        return value
+
+
+def compact_row_factory(cursor, row):
+    '''
+    sqlite3 row factory that builds :py:class:`CompactRow` objects and
+    interns the strings of the :py:data:`INTERNED_COLUMNS`. The column
+    layout of the cursor is computed once per statement and stored in the
+    cursor.
+    '''
+    description = cursor.description
+    layout = getattr(cursor, '_compact_layout', None)
+    if layout is None or layout[0] is not description:
+        columns = tuple(column[0] for column in description)
+        interned = tuple(position for position, column in enumerate(columns)
+                         if column in INTERNED_COLUMNS)
+        layout = (description, compact_row_type(columns), interned)
+        try:
+            cursor._compact_layout = layout
+        except AttributeError:
+            #Plain sqlite3 cursors do not accept attributes
+            pass
+    row_type, interned = layout[1], layout[2]
+    if interned:
+        row = list(row)
+        for position in interned:
+            if isinstance(row[position], basestring):
+                row[position] = intern_string(row[position])
+    return tuple.__new__(row_type, row)
+
+
+class StatementCounter(object):
+    '''
+    Thread safe counter of the SQL statements executed by the connections of
+    an :py:class:`Engine`, grouped by their first keyword (``SELECT``,
+    ``INSERT``, ``PRAGMA``...). It is used to check which statements run in
+    the hot path of the API. It is only installed by the Engines created
+    with ``count_statements=True``, like the ones of the tests.
+    '''
+    def __init__(self):
+        super(StatementCounter, self).__init__()
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def count(self, sql):
+        '''
+        Counts one execution of ``sql``.
+        '''
+        words = sql.split(None, 1)
+        kind = words[0].upper() if words else ''
+        with self._lock:
+            self._counts[kind] = self._counts.get(kind, 0) + 1
+
+    def snapshot(self):
+        '''
+        :return: dictionary with the number of statements of each kind.
+        '''
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        '''
+        Sets all the counters to zero.
+        '''
+        with self._lock:
+            self._counts = {}
+
+
+class CountingCursor(sqlite3.Cursor):
+    '''
+    sqlite3 cursor that reports every executed statement to the
+    :py:class:`StatementCounter` of its connection.
+    '''
+    def execute(self, sql, parameters=()):
+        self.connection.counter.count(sql)
+        return sqlite3.Cursor.execute(self, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.connection.counter.count(sql)
+        return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        self.connection.counter.count('SCRIPT')
+        return sqlite3.Cursor.executescript(self, sql_script)
+
+
+class CountingConnection(sqlite3.Connection):
+    '''
+    sqlite3 connection whose cursors are :py:class:`CountingCursor` objects.
+    The ``counter`` attribute is set by :py:meth:`Engine.open_connection`.
+    '''
+    counter = None
+
+    def cursor(self, factory=CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+class ConnectionPool(object):
+    '''
+    Bounded pool of sqlite3 connections to one database file.
+
+    A :py:class:`Connection` takes a sqlite3 connection from the pool using
+    :py:meth:`checkout` and gives it back with :py:meth:`checkin` when it is
+    closed, so the file is not opened and closed again on every request.
+
+    * At most ``max_size`` connections exist at the same time. When all of
+      them are in use :py:meth:`checkout` waits until one is returned.
+    * Connections that have not been used for ``idle_timeout`` seconds are
+      closed.
+    * Every connection is checked with ``SELECT 1`` before it is handed out.
+      Broken connections are discarded and replaced.
+    * A thread gets back the connection it used last time if it is free.
+
+    The counters of the pool are returned by :py:meth:`metrics`.
+
+    :param str db_path: The path of the database file.
+    :param open_connection: Function used to open and configure a new
+        sqlite3 connection. It receives the database path and returns the
+        connection. Normally :py:meth:`Engine.open_connection`.
+    :param int max_size: Maximum number of connections.
+    :param idle_timeout: Seconds before an idle connection is closed.
+    :param wait_timeout: Seconds to wait for a free connection before
+        raising :py:exc:`sqlite3.OperationalError`.
+
+    '''
+    def __init__(self, db_path, open_connection, max_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 wait_timeout=DEFAULT_POOL_WAIT_TIMEOUT):
+        super(ConnectionPool, self).__init__()
+        self.db_path = db_path
+        self.open_connection = open_connection
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        #Free connections as [connection, time of the checkin] pairs
+        self._idle = []
+        #Number of connections opened by the pool and not closed yet
+        self._size = 0
+        #Connections opened before the last dispose() are closed on checkin
+        self._generation = 0
+        self._generations = {}
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._metrics = {'checkouts': 0, 'hits': 0, 'creations': 0,
+                         'waits': 0, 'evictions': 0, 'discarded': 0}
+
+    def _close(self, con):
+        '''
+        Closes a connection owned by the pool. Must be called holding the lock.
+        '''
+        self._generations.pop(id(con), None)
+        self._size -= 1
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
+        self._cond.notify()
+
+    def _is_healthy(self, con):
+        '''
+        Checks that a pooled connection still works and does not have a
+        transaction left open by its previous user.
+        '''
+        try:
+            con.rollback()
+            #A plain cursor, so the check is not counted as a statement of
+            #the API
+            sqlite3.Cursor(con).execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _evict_idle(self):
+        '''
+        Closes the connections that have been idle for too long. Must be
+        called holding the lock.
+        '''
+        if self.idle_timeout is None:
+            return
+        limit = time.time() - self.idle_timeout
+        keep = []
+        for entry in self._idle:
+            if entry[1] < limit:
+                self._metrics['evictions'] += 1
+                self._close(entry[0])
+            else:
+                keep.append(entry)
+        self._idle = keep
+
+    def _take_idle(self):
+        '''
+        Removes a free connection from the pool, preferring the one the
+        calling thread used last. Must be called holding the lock.
+        '''
+        if not self._idle:
+            return None
+        last = getattr(self._local, 'con', None)
+        for index, entry in enumerate(self._idle):
+            if entry[0] is last:
+                return self._idle.pop(index)[0]
+        #Most recently returned connection, it has the warmest page cache
+        return self._idle.pop()[0]
+
+    def checkout(self):
+        '''
+        Takes a connection from the pool, opening a new one if there are no
+        free connections and the pool is not full.
+
+        :return: a sqlite3 connection
+        :raises sqlite3.OperationalError: if no connection is released in
+            ``wait_timeout`` seconds.
+
+        '''
+        with self._cond:
+            self._metrics['checkouts'] += 1
+            deadline = None
+            waited = False
+            while True:
+                self._evict_idle()
+                con = self._take_idle()
+                if con is not None:
+                    if self._is_healthy(con):
+                        self._metrics['hits'] += 1
+                        return con
+                    self._metrics['discarded'] += 1
+                    self._close(con)
+                    continue
+                if self._size < self.max_size:
+                    #Reserve the slot, the file is opened outside the lock
+                    self._size += 1
+                    generation = self._generation
+                    break
+                if not waited:
+                    waited = True
+                    self._metrics['waits'] += 1
+                    if self.wait_timeout is not None:
+                        deadline = time.time() + self.wait_timeout
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError(
+                            'connection pool exhausted')
+                self._cond.wait(remaining)
+        try:
+            con = self.open_connection(self.db_path)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._metrics['creations'] += 1
+            self._generations[id(con)] = generation
+        return con
+
+    def checkin(self, con):
+        '''
+        Gives back a connection obtained with :py:meth:`checkout`.
+
+        :param con: the sqlite3 connection
+        '''
+        with self._cond:
+            if self._generations.get(id(con)) != self._generation:
+                #Opened before dispose() or not opened by this pool
+                if id(con) in self._generations:
+                    self._close(con)
+                else:
+                    con.close()
+                return
+            self._idle.append([con, time.time()])
+            self._local.con = con
+            self._evict_idle()
+            self._cond.notify()
+
+    def dispose(self):
+        '''
+        Closes all the free connections. Connections that are checked out
+        at this moment are closed when they are given back.
+        '''
+        with self._cond:
+            self._generation += 1
+            for entry in self._idle:
+                self._close(entry[0])
+            self._idle = []
+
+    def metrics(self):
+        '''
+        Returns the counters of the pool.
+
+        :return: a dictionary containing the following keys:
+
+            * ``checkouts``: Number of calls to :py:meth:`checkout` (int)
+            * ``hits``: Checkouts served with a pooled connection (int)
+            * ``creations``: Connections opened by the pool (int)
+            * ``waits``: Times a checkout had to wait for a connection (int)
+            * ``evictions``: Idle connections closed by the timeout (int)
+            * ``discarded``: Connections that failed the health check (int)
+            * ``size``: Connections currently open (int)
+            * ``idle``: Connections currently free (int)
+
+        '''
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics['size'] = self._size
+            metrics['idle'] = len(self._idle)
+        return metrics
+
+
+class QueryCache(object):
+    '''
+    Thread safe LRU cache of the rows returned by SELECT statements, shared
+    by the connections of an :py:class:`Engine` created with
+    ``query_cache=True``.
+
+    Entries are keyed by the SQL text and its parameters and tagged with the
+    versions of the tables the statement reads. :py:meth:`Connection._write`
+    bumps the versions of the tables modified by every committed operation,
+    so entries read before the change are not returned anymore. Entries
+    also expire ``ttl`` seconds after they are stored, and the least
+    recently used entries are evicted when there are more than ``max_size``.
+
+    :param int max_size: Maximum number of cached statements
+    :param ttl: Seconds a cached result is valid
+    '''
+    def __init__(self, max_size=DEFAULT_QUERY_CACHE_SIZE,
+                 ttl=DEFAULT_QUERY_CACHE_TTL):
+        super(QueryCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._versions = {}
+        #Bumped by clear, it invalidates the entries of every table
+        self._epoch = 0
+        self._metrics = {'hits': 0, 'misses': 0, 'evictions': 0,
+                         'expirations': 0, 'invalidations': 0}
+
+    def _current(self, tables):
+        '''
+        Versions of ``tables``. Must be called holding the lock.
+        '''
+        return (self._epoch,) + tuple(self._versions.get(table, 0)
+                                      for table in tables)
+
+    def versions(self, tables):
+        '''
+        :return: the current versions of ``tables``. They must be read before
+            executing the statement whose rows are passed to :py:meth:`put`.
+        '''
+        with self._lock:
+            return self._current(tables)
+
+    def get(self, key):
+        '''
+        :return: the cached rows of ``key`` or None if they are not cached,
+            have expired or a table they were read from has changed.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._metrics['misses'] += 1
+                return None
+            rows, tables, versions, expires = entry
+            if expires <= time.time():
+                reason = 'expirations'
+            elif self._current(tables) != versions:
+                reason = 'invalidations'
+            else:
+                #Move the entry to the most recently used end
+                del self._entries[key]
+                self._entries[key] = entry
+                self._metrics['hits'] += 1
+                return rows
+            del self._entries[key]
+            self._metrics[reason] += 1
+            self._metrics['misses'] += 1
+            return None
+
+    def put(self, key, rows, tables, versions):
+        '''
+        Stores the rows of the statement ``key``.
+
+        :param tuple rows: rows returned by the statement
+        :param tuple tables: tables read by the statement
+        :param tuple versions: result of :py:meth:`versions` before the
+            statement was executed. If a table changed meanwhile the rows are
+            not stored.
+        '''
+        with self._lock:
+            if self._current(tables) != versions:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (rows, tables, versions,
+                                  time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._metrics['evictions'] += 1
+
+    def bump(self, tables):
+        '''
+        Invalidates the entries that read any of ``tables``.
+        '''
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def clear(self):
+        '''
+        Removes all the entries. Used when the database is modified without
+        the :py:class:`Connection` methods.
+        '''
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def metrics(self):
+        '''
+        :return: dictionary with the counters ``hits``, ``misses``,
+            ``evictions`` (LRU), ``expirations`` (TTL) and ``invalidations``
+            (table versions) and the current ``size``.
+        '''
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['size'] = len(self._entries)
+            return metrics
+
+
+class IdentityMap(object):
+    '''
+    Thread safe, bounded two-way map between usernames and user ids, shared
+    by the connections of an :py:class:`Engine` created with
+    ``identity_map=True``. It saves the ``SELECT user_id FROM users WHERE
+    username = ?`` lookup that starts most :py:class:`Connection` methods,
+    and its reverse.
+
+    Unknown usernames are stored as negative entries (user id None). User
+    ids are never reused (AUTOINCREMENT) and usernames cannot be modified,
+    so only :py:meth:`Connection.append_user` and
+    :py:meth:`Connection.delete_user` invalidate entries. The least recently
+    used usernames are evicted when there are more than ``max_size``.
+
+    :param int max_size: Maximum number of usernames, including the
+        negative entries
+    '''
+    def __init__(self, max_size=DEFAULT_IDENTITY_MAP_SIZE):
+        super(IdentityMap, self).__init__()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        #username => user_id or None, in LRU order
+        self._ids = collections.OrderedDict()
+        #user_id => username of the positive entries of _ids
+        self._names = {}
+        #Incremented by every invalidation, see put
+        self._generation = 0
+        self._metrics = {'hits': 0, 'negative_hits': 0, 'misses': 0,
+                         'evictions': 0}
+
+    def generation(self):
+        '''
+        :return: a number that changes with every invalidation. It must be
+            read before the query whose result is passed to :py:meth:`put`.
+        '''
+        with self._lock:
+            return self._generation
+
+    def user_id(self, username):
+        '''
+        :return: tuple (found, user_id). ``found`` is False if the username
+            is not in the map; ``user_id`` is None for an unknown user.
+        '''
+        with self._lock:
+            try:
+                user_id = self._ids.pop(username)
+            except KeyError:
+                self._metrics['misses'] += 1
+                return False, None
+            #Move the entry to the most recently used end
+            self._ids[username] = user_id
+            if user_id is None:
+                self._metrics['negative_hits'] += 1
+            else:
+                self._metrics['hits'] += 1
+            return True, user_id
+
+    def username(self, user_id):
+        '''
+        :return: the username of ``user_id`` or None if it is not in the map
+        '''
+        with self._lock:
+            username = self._names.get(user_id)
+            if username is None:
+                self._metrics['misses'] += 1
+            else:
+                self._metrics['hits'] += 1
+            return username
+
+    def put(self, username, user_id, generation):
+        '''
+        Stores the user id of ``username`` (None if the user does not exist).
+
+        :param generation: result of :py:meth:`generation` before the query.
+            If an entry was invalidated meanwhile nothing is stored, because
+            the query could have read the database before the change.
+        '''
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(username)
+            self._ids[username] = user_id
+            if user_id is not None:
+                self._names[user_id] = username
+            while len(self._ids) > self.max_size:
+                self._remove(next(iter(self._ids)))
+                self._metrics['evictions'] += 1
+
+    def _remove(self, username):
+        '''
+        Removes the entries of ``username``. Must be called holding the lock.
+        '''
+        user_id = self._ids.pop(username, None)
+        if user_id is not None:
+            self._names.pop(user_id, None)
+
+    def discard(self, username):
+        '''
+        Invalidates the entries of ``username``, because it has been created
+        or deleted.
+        '''
+        with self._lock:
+            self._generation += 1
+            self._remove(username)
+
+    def clear(self):
+        '''
+        Removes all the entries.
+        '''
+        with self._lock:
+            self._generation += 1
+            self._ids.clear()
+            self._names.clear()
+
+    def metrics(self):
+        '''
+        :return: dictionary with the counters ``hits``, ``negative_hits``,
+            ``misses`` and ``evictions`` and the current ``size``
+        '''
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['size'] = len(self._ids)
+            return metrics
+
+
+class UsernameFilter(object):
+    '''
+    Bloom filter of the usernames of the database, shared by the
+    connections of an :py:class:`Engine` created with
+    ``username_filter=True``. When it says that a username is not in the
+    database the user does not exist for sure, and the lookup is answered
+    without any query. This protects the database from floods of unknown
+    usernames.
+
+    The filter is built from the ``users`` table the first time it is used
+    and is rebuilt after ``rebuild_deletes`` users have been deleted, because
+    a Bloom filter cannot remove keys, or when it holds more usernames than
+    it was sized for. :py:meth:`Connection.append_user` adds the new
+    usernames before inserting them, so the filter never misses an existing
+    user, but they are only counted once the insert is committed.
+
+    :param float error_rate: False positive rate the filter is sized for
+    :param int rebuild_deletes: Deleted users that trigger a rebuild
+    '''
+    def __init__(self, error_rate=DEFAULT_FILTER_ERROR_RATE,
+                 rebuild_deletes=DEFAULT_FILTER_REBUILD_DELETES):
+        super(UsernameFilter, self).__init__()
+        self.error_rate = error_rate
+        self.rebuild_deletes = rebuild_deletes
+        self._lock = threading.Lock()
+        self._bloom = None
+        #Usernames added while a rebuild reads the users table
+        self._pending = None
+        self._deletes = 0
+        self._metrics = {'checks': 0, 'definite_misses': 0,
+                         'false_positives': 0, 'rebuilds': 0}
+
+    def needs_build(self):
+        '''
+        :return: True if the filter must be (re)built before it is used
+        '''
+        bloom = self._bloom
+        return (bloom is None or self._deletes >= self.rebuild_deletes or
+                bloom.count > bloom.capacity)
+
+    def build(self, con):
+        '''
+        Builds the filter from the usernames of the ``users`` table. Returns
+        at once if another thread is already building it.
+
+        :param con: sqlite3 connection used to read the usernames
+        '''
+        with self._lock:
+            if self._pending is not None:
+                return
+            self._pending = set()
+        try:
+            cur = con.cursor()
+            cur.execute('SELECT username FROM users')
+            usernames = [row[0] for row in cur.fetchall()]
+            bloom = BloomFilter(max(2 * len(usernames),
+                                    DEFAULT_FILTER_CAPACITY), self.error_rate)
+            for username in usernames:
+                bloom.add(username)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            #The committed ones are already counted in usernames
+            for username in self._pending:
+                bloom.add(username, count=False)
+            self._bloom = bloom
+            self._pending = None
+            self._deletes = 0
+            self._metrics['rebuilds'] += 1
+
+    def add(self, username):
+        '''
+        Adds a username that is going to be inserted. It is not counted
+        until :py:meth:`inserted`, because the insert can still fail.
+        '''
+        self._add(username, False)
+
+    def inserted(self, username):
+        '''
+        Counts a username whose insert has been committed. It is added
+        again in case a rebuild read the users table before the commit.
+        '''
+        self._add(username, True)
+
+    def _add(self, username, count):
+        if username is None:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending.add(username)
+            if self._bloom is not None:
+                self._bloom.add(username, count)
+
+    def deleted(self):
+        '''
+        Counts a deleted user.
+        '''
+        with self._lock:
+            self._deletes += 1
+
+    def might_contain(self, username):
+        '''
+        :return: False if ``username`` is certainly not in the database. True
+            if it might be, or if the filter is not built.
+        '''
+        bloom = self._bloom
+        if bloom is None:
+            return True
+        found = username in bloom
+        with self._lock:
+            self._metrics['checks'] += 1
+            if not found:
+                self._metrics['definite_misses'] += 1
+        return found
+
+    def false_positive(self):
+        '''
+        Counts a username that passed the filter but was not in the
+        database.
+        '''
+        with self._lock:
+            self._metrics['false_positives'] += 1
+
+    def invalidate(self):
+        '''
+        Discards the filter, it is built again when it is used next time.
+        '''
+        with self._lock:
+            self._bloom = None
+
+    def metrics(self):
+        '''
+        :return: dictionary with the counters ``checks``, ``definite_misses``,
+            ``false_positives`` and ``rebuilds``, the number of ``usernames``
+            in the filter, the measured ``false_positive_rate`` (false
+            positives among the checked usernames that were not in the
+            database) and the ``estimated_false_positive_rate`` of the
+            filter.
+        '''
+        with self._lock:
+            metrics = dict(self._metrics)
+            bloom = self._bloom
+        absent = metrics['false_positives'] + metrics['definite_misses']
+        if absent:
+            metrics['false_positive_rate'] = (float(metrics['false_positives'])
+                                              / absent)
+        else:
+            metrics['false_positive_rate'] = 0.0
+        metrics['usernames'] = len(bloom) if bloom is not None else 0
+        metrics['estimated_false_positive_rate'] = (
+            bloom.estimated_error_rate() if bloom is not None else 0.0)
+        return metrics
+
+
+class _WriteOperation(object):
+    '''
+    A mutating :py:class:`Connection` method call waiting in the queue of the
+    :py:class:`GroupCommitWriter`.
+    '''
+    def __init__(self, name, args):
+        super(_WriteOperation, self).__init__()
+        self.name = name
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter(object):
+    '''
+    Dedicated thread that owns the write connection of an :py:class:`Engine`.
+
+    The mutating methods of :py:class:`Connection` (``append_user``,
+    ``create_exercise``, ``add_friend``...) put the call in a queue with
+    :py:meth:`submit` and wait. The writer takes the queued operations and
+    runs them in one transaction, each one inside its own savepoint, and
+    commits them together. A group is closed when it has ``batch_size``
+    operations or when no new operation arrives in ``interval`` seconds.
+    With an interval of 0 the group contains the operations queued while
+    the previous group was being committed.
+
+    Every caller gets back the value returned by its own operation. If an
+    operation raises an exception only that operation is rolled back and the
+    exception is raised in the caller. If the commit, or a call registered
+    to run after it, fails all the operations of the group get the error.
+
+    :param engine: The Engine whose database is written.
+    :type engine: Engine
+    :param int batch_size: Maximum number of operations per commit.
+    :param interval: Seconds to wait for more operations before committing.
+
+    '''
+    def __init__(self, engine, batch_size=DEFAULT_COMMIT_BATCH_SIZE,
+                 interval=DEFAULT_COMMIT_INTERVAL):
+        super(GroupCommitWriter, self).__init__()
+        self.engine = engine
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._metrics = {'operations': 0, 'commits': 0, 'failures': 0}
+        self._thread = threading.Thread(target=self._run,
+                                        name='forum-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, name, args):
+        '''
+        Queues the call ``Connection._<name>(*args)`` and waits until it has
+        been committed.
+
+        :param str name: Name of the mutating method, e.g. ``append_user``
+        :param tuple args: Arguments of the method
+        :return: the value returned by the method
+        :raises Exception: the exception raised by the method or by the
+            commit.
+        '''
+        operation = _WriteOperation(name, args)
+        self._queue.put(operation)
+        operation.done.wait()
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def stop(self):
+        '''
+        Commits the queued operations and stops the thread.
+        '''
+        self._queue.put(None)
+        self._thread.join()
+
+    def metrics(self):
+        '''
+        :return: a dictionary containing the following keys:
+
+            * ``operations``: Operations executed (int)
+            * ``commits``: Transactions committed (int)
+            * ``failures``: Operations that raised an exception (int)
+
+        '''
+        with self._lock:
+            return dict(self._metrics)
+
+    def _next_group(self):
+        '''
+        Waits for the next operation and collects the operations queued
+        after it until the group is full or the interval expires.
+
+        :return: tuple (list of operations, True if the writer must stop)
+        '''
+        operation = self._queue.get()
+        if operation is None:
+            return [], True
+        group = [operation]
+        deadline = time.time() + self.interval
+        while len(group) < self.batch_size:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    operation = self._queue.get(True, remaining)
+                else:
+                    operation = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if operation is None:
+                return group, True
+            group.append(operation)
+        return group, False
+
+    def _execute(self, connection, group):
+        '''
+        Runs a group of operations in one transaction and commits it.
+        '''
+        cur = connection.con.cursor()
+        failures = 0
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for operation in group:
+                cur.execute('SAVEPOINT operation')
+                mark = connection._commit_mark()
+                try:
+                    operation.result = getattr(connection,
+                                               '_' + operation.name)(
+                                                   *operation.args)
+                except Exception, excp:
+                    operation.error = excp
+                    failures += 1
+                    cur.execute('ROLLBACK TO operation')
+                    connection._discard_on_commit(mark)
+                cur.execute('RELEASE operation')
+            cur.execute('COMMIT')
+            connection._run_on_commit()
+        except Exception, excp:
+            #The commit failed or one of the calls registered for after the
+            #commit raised: the operations that had not failed yet get the
+            #error. ROLLBACK fails if the transaction was already committed.
+            connection._discard_on_commit()
+            try:
+                cur.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            for operation in group:
+                if operation.error is None:
+                    operation.error = excp
+                    failures += 1
+        finally:
+            with self._lock:
+                self._metrics['operations'] += len(group)
+                self._metrics['commits'] += 1
+                self._metrics['failures'] += failures
+            for operation in group:
+                operation.done.set()
+
+    def _fail(self, group, error):
+        '''
+        Gives ``error`` to a group of operations that cannot be executed.
+        '''
+        for operation in group:
+            operation.error = error
+        with self._lock:
+            self._metrics['operations'] += len(group)
+            self._metrics['failures'] += len(group)
+        for operation in group:
+            operation.done.set()
+
+    def _run(self):
+        '''
+        Main loop of the writer thread.
+
+        The write connection is opened with the first group. If it cannot be
+        opened the operations of the group get the error and the writer
+        tries again with the next group.
+        '''
+        connection = None
+        try:
+            stop = False
+            while not stop:
+                group, stop = self._next_group()
+                if not group:
+                    continue
+                if connection is None:
+                    try:
+                        connection = self._connect()
+                    except Exception, excp:
+                        self._fail(group, excp)
+                        continue
+                self._execute(connection, group)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _connect(self):
+        '''
+        :return: the write connection, in autocommit mode
+        '''
+        connection = Connection(self.engine.db_path,
+                                open_connection=self.engine.open_connection,
+                                identity=self.engine.identity_map,
+                                username_filter=self.engine.username_filter,
+                                graph=self.engine.friend_graph,
+                                timeline_friends=self.engine.timeline_friends)
+        #Transactions are controlled explicitly by _execute
+        connection.con.isolation_level = None
+        return connection
+
+
+#SCHEMA MIGRATIONS
+#The tables created by Engine.create_*_table are the version 0 of the
+#schema. Every later change is a migration: (version, description, steps).
+#A step is a SQL statement or a function that receives a sqlite3 cursor.
+#Engine.migrate() applies the pending migrations in order, each one in its
+#own transaction, and stores the version in PRAGMA user_version.
+#Migrations are never modified once released, add a new one instead.
+MIGRATIONS = [
+    (1, 'Indexes for the Connection queries', [
+        #get_user_exercises and the friend lookups by username
+        'CREATE INDEX IF NOT EXISTS exercise_username_idx '
+        'ON exercise(username)',
+        #Foreign key exercise(user_id, username) -> users, used when a user
+        #is deleted (ON DELETE SET NULL)
+        'CREATE INDEX IF NOT EXISTS exercise_user_idx '
+        'ON exercise(user_id, username)',
+        #Foreign key friends(friend_id) -> users (ON DELETE CASCADE) and the
+        #reverse friend lookups. friends(user_id) uses the primary key.
+        'CREATE INDEX IF NOT EXISTS friends_friend_id_idx '
+        'ON friends(friend_id)',
+    ]),
+    (2, 'Sortable exercise dates in exercise.date_iso', [
+        'ALTER TABLE exercise ADD COLUMN date_iso TEXT',
+        'UPDATE exercise SET date_iso = %s' % _sql_iso_date('date'),
+        'CREATE INDEX IF NOT EXISTS exercise_user_date_idx '
+        'ON exercise(user_id, date_iso)',
+        #Rows inserted or updated without going through Connection, for
+        #instance the data dumps, get date_iso from the triggers
+        'CREATE TRIGGER IF NOT EXISTS exercise_date_iso_insert '
+        'AFTER INSERT ON exercise '
+        'WHEN NEW.date_iso IS NULL AND NEW.date IS NOT NULL BEGIN '
+        'UPDATE exercise SET date_iso = %s '
+        'WHERE exercise_id = NEW.exercise_id; END' % _sql_iso_date('NEW.date'),
+        'CREATE TRIGGER IF NOT EXISTS exercise_date_iso_update '
+        'AFTER UPDATE OF date ON exercise '
+        'WHEN NEW.date_iso IS OLD.date_iso BEGIN '
+        'UPDATE exercise SET date_iso = %s '
+        'WHERE exercise_id = NEW.exercise_id; END' % _sql_iso_date('NEW.date'),
+    ]),
+    (3, 'Covering index for user listings without password and avatar', [
+        'CREATE INDEX IF NOT EXISTS users_list_idx '
+        'ON users(user_id, username, description, visibility)',
+    ]),
+    (4, 'Weekly and monthly exercise rollups kept by triggers', [
+        'CREATE TABLE IF NOT EXISTS exercise_rollup(user_id INTEGER, '
+        'period_kind TEXT, period TEXT, type TEXT, valueunit TEXT, '
+        'timeunit TEXT, count INTEGER, total_value INTEGER, '
+        'total_time INTEGER, max_value INTEGER, max_time INTEGER)',
+        'CREATE INDEX IF NOT EXISTS exercise_rollup_idx '
+        'ON exercise_rollup(user_id, period_kind, period)',
+        'INSERT INTO exercise_rollup(%s) %s' % (', '.join(ROLLUP_COLUMNS),
+                                                _rollup_query()),
+        _rollup_trigger('exercise_rollup_insert', 'AFTER INSERT',
+                        _rollup_add('NEW')),
+        _rollup_trigger('exercise_rollup_delete', 'AFTER DELETE',
+                        _rollup_remove('OLD')),
+        #date_iso is in the list: the rows inserted without it get it from
+        #the exercise_date_iso_insert trigger
+        _rollup_trigger('exercise_rollup_update',
+                        'AFTER UPDATE OF user_id, type, value, valueunit, '
+                        'date_iso, time, timeunit',
+                        _rollup_remove('OLD') + _rollup_add('NEW')),
+    ]),
+    #The conversions are the units of units.REGISTRY when the migration was
+    #written. Units registered later need a new migration.
+    (5, 'Values and times in SI units in exercise.value_si and time_si', [
+        'ALTER TABLE exercise ADD COLUMN value_si REAL',
+        'ALTER TABLE exercise ADD COLUMN time_si REAL',
+        'UPDATE exercise SET value_si = %s, time_si = %s' % (
+            _sql_value_si(''), _sql_time_si('')),
+        #Rows inserted or updated without going through Connection get the
+        #SI values from the triggers
+        'CREATE TRIGGER IF NOT EXISTS exercise_si_insert '
+        'AFTER INSERT ON exercise '
+        'WHEN NEW.value_si IS NULL AND NEW.time_si IS NULL BEGIN '
+        'UPDATE exercise SET value_si = %s, time_si = %s '
+        'WHERE exercise_id = NEW.exercise_id; END' % (
+            _sql_value_si('NEW.'), _sql_time_si('NEW.')),
+        'CREATE TRIGGER IF NOT EXISTS exercise_si_update '
+        'AFTER UPDATE OF value, valueunit, time, timeunit ON exercise '
+        'WHEN NEW.value_si IS OLD.value_si AND NEW.time_si IS OLD.time_si '
+        'BEGIN UPDATE exercise SET value_si = %s, time_si = %s '
+        'WHERE exercise_id = NEW.exercise_id; END' % (
+            _sql_value_si('NEW.'), _sql_time_si('NEW.')),
+    ]),
+    #Fan-out-on-write feeds. timeline has a row per exercise of a friend of
+    #the users in timeline_users, so Connection.get_feed reads their feed
+    #with one range of its primary key. The triggers keep it in sync with
+    #the exercises and the friends.
+    (6, 'Friends activity timelines for the users in timeline_users', [
+        'CREATE TABLE IF NOT EXISTS timeline_users('
+        'user_id INTEGER PRIMARY KEY, '
+        'FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)',
+        'CREATE TABLE IF NOT EXISTS timeline(user_id INTEGER, '
+        'date_iso TEXT, exercise_id INTEGER, '
+        'PRIMARY KEY(user_id, date_iso, exercise_id)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS timeline_exercise_idx '
+        'ON timeline(exercise_id)',
+        'CREATE TRIGGER IF NOT EXISTS timeline_exercise_insert '
+        'AFTER INSERT ON exercise '
+        'WHEN NEW.user_id IS NOT NULL AND NEW.date_iso IS NOT NULL BEGIN '
+        'INSERT OR IGNORE INTO timeline(user_id, date_iso, exercise_id) '
+        'SELECT friends.user_id, NEW.date_iso, NEW.exercise_id '
+        'FROM friends JOIN timeline_users '
+        'ON timeline_users.user_id = friends.user_id '
+        'WHERE friends.friend_id = NEW.user_id; END',
+        #Also the rows inserted without date_iso (see
+        #exercise_date_iso_insert) and the exercises of deleted users
+        #(ON DELETE SET NULL)
+        'CREATE TRIGGER IF NOT EXISTS timeline_exercise_update '
+        'AFTER UPDATE OF user_id, date_iso ON exercise BEGIN '
+        'DELETE FROM timeline WHERE exercise_id = OLD.exercise_id; '
+        'INSERT OR IGNORE INTO timeline(user_id, date_iso, exercise_id) '
+        'SELECT friends.user_id, NEW.date_iso, NEW.exercise_id '
+        'FROM friends JOIN timeline_users '
+        'ON timeline_users.user_id = friends.user_id '
+        'WHERE friends.friend_id = NEW.user_id '
+        'AND NEW.date_iso IS NOT NULL; END',
+        'CREATE TRIGGER IF NOT EXISTS timeline_exercise_delete '
+        'AFTER DELETE ON exercise BEGIN '
+        'DELETE FROM timeline WHERE exercise_id = OLD.exercise_id; END',
+        'CREATE TRIGGER IF NOT EXISTS timeline_friends_insert '
+        'AFTER INSERT ON friends WHEN NEW.user_id IN '
+        '(SELECT user_id FROM timeline_users) BEGIN '
+        'INSERT OR IGNORE INTO timeline(user_id, date_iso, exercise_id) '
+        'SELECT NEW.user_id, date_iso, exercise_id FROM exercise '
+        'WHERE user_id = NEW.friend_id AND date_iso IS NOT NULL; END',
+        'CREATE TRIGGER IF NOT EXISTS timeline_friends_delete '
+        'AFTER DELETE ON friends WHEN OLD.user_id IN '
+        '(SELECT user_id FROM timeline_users) BEGIN '
+        'DELETE FROM timeline WHERE user_id = OLD.user_id '
+        'AND exercise_id IN (SELECT exercise_id FROM exercise '
+        'WHERE user_id = OLD.friend_id); END',
+        'CREATE TRIGGER IF NOT EXISTS timeline_users_insert '
+        'AFTER INSERT ON timeline_users BEGIN '
+        'INSERT OR IGNORE INTO timeline(user_id, date_iso, exercise_id) '
+        'SELECT NEW.user_id, exercise.date_iso, exercise.exercise_id '
+        'FROM friends JOIN exercise ON exercise.user_id = friends.friend_id '
+        'WHERE friends.user_id = NEW.user_id '
+        'AND exercise.date_iso IS NOT NULL; END',
+        'CREATE TRIGGER IF NOT EXISTS timeline_users_delete '
+        'AFTER DELETE ON timeline_users BEGIN '
+        'DELETE FROM timeline WHERE user_id = OLD.user_id; END',
+    ]),
+    #Migration 2 and iso_date accepted days out of range, like 30.2.2012.
+    #The date_iso triggers are created again with the checks of
+    #_sql_iso_date, followed by the exercise triggers created after them to
+    #keep their order, and the invalid dates are removed. The
+    #exercise_rollup and timeline triggers update the derived tables.
+    (7, 'Only valid dates in exercise.date_iso', [
+        'DROP TRIGGER IF EXISTS exercise_date_iso_insert',
+        'CREATE TRIGGER exercise_date_iso_insert '
+        'AFTER INSERT ON exercise '
+        'WHEN NEW.date_iso IS NULL AND NEW.date IS NOT NULL BEGIN '
+        'UPDATE exercise SET date_iso = %s '
+        'WHERE exercise_id = NEW.exercise_id; END' % _sql_iso_date('NEW.date'),
+        'DROP TRIGGER IF EXISTS exercise_date_iso_update',
+        'CREATE TRIGGER exercise_date_iso_update '
+        'AFTER UPDATE OF date ON exercise '
+        'WHEN NEW.date_iso IS OLD.date_iso BEGIN '
+        'UPDATE exercise SET date_iso = %s '
+        'WHERE exercise_id = NEW.exercise_id; END' % _sql_iso_date('NEW.date'),
+        _recreate_triggers(('exercise_rollup_insert', 'exercise_rollup_delete',
+                            'exercise_rollup_update', 'exercise_si_insert',
+                            'exercise_si_update', 'timeline_exercise_insert',
+                            'timeline_exercise_update',
+                            'timeline_exercise_delete')),
+        'UPDATE exercise SET date_iso = NULL '
+        "WHERE date(date_iso, '+0 days') IS NOT date_iso",
+    ]),
+]
 
 
 class Engine(object):
@@ -33,9 +1619,65 @@ class Engine(object):
     :param db_path: The path of the database file (always with respect to the
         calling script. If not specified, the Engine will use the file located
         at *db/forum.db*
+    :param int pool_size: Maximum number of pooled sqlite3 connections. Use
+        ``0`` to open a new sqlite3 connection for every :py:meth:`connect`.
+    :param pool_idle_timeout: Seconds an unused pooled connection is kept
+        open.
+    :param int busy_timeout: Milliseconds a statement waits for a database
+        lock before failing.
+    :param int statement_cache_size: Number of prepared statements cached by
+        each sqlite3 connection.
+    :param profile: Name of one of the :py:data:`STORAGE_PROFILES` or a
+        dictionary with the same keys. It sets the journal mode, synchronous
+        level, page cache, memory map, temporary storage and WAL checkpoint
+        interval of every connection.
+    :param bool group_commit: If True the mutating methods of the connections
+        are executed by a :py:class:`GroupCommitWriter` thread.
+    :param int commit_batch_size: Maximum operations per group commit.
+    :param commit_interval: Seconds the writer waits to fill a group.
+    :param bool compact_rows: If True the connections use
+        :py:func:`compact_row_factory` and the read methods return
+        :py:class:`CompactRow` objects with the selected columns instead of
+        dictionaries. They use much less memory in long listings.
+    :param bool query_cache: If True the read methods of the connections
+        share a :py:class:`QueryCache`.
+    :param int query_cache_size: Maximum number of cached statements.
+    :param query_cache_ttl: Seconds a cached result is valid.
+    :param bool identity_map: If True the connections share an
+        :py:class:`IdentityMap` of usernames and user ids. Do not use it if
+        other processes create or delete users in the same database file.
+    :param int identity_map_size: Maximum number of usernames in the map.
+    :param bool username_filter: If True the connections share a
+        :py:class:`UsernameFilter` that answers the lookups of unknown
+        usernames without queries. As the identity map, it cannot be used if
+        other processes create users in the same database file.
+    :param bool friend_graph: If True the connections share a
+        :py:class:`graph.FriendGraph` copy of the ``friends`` table, used by
+        the mutual friends, followers and suggestions methods. It cannot be
+        used if other processes modify the friends.
+    :param int timeline_friends: If given, :py:meth:`Connection.add_friend`
+        enables the timeline of a user (see :py:meth:`Connection.get_feed`)
+        when it has this number of friends or more.
+    :param bool count_statements: If True the connections count the
+        executed statements in a :py:class:`StatementCounter`, see
+        :py:meth:`statement_counts`. It adds a lock to every statement, so
+        it is meant for tests and benchmarks.
 
     '''
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, pool_size=DEFAULT_POOL_SIZE,
+                 pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT,
+                 statement_cache_size=DEFAULT_STATEMENT_CACHE_SIZE,
+                 profile=DEFAULT_STORAGE_PROFILE, group_commit=False,
+                 commit_batch_size=DEFAULT_COMMIT_BATCH_SIZE,
+                 commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 compact_rows=False, query_cache=False,
+                 query_cache_size=DEFAULT_QUERY_CACHE_SIZE,
+                 query_cache_ttl=DEFAULT_QUERY_CACHE_TTL,
+                 identity_map=False,
+                 identity_map_size=DEFAULT_IDENTITY_MAP_SIZE,
+                 username_filter=False, friend_graph=False,
+                 timeline_friends=None, count_statements=False):
         '''
         '''
 
@@ -44,25 +1686,283 @@ class Engine(object):
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
+        self.busy_timeout = busy_timeout
+        self.statement_cache_size = statement_cache_size
+        if isinstance(profile, dict):
+            self.profile = dict(STORAGE_PROFILES[DEFAULT_STORAGE_PROFILE])
+            self.profile.update(profile)
+        else:
+            try:
+                self.profile = STORAGE_PROFILES[profile]
+            except KeyError:
+                raise ValueError('Unknown storage profile %s' % profile)
+        if count_statements:
+            self.statements = StatementCounter()
+            self.connection_factory = CountingConnection
+        else:
+            self.statements = None
+            self.connection_factory = sqlite3.Connection
+        self.group_commit = group_commit
+        self.commit_batch_size = commit_batch_size
+        self.commit_interval = commit_interval
+        self.compact_rows = compact_rows
+        if query_cache:
+            self.query_cache = QueryCache(query_cache_size, query_cache_ttl)
+        else:
+            self.query_cache = None
+        if identity_map:
+            self.identity_map = IdentityMap(identity_map_size)
+        else:
+            self.identity_map = None
+        if username_filter:
+            self.username_filter = UsernameFilter()
+        else:
+            self.username_filter = None
+        if friend_graph:
+            self.friend_graph = FriendGraph()
+        else:
+            self.friend_graph = None
+        self.timeline_friends = timeline_friends
+        self.writer = None
+        self._writer_lock = threading.Lock()
+        if pool_size:
+            self.pool = ConnectionPool(self.db_path, self.open_connection,
+                                       pool_size, pool_idle_timeout)
+            self.readonly_pool = ConnectionPool(
+                self.db_path, self.open_readonly_connection, pool_size,
+                pool_idle_timeout)
+        else:
+            self.pool = None
+            self.readonly_pool = None
+
+    def open_connection(self, db_path):
+        '''
+        Opens a new sqlite3 connection and calls :py:meth:`on_connect` on it.
+        The connection can be used from any thread because the pool hands it
+        to different request threads.
+
+        :param str db_path: The path of the database file.
+        :return: the configured sqlite3 connection
+        '''
+        con = sqlite3.connect(db_path, check_same_thread=False,
+                              cached_statements=self.statement_cache_size,
+                              factory=self.connection_factory)
+        if self.statements is not None:
+            con.counter = self.statements
+        self.on_connect(con)
+        return con
+
+    def open_readonly_connection(self, db_path):
+        '''
+        Opens a new read-only sqlite3 connection. The file is opened with
+        ``mode=ro`` and the connection has ``PRAGMA query_only`` enabled, so
+        it never takes a write lock. In WAL mode any number of these
+        connections can read while the writer is committing.
+
+        :param str db_path: The path of the database file.
+        :return: the configured sqlite3 connection
+        '''
+        uri = 'file:%s?mode=ro' % urllib.pathname2url(
+            os.path.abspath(db_path))
+        try:
+            con = sqlite3.connect(uri, check_same_thread=False,
+                                  cached_statements=self.statement_cache_size,
+                                  factory=self.connection_factory,
+                                  uri=True)
+        except TypeError:
+            #Old sqlite3 modules without the uri argument pass the filename
+            #directly to SQLite, which understands URI filenames by default
+            con = sqlite3.connect(uri, check_same_thread=False,
+                                  cached_statements=self.statement_cache_size,
+                                  factory=self.connection_factory)
+        if self.statements is not None:
+            con.counter = self.statements
+        self.on_connect(con, readonly=True)
+        con.execute('PRAGMA query_only = ON')
+        return con
+
+    def on_connect(self, con, readonly=False):
+        '''
+        Initialization hook executed once for every new sqlite3 connection.
+        It activates the foreign keys support, sets the busy timeout, applies
+        the storage profile and installs :py:class:`sqlite3.Row` (or
+        :py:func:`compact_row_factory`) as row factory, so the
+        :py:class:`Connection` methods do not have to do it before every
+        query. Subclasses can extend it to run more PRAGMA statements.
+
+        :param con: the new sqlite3 connection
+        :param bool readonly: True if the connection cannot write. The
+            journal mode is then left as the writers set it.
+        '''
+        profile = self.profile
+        cur = con.cursor()
+        cur.execute('PRAGMA foreign_keys = ON')
+        cur.execute('PRAGMA busy_timeout = %d' % int(self.busy_timeout))
+        #journal_mode is stored in the database file, the rest are per
+        #connection settings
+        if not readonly:
+            cur.execute('PRAGMA journal_mode = %s' % profile['journal_mode'])
+        cur.execute('PRAGMA synchronous = %s' % profile['synchronous'])
+        cur.execute('PRAGMA cache_size = %d' % int(profile['cache_size']))
+        cur.execute('PRAGMA mmap_size = %d' % int(profile['mmap_size']))
+        cur.execute('PRAGMA temp_store = %s' % profile['temp_store'])
+        cur.execute('PRAGMA wal_autocheckpoint = %d'
+                    % int(profile['wal_autocheckpoint']))
+        if self.compact_rows:
+            con.row_factory = compact_row_factory
+        else:
+            con.row_factory = sqlite3.Row
 
     def connect(self):
         '''
-        Creates a connection to the database.
+        Creates a connection to the database. If the Engine has a pool the
+        underlying sqlite3 connection is taken from it.
 
         :return: A Connection instance
         :rtype: Connection
 
         '''
-        return Connection(self.db_path)
+        return Connection(self.db_path, self.pool, self.open_connection,
+                          self.get_writer(), self.query_cache,
+                          self.identity_map, self.username_filter,
+                          self.friend_graph, self.timeline_friends)
+
+    def connect_readonly(self):
+        '''
+        Creates a read-only connection to the database. It must be used by
+        the operations that only read, like the GET requests of the API. The
+        mutating methods of the returned connection raise
+        :py:exc:`sqlite3.OperationalError`.
+
+        :return: A Connection instance
+        :rtype: Connection
+
+        '''
+        return Connection(self.db_path, self.readonly_pool,
+                          self.open_readonly_connection,
+                          cache=self.query_cache, identity=self.identity_map,
+                          username_filter=self.username_filter,
+                          graph=self.friend_graph)
+
+    def get_writer(self):
+        '''
+        Returns the writer thread of the Engine, starting it if needed.
+
+        :return: the :py:class:`GroupCommitWriter` or None if the Engine was
+            created without ``group_commit``.
+        '''
+        if not self.group_commit:
+            return None
+        with self._writer_lock:
+            if self.writer is None:
+                self.writer = GroupCommitWriter(self, self.commit_batch_size,
+                                                self.commit_interval)
+            return self.writer
+
+    def stop_writer(self):
+        '''
+        Commits the pending writes and stops the writer thread. It is
+        started again by the next :py:meth:`connect`.
+        '''
+        with self._writer_lock:
+            writer = self.writer
+            self.writer = None
+        if writer is not None:
+            writer.stop()
+
+    def statement_counts(self):
+        '''
+        :return: dictionary with the number of statements executed by the
+            connections of this Engine grouped by their first keyword. For
+            instance ``{'SELECT': 10, 'PRAGMA': 2}``. None if the Engine was
+            created without ``count_statements``.
+        '''
+        if self.statements is None:
+            return None
+        return self.statements.snapshot()
+
+    def pool_metrics(self, readonly=False):
+        '''
+        :param bool readonly: If True return the counters of the pool used
+            by :py:meth:`connect_readonly`.
+        :return: the counters of the connection pool as returned by
+            :py:meth:`ConnectionPool.metrics` or None if pooling is disabled.
+        '''
+        pool = self.readonly_pool if readonly else self.pool
+        if pool is None:
+            return None
+        return pool.metrics()
+
+    def cache_metrics(self):
+        '''
+        :return: the counters of the query cache as returned by
+            :py:meth:`QueryCache.metrics` or None if the cache is disabled.
+        '''
+        if self.query_cache is None:
+            return None
+        return self.query_cache.metrics()
+
+    def identity_metrics(self):
+        '''
+        :return: the counters of the identity map as returned by
+            :py:meth:`IdentityMap.metrics` or None if it is disabled.
+        '''
+        if self.identity_map is None:
+            return None
+        return self.identity_map.metrics()
+
+    def filter_metrics(self):
+        '''
+        :return: the counters and false positive rates of the username
+            filter as returned by :py:meth:`UsernameFilter.metrics` or None
+            if it is disabled.
+        '''
+        if self.username_filter is None:
+            return None
+        return self.username_filter.metrics()
+
+    def graph_metrics(self):
+        '''
+        :return: the counters of the friend graph as returned by
+            :py:meth:`graph.FriendGraph.metrics` or None if it is disabled.
+        '''
+        if self.friend_graph is None:
+            return None
+        return self.friend_graph.metrics()
+
+    def _clear_cache(self):
+        '''
+        Empties the query cache, the identity map, the username filter and
+        the friend graph after the database is modified without the
+        :py:class:`Connection` methods.
+        '''
+        if self.query_cache is not None:
+            self.query_cache.clear()
+        if self.identity_map is not None:
+            self.identity_map.clear()
+        if self.username_filter is not None:
+            self.username_filter.invalidate()
+        if self.friend_graph is not None:
+            self.friend_graph.invalidate()
 
     def remove_database(self):
         '''
-        Removes the database file from the filesystem.
+        Removes the database file from the filesystem, together with its WAL
+        files. The pooled connections to the removed file are closed and the
+        writer thread is stopped.
 
         '''
+        self.stop_writer()
+        self._clear_cache()
+        if self.pool is not None:
+            self.pool.dispose()
+            self.readonly_pool.dispose()
         if os.path.exists(self.db_path):
             #THIS REMOVES THE DATABASE STRUCTURE
             os.remove(self.db_path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
 
     def clear(self):
         '''
@@ -82,6 +1982,7 @@ class Engine(object):
             cur.execute("DELETE FROM users")
             #NOTE since we have ON DELETE CASCADE BOTH IN users_profile AND
             #friends, WE DO NOT HAVE TO WORRY TO CLEAR THOSE TABLES.
+        self._clear_cache()
 
     #METHODS TO CREATE AND POPULATE A DATABASE USING DIFFERENT SCRIPTS
     def create_tables(self, schema=None):
@@ -107,6 +2008,121 @@ class Engine(object):
         self.create_users_table()
         self.create_exercise_table()
         self.create_friends_table()   
+        self.migrate()
+
+    #SCHEMA MIGRATIONS
+    def schema_version(self):
+        '''
+        :return: the version of the schema of the database file, this is the
+            number of the last migration applied to it.
+        :rtype: int
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            return con.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            con.close()
+
+    def migrate(self, target=None):
+        '''
+        Applies to the database the :py:data:`MIGRATIONS` newer than its
+        schema version.
+
+        Each migration runs in its own ``BEGIN IMMEDIATE`` transaction that
+        also updates ``PRAGMA user_version``, so a failing migration leaves
+        the database in the previous version. The transaction only blocks
+        the writers, so it can be applied to a database that is in use.
+
+        :param int target: Last version to apply. If None all the
+            migrations are applied.
+        :return: list with the versions applied
+        '''
+        con = self.open_connection(self.db_path)
+        #Transactions are controlled explicitly: the sqlite3 module would
+        #commit before every CREATE statement
+        con.isolation_level = None
+        applied = []
+        try:
+            cur = con.cursor()
+            cur.execute('PRAGMA user_version')
+            current = cur.fetchone()[0]
+            for version, description, steps in MIGRATIONS:
+                if version <= current:
+                    continue
+                if target is not None and version > target:
+                    break
+                cur.execute('BEGIN IMMEDIATE')
+                try:
+                    #Read again inside the transaction, other process could
+                    #have migrated the database meanwhile
+                    cur.execute('PRAGMA user_version')
+                    if cur.fetchone()[0] >= version:
+                        cur.execute('ROLLBACK')
+                        continue
+                    for step in steps:
+                        if callable(step):
+                            step(cur)
+                        else:
+                            cur.execute(step)
+                    cur.execute('PRAGMA user_version = %d' % version)
+                    cur.execute('COMMIT')
+                except Exception:
+                    cur.execute('ROLLBACK')
+                    raise
+                applied.append(version)
+        finally:
+            con.close()
+            self._clear_cache()
+        return applied
+
+    def rebuild_rollups(self):
+        '''
+        Computes again the ``exercise_rollup`` table from the ``exercise``
+        table, in one transaction. The triggers keep the rollups current, so
+        this is only needed if :py:meth:`check_rollups` finds differences.
+
+        :return: the number of rollup rows
+        '''
+        con = self.open_connection(self.db_path)
+        con.isolation_level = None
+        try:
+            cur = con.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                cur.execute('DELETE FROM exercise_rollup')
+                cur.execute('INSERT INTO exercise_rollup(%s) %s' % (
+                    ', '.join(ROLLUP_COLUMNS), _rollup_query()))
+                rows = cur.rowcount
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+        finally:
+            con.close()
+            self._clear_cache()
+        return rows
+
+    def check_rollups(self):
+        '''
+        Compares the ``exercise_rollup`` table with the rollups computed from
+        the ``exercise`` table.
+
+        :return: list with the keys (user_id, period_kind, period, type,
+            valueunit, timeunit) of the rollup rows that are wrong, missing or
+            extra. It is empty if the table is consistent.
+        '''
+        stored = 'SELECT %s FROM exercise_rollup' % ', '.join(ROLLUP_COLUMNS)
+        computed = 'SELECT * FROM (%s)' % _rollup_query()
+        query = 'SELECT DISTINCT user_id, period_kind, period, type, \
+                 valueunit, timeunit FROM (%s EXCEPT %s UNION ALL \
+                 SELECT * FROM (%s EXCEPT %s)) ORDER BY 1, 2, 3, 4, 5, 6' % (
+                     stored, computed, computed, stored)
+        con = self.open_connection(self.db_path)
+        try:
+            return [tuple(row) for row in con.execute(query)]
+        finally:
+            con.close()
+
     def populate_tables(self, dump=None):
         '''
         Populate programmatically the tables from a dump file.
@@ -127,6 +2143,7 @@ class Engine(object):
             sql = f.read()
             cur = con.cursor()
             cur.executescript(sql)
+        self._clear_cache()
 
     #METHODS TO CREATE THE TABLES PROGRAMMATICALLY WITHOUT USING SQL SCRIPT
     def create_exercise_table(self):
@@ -244,20 +2261,64 @@ class Connection(object):
 
     :param db_path: Location of the database file.
     :type dbpath: str
+    :param pool: The pool the sqlite3 connection is taken from. If None a new
+        sqlite3 connection is opened.
+    :type pool: ConnectionPool
+    :param open_connection: Function used to open a new sqlite3 connection
+        when there is no pool. Normally :py:meth:`Engine.open_connection`.
+    :param writer: The writer thread that executes the mutating methods. If
+        None they are executed and committed in this connection.
+    :type writer: GroupCommitWriter
+    :param cache: The cache of the read methods, or None.
+    :type cache: QueryCache
+    :param identity: The map of usernames and user ids, or None.
+    :type identity: IdentityMap
+    :param username_filter: The Bloom filter of the usernames, or None.
+    :type username_filter: UsernameFilter
+    :param graph: The in-memory friend graph, or None.
+    :type graph: graph.FriendGraph
+    :param int timeline_friends: Number of friends from which
+        :py:meth:`add_friend` enables the timeline of the user, or None.
 
     '''
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool=None, open_connection=None, writer=None,
+                 cache=None, identity=None, username_filter=None,
+                 graph=None, timeline_friends=None):
         super(Connection, self).__init__()
-        self.con = sqlite3.connect(db_path)
+        self.pool = pool
+        self.writer = writer
+        self.cache = cache
+        self.identity = identity
+        self.username_filter = username_filter
+        self.graph = graph
+        self.timeline_friends = timeline_friends
+        #Changes of the shared structures done when the transaction commits
+        self._on_commit = []
+        if pool is not None:
+            self.con = pool.checkout()
+        elif open_connection is not None:
+            self.con = open_connection(db_path)
+        else:
+            self.con = sqlite3.connect(db_path)
+            self.con.execute('PRAGMA foreign_keys = ON')
+            self.con.row_factory = sqlite3.Row
 
     def close(self):
         '''
-        Closes the database connection, commiting all changes.
+        Closes the database connection, commiting all changes. A pooled
+        sqlite3 connection is given back to the pool instead of being closed.
 
         '''
         if self.con:
-            self.con.commit()
-            self.con.close()
+            con = self.con
+            self.con = None
+            try:
+                con.commit()
+            finally:
+                if self.pool is not None:
+                    self.pool.checkin(con)
+                else:
+                    con.close()
 
     #FOREIGN KEY STATUS
     def check_foreign_keys_status(self):
@@ -276,7 +2337,7 @@ class Connection(object):
             cur.execute('PRAGMA foreign_keys')
             #We know we retrieve just one record: use fetchone()
             data = cur.fetchone()
-            is_activated = data == (1,)
+            is_activated = tuple(data) == (1,)
             print "Foreign Keys status: %s" % 'ON' if is_activated else 'OFF'
         except sqlite3.Error, excp:
             print "Error %s:" % excp.args[0]
@@ -322,9 +2383,198 @@ class Connection(object):
             print "Error %s:" % excp.args[0]
             return False
 
+    #WRITES
+    def _write(self, name, *args):
+        '''
+        Runs the mutating operation ``name`` and commits it.
+
+        If the connection has a :py:class:`GroupCommitWriter` the operation
+        is sent to the writer thread, which commits it together with the
+        operations of other connections. Otherwise the private method
+        ``_<name>`` runs in this connection and the transaction is committed
+        immediately, or rolled back if it raises an exception.
+
+        After the commit :py:meth:`_after_write` updates the shared caches.
+
+        :param str name: Name of the public method, e.g. ``append_user``
+        :return: the value returned by the operation
+        '''
+        if self.writer is not None:
+            result = self.writer.submit(name, args)
+        else:
+            try:
+                result = getattr(self, '_' + name)(*args)
+                self.con.commit()
+            except Exception:
+                #Also if the commit fails: the registered calls must not run
+                #with a later write
+                self.con.rollback()
+                self._discard_on_commit()
+                raise
+            self._run_on_commit()
+        self._after_write(name, args, result)
+        return result
+
+    def _commit_on(self, function, *args):
+        '''
+        Registers a call to ``function(*args)`` that is executed when the
+        current transaction commits, and discarded if it is rolled back. The
+        write implementations use it to update the shared in-memory
+        structures only with committed data.
+        '''
+        self._on_commit.append((function, args))
+
+    def _commit_mark(self):
+        '''
+        :return: position in the registered calls, for
+            :py:meth:`_discard_on_commit`
+        '''
+        return len(self._on_commit)
+
+    def _discard_on_commit(self, mark=0):
+        '''
+        Discards the calls registered after ``mark``, because their
+        operation was rolled back.
+        '''
+        del self._on_commit[mark:]
+
+    def _run_on_commit(self):
+        '''
+        Executes the registered calls after a commit.
+        '''
+        calls, self._on_commit = self._on_commit, []
+        for function, args in calls:
+            function(*args)
+
+    def _after_write(self, name, args, result):
+        '''
+        Updates the shared caches after the operation ``name`` has been
+        committed: the versions of its :py:data:`WRITE_TABLES` are bumped in
+        the query cache, the created or deleted usernames are removed from
+        the identity map and the deleted users are counted by the username
+        filter.
+        '''
+        if self.cache is not None:
+            self.cache.bump(WRITE_TABLES[name])
+        identity = self.identity
+        if identity is not None:
+            if name in ('append_user', 'delete_user'):
+                identity.discard(args[0])
+            elif name == 'append_users_many':
+                for user in args[0]:
+                    identity.discard(user.get('username'))
+        username_filter = self.username_filter
+        if username_filter is not None:
+            if name == 'delete_user' and result:
+                username_filter.deleted()
+            #Only the committed users count for the capacity of the filter
+            elif name == 'append_user' and result:
+                username_filter.inserted(args[0])
+            elif name == 'append_users_many':
+                for username in result:
+                    username_filter.inserted(username)
+
+    def _unknown_username(self, username):
+        '''
+        Checks ``username`` with the username filter, building it first if
+        needed.
+
+        :return: True if the user certainly does not exist. False if it might
+            exist or the connection has no filter.
+        '''
+        username_filter = self.username_filter
+        if username_filter is None:
+            return False
+        if username_filter.needs_build():
+            username_filter.build(self.con)
+        return not username_filter.might_contain(username)
+
+    def _filter_false_positive(self):
+        '''
+        Reports to the username filter that a username it let through is not
+        in the database.
+        '''
+        if self.username_filter is not None:
+            self.username_filter.false_positive()
+
+    def _lookup_user_id(self, username):
+        '''
+        Returns the user id of ``username`` using the identity map when the
+        connection has one. Used by the read methods.
+
+        :return: the user id or None if the user does not exist
+        '''
+        identity = self.identity
+        if identity is not None:
+            found, user_id = identity.user_id(username)
+            if found:
+                return user_id
+            generation = identity.generation()
+        if self._unknown_username(username):
+            return None
+        query = 'SELECT user_id from users WHERE username = ?'
+        row = self._fetchone(query, (username,), ('users',))
+        user_id = row['user_id'] if row is not None else None
+        if user_id is None:
+            self._filter_false_positive()
+        if identity is not None:
+            identity.put(username, user_id, generation)
+        return user_id
+
+    def _write_user_id(self, cur, username):
+        '''
+        Returns the user id of ``username`` inside a write transaction. Only
+        the positive entries of the identity map are used: the transaction
+        can see users that the map or the query cache do not know yet.
+
+        :return: the user id or None if the user does not exist
+        '''
+        if self.identity is not None:
+            found, user_id = self.identity.user_id(username)
+            if user_id is not None:
+                return user_id
+        cur.execute('SELECT user_id from users WHERE username = ?',
+                    (username,))
+        row = cur.fetchone()
+        return row['user_id'] if row is not None else None
+
+    def _fetchall(self, query, pvalue, tables):
+        '''
+        Executes the SELECT statement ``query`` and returns all its rows. If
+        the connection has a :py:class:`QueryCache` the rows are taken from
+        it when possible.
+
+        :param tuple tables: tables read by the statement
+        :return: list of rows
+        '''
+        cache = self.cache
+        if cache is not None:
+            key = (query, tuple(pvalue))
+            rows = cache.get(key)
+            if rows is not None:
+                return list(rows)
+            versions = cache.versions(tables)
+        cur = self.con.cursor()
+        cur.execute(query, pvalue)
+        rows = cur.fetchall()
+        if cache is not None:
+            cache.put(key, tuple(rows), tables, versions)
+        return rows
+
+    def _fetchone(self, query, pvalue, tables):
+        '''
+        Same as :py:meth:`_fetchall` for statements returning at most one
+        row.
+
+        :return: the row or None
+        '''
+        rows = self._fetchall(query, pvalue, tables)
+        return rows[0] if rows else None
+
     #HELPERS
     #Here the helpers that transform database rows into dictionary. They work
-    #similarly to ORM
+    #similarly to ORM. Compact rows (see Engine compact_rows) are projected
+    #to compact rows with the keys of the dictionaries.
     #EVERYTHING below this is our own implementation
     #Helpers for exercises
     def _create_exercise_object(self, row):
@@ -345,6 +2595,8 @@ class Connection(object):
             * ``time``: Time the exercise took.(int)
             * ``timeunit``: Times unit. For example 'h'(string)
         '''
+        if isinstance(row, CompactRow):
+            return row.project(EXERCISE_FIELDS)
         return {'exercise_id': row['exercise_id'],
                     'user_id' : row['user_id'], 
                     'username': row['username'],
@@ -374,6 +2626,8 @@ class Connection(object):
             * ``time``: Time the exercise took.(int)
             * ``timeunit``: Times unit. For example 'h'(string)
         '''
+        if isinstance(row, CompactRow):
+            return row.project(EXERCISE_FIELDS)
         return {'exercise_id': row['exercise_id'],
                     'user_id' : row['user_id'], 
                     'username': row['username'],
@@ -405,6 +2659,8 @@ class Connection(object):
             * ``visibility``: Users visibility value (int)
 
         '''
+        if isinstance(row, CompactRow):
+            return row.project(USER_FIELDS)
 
         return {'username': row['username'],
                             'password':row['password'],
@@ -429,6 +2685,8 @@ class Connection(object):
             * ``description``: Users description (string)
             * ``visibility``: Users visibility value (int)
         '''
+        if isinstance(row, CompactRow):
+            return row.project(USER_FIELDS)
         return {'username': row['username'],
                             'password':row['password'],
                             'avatar': row['avatar'],
@@ -447,95 +2705,222 @@ class Connection(object):
         '''
         return {'friend_id': row['friend_id']}
 
+    def _iter_rows(self, query, pvalue, create_object, batch_size):
+        '''
+        Executes ``query`` and yields ``create_object(row)`` for every row,
+        fetching ``batch_size`` rows at a time. Only one batch of rows is in
+        memory at any moment.
+        '''
+        cur = self.con.cursor()
+        cur.execute(query, pvalue)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield create_object(row)
+
+    def _seek_page(self, query, where, pvalue, key, limit, cursor,
+                   create_object, tables):
+        '''
+        Returns one page of the rows of ``query`` ordered by the column
+        ``key`` using keyset pagination: the query seeks directly to the
+        rows after (or before) the key stored in the cursor, so the cost of
+        a page does not depend on how deep it is.
+
+        :param str query: SELECT statement without WHERE and ORDER BY. The
+            column ``key`` must be in the selected columns.
+        :param list where: conditions joined with AND to the seek condition
+        :param tuple pvalue: values of the conditions in ``where``
+        :param str key: unique integer column that orders the rows
+        :param int limit: maximum number of rows of the page
+        :param str cursor: cursor returned by a previous call or None for the
+            first page
+        :param create_object: function that transforms a row into a
+            dictionary
+        :param tuple tables: tables read by ``query``
+        :return: dictionary with the keys ``items`` (list of dictionaries),
+            ``next`` and ``prev`` (cursors of the next and previous pages or
+            None if there are no more rows in that direction)
+        :raises ValueError: if the cursor is malformed
+        '''
+        where = list(where)
+        pvalue = list(pvalue)
+        direction = 'next'
+        if cursor is not None:
+            direction, last = decode_cursor(cursor)
+            if isinstance(last, bool) or not isinstance(last, (int, long)):
+                raise ValueError('Malformed cursor %s' % cursor)
+            where.append('%s %s ?' % (key, '>' if direction == 'next' else '<'))
+            pvalue.append(last)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY %s %s LIMIT ?' % (
+            key, 'ASC' if direction == 'next' else 'DESC')
+        #One extra row tells if there is another page
+        pvalue.append(limit + 1)
+        rows = self._fetchall(query, pvalue, tables)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if direction == 'prev':
+            rows.reverse()
+        page = {'items': [create_object(row) for row in rows],
+                'next': None, 'prev': None}
+        if rows:
+            column = key.split('.')[-1]
+            if more or direction == 'prev':
+                page['next'] = encode_cursor('next', rows[-1][column])
+            if cursor is not None and (more or direction == 'next'):
+                page['prev'] = encode_cursor('prev', rows[0][column])
+        return page
+
+    def _user_projection(self, fields, create_object, table='users'):
+        '''
+        Helper for the methods accepting a ``fields`` argument.
+
+        :param fields: names of the user fields to read, a subset of
+            :py:data:`USER_FIELDS`, or None for all of them.
+        :param create_object: function used when ``fields`` is None
+        :param str table: name or alias of the users table in the query
+        :return: tuple (columns for the SELECT statement, function that
+            transforms a row into a dictionary with only those fields)
+        :raises ValueError: if a field is not in :py:data:`USER_FIELDS`
+        '''
+        if fields is None:
+            return table + '.*', create_object
+        fields = tuple(fields)
+        for field in fields:
+            if field not in USER_FIELDS:
+                raise ValueError('Unknown user field %s' % field)
+        #user_id is needed by the pagination
+        columns = ', '.join(['%s.user_id' % table] +
+                            ['%s.%s' % (table, field) for field in fields])
+        def create_projection(row):
+            if isinstance(row, CompactRow):
+                return row.project(fields)
+            return dict((field, row[field]) for field in fields)
+        return columns, create_projection
+
     #API ITSELF
    
 
     #USER
-    def get_users(self):
+    def get_users(self, fields=None):
         '''
         Extracts all users in the database.
 
+        :param fields: names of the fields to read, a subset of
+            :py:data:`USER_FIELDS`. Only those columns are read from the
+            database. If None all the fields are returned.
         :return: list of Users of the database. Each user is a dictionary
-            that contains same keys as user_list_object
+            that contains same keys as user_list_object, or the ``fields``
+        :raises ValueError: if a field is not in :py:data:`USER_FIELDS`
 
         '''
+        columns, create_object = self._user_projection(
+            fields, self._create_user_list_object)
         #Create the SQL Statements
-          #SQL Statement for retrieving the users
-        query = 'SELECT users.* FROM users'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute main SQL Statement
-        cur.execute(query)
-        #Process the results
-        rows = cur.fetchall()
+          #SQL Statement for retrieving the users
+        query = 'SELECT %s FROM users' % columns
+        #Execute main SQL Statement and process the results
+        rows = self._fetchall(query, (), ('users',))
         if rows is None:
             return None
         #Process the response.
         users = []
         for row in rows:
-            users.append(self._create_user_list_object(row))
+            users.append(create_object(row))
         return users
 
-    def get_user(self, username):
+    def iter_users(self, batch_size=DEFAULT_FETCH_SIZE, fields=None):
+        '''
+        Generator version of :py:meth:`get_users`. The users are read from
+        the database in batches of ``batch_size`` rows while the generator
+        is consumed, so the memory used does not depend on the number of
+        users. It can be passed directly to a streaming HTTP response. The
+        connection must stay open until the generator is exhausted.
+
+        :param int batch_size: Number of rows fetched at a time.
+        :param fields: names of the fields to read, see :py:meth:`get_users`
+        :return: generator of dictionaries with the same keys as
+            :py:meth:`_create_user_list_object`, or the ``fields``
+
+        '''
+        columns, create_object = self._user_projection(
+            fields, self._create_user_list_object)
+        query = 'SELECT %s FROM users' % columns
+        return self._iter_rows(query, (), create_object, batch_size)
+
+    def get_users_page(self, limit=DEFAULT_PAGE_SIZE, cursor=None,
+                       fields=None):
+        '''
+        Paginated version of :py:meth:`get_users`. The users are ordered by
+        user_id. See :py:meth:`_seek_page`.
+
+        :param int limit: Maximum number of users in the page.
+        :param str cursor: ``next`` or ``prev`` cursor of a previous page,
+            None for the first page.
+        :param fields: names of the fields to read, see :py:meth:`get_users`
+        :return: dictionary with the keys ``items``, ``next`` and ``prev``.
+            Items have the same keys as
+            :py:meth:`_create_user_list_object`, or the ``fields``
+        :raises ValueError: if the cursor or the fields are malformed
+
+        '''
+        columns, create_object = self._user_projection(
+            fields, self._create_user_list_object)
+        query = 'SELECT %s FROM users' % columns
+        return self._seek_page(query, [], (), 'users.user_id', limit,
+                               cursor, create_object, ('users',))
+
+    def get_user(self, username, fields=None):
         '''
         Extracts all the information of a user.
 
         :param str username: The nickname of the user to search for.
+        :param fields: names of the fields to read, see :py:meth:`get_users`
         :return: dictionary with the format provided in the method:
-            :py:meth:`_create_user_object`
+            :py:meth:`_create_user_object`, or with the ``fields``
+        :raises ValueError: if a field is not in :py:data:`USER_FIELDS`
 
         '''
+        columns, create_object = self._user_projection(
+            fields, self._create_user_object)
         #Create the SQL Statements
-          #SQL Statement for retrieving the user given a nickname
-        query1 = 'SELECT user_id from users WHERE username = ?'
-          #SQL Statement for retrieving the user information
-
-        query2 = 'SELECT users.* FROM users\
-                  WHERE users.user_id = ?'
-          #Variable to be used in the second query.
-        user_id = None
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute SQL Statement to retrieve the id given a nickname
+          #SQL Statement for retrieving the user information given a
+          #nickname. username is UNIQUE, so it uses its index.
+        query = 'SELECT %s FROM users\
+                 WHERE users.username = ?' % columns
+        #Unknown usernames are discarded by the username filter
+        if self._unknown_username(username):
+            return None
+        #Execute SQL Statement to retrieve the user given a nickname
         pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #Extract the user id
-        row = cur.fetchone()
+        #Process the response. Only one posible row is expected.
+        row = self._fetchone(query, pvalue, ('users',))
         if row is None:
+            self._filter_false_positive()
             return None
-        user_id = row["user_id"]
-        # Execute the SQL Statement to retrieve the user invformation.
-        # Create first the valuse
-        pvalue = (user_id, )
-        #execute the statement
-        cur.execute(query2, pvalue)
-        #Process the response. Only one posible row is expected.
-        row = cur.fetchone()
-        return self._create_user_object(row)
+        return create_object(row)
 
     def get_username(self,user_id):
         """
         """
+        if self.identity is not None:
+            username = self.identity.username(user_id)
+            if username is not None:
+                return username
+            generation = self.identity.generation()
         query1 = 'SELECT username from users WHERE user_id = ?'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
         #Execute SQL Statement to retrieve the id given a nickname
         pvalue = (user_id,)
-        cur.execute(query1, pvalue)
         #Extract the user id
-        row = cur.fetchone()
+        row = self._fetchone(query1, pvalue, ('users',))
         if row is None:
             return None
         username = row["username"]
+        if self.identity is not None:
+            self.identity.put(username, user_id, generation)
  
         return username
 
@@ -548,22 +2933,33 @@ class Connection(object):
 
         :return: True if the user is deleted, False otherwise.
 
+        '''
+        return self._write('delete_user', username)
+
+    def _delete_user(self, username):
+        '''
+        Implementation of :py:meth:`delete_user`. It runs in the current
+        transaction and does not commit.
         '''
         #Create the SQL Statements
           #SQL Statement for deleting the user information
         query = 'DELETE FROM users WHERE username = ?'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
+        #The friend graph removes the user by id
+        if self.graph is not None:
+            user_id = self._write_user_id(cur, username)
+        #The next operations of the transaction must not see the old id
+        if self.identity is not None:
+            self.identity.discard(username)
         #Execute the statement to delete
         pvalue = (username,)
         cur.execute(query, pvalue)
-        self.con.commit()
         #Check that it has been deleted
         if cur.rowcount < 1:
             return False
+        if self.graph is not None:
+            self._commit_on(self.graph.remove_user, user_id)
         return True
 
     def modify_user(self, username, user):
@@ -589,19 +2985,24 @@ class Connection(object):
 
         :return: the username of the modified user or None if the
             `username`` passed as parameter is not  in the database.
+        '''
+        return self._write('modify_user', username, user)
+
+    def _modify_user(self, username, user):
+        '''
+        Implementation of :py:meth:`modify_user`. It runs in the current
+        transaction and does not commit.
         '''
                 #Create the SQL Statements
-           #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE username = ?'
-          #SQL Statement to update the user_profile table
+          #SQL Statement to update the user given a nickname. No previous
+          #SELECT is needed: rowcount tells if the user exists.
         #START UPDATE statement
         query2_start = 'UPDATE users SET '
         query2_public = 'password = ?,avatar = ?, description = ?, visibility = ?'
-        query2_end = ' WHERE user_id = ?'
+        query2_end = ' WHERE username = ?'
           #SQL Statement to update the user_profile table
         query2 = query2_start
         #temporal variables
-        user_id = None
         pvalue_array = []
        # p_profile = user.get('public_profile', None)
        # r_profile = user.get('restricted_profile', None)
@@ -610,35 +3011,19 @@ class Connection(object):
         _avatar = user.get('avatar', None)
         _description = user.get('description', None)
         _visibility = user.get('visibility', None)        
-        query2 += query2_public
-        pvalue_array.extend([_password,_avatar,_description,_visibility])
+        query2 += query2_public + query2_end
+        pvalue_array.extend([_password,_avatar,_description,_visibility,
+                             username])
  
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #Only one value expected
-        row = cur.fetchone()
-        #if does not exist, return
-        if row is None:
+        #execute the main statement
+        pvalue = tuple(pvalue_array)
+        cur.execute(query2, pvalue)
+        #Check that I have modified the user. If it does not exist, return
+        if cur.rowcount < 1:
             return None
-        else:
-            user_id = row["user_id"]
-            #pvalue_array.append(user_id)
-            #execute the main statement
-            pvalue = tuple(pvalue_array)
-            print query2
-            print pvalue
-            cur.execute(query2, pvalue)
-            self.con.commit()
-            #Check that I have modified the user
-            if cur.rowcount < 1:
-                return None
-            return username
+        return username
 
     def append_user(self, username, user):
         '''
@@ -664,12 +3049,19 @@ class Connection(object):
             `username`` passed as parameter is not  in the database.
 
 
+        '''
+        return self._write('append_user', username, user)
+
+    def _append_user(self, username, user):
+        '''
+        Implementation of :py:meth:`append_user`. It runs in the current
+        transaction and does not commit.
         '''
         #Create the SQL Statements
-          #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE username = ?'
-          #SQL Statement to create the row in  users table
-        query2 = 'INSERT INTO users(username,password,avatar,description,visibility)\
+          #SQL Statement to create the row in  users table. username is
+          #UNIQUE: if it is taken the row is ignored and rowcount is 0, so
+          #no previous SELECT is needed.
+        query2 = 'INSERT OR IGNORE INTO users(username,password,avatar,description,visibility)\
                   VALUES(?,?,?,?,?)'
           #SQL Statement to create the row in user_profile table
 
@@ -682,29 +3074,78 @@ class Connection(object):
         _avatar = user.get('avatar', None)
         _description = user.get('description', None)
         _visibility = user.get('visibility', None)
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #The filter must know the user before it can be read
+        if self.username_filter is not None:
+            self.username_filter.add(username)
+        #Cursor initialization
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
-        row = cur.fetchone()
-        #If there is no user add rows in user and user profile
-        if row is None:
-            #Add the row in users table
-            # Execute the statement
-            pvalue = (username, _password, _avatar, _description, _visibility)
-            cur.execute(query2, pvalue)
-            #Extrat the rowid => user-id
-
-            self.con.commit()
-            #We do not do any comprobation and return the nickname
-            return username
-        else:
+        #Add the row in users table
+        # Execute the statement
+        pvalue = (username, _password, _avatar, _description, _visibility)
+        cur.execute(query2, pvalue)
+        #If there was already a user with that nickname nothing was added
+        if cur.rowcount < 1:
             return None
+        if self.graph is not None:
+            self._commit_on(self.graph.set_username, cur.lastrowid, username)
+        return username
+
+    def append_users_many(self, users):
+        '''
+        Create many users in one transaction.
+
+        All the usernames are checked with one query and the new users are
+        inserted with one ``executemany``.
+
+        :param list users: list of dictionaries with the same structure as
+            the ``user`` argument of :py:meth:`append_user`. The username is
+            read from the ``username`` key.
+        :return: a list with one element per user: the username if the user
+            was created or None if the username already exists, is repeated
+            in ``users`` or is missing.
+        '''
+        return self._write('append_users_many', users)
+
+    def _append_users_many(self, users):
+        '''
+        Implementation of :py:meth:`append_users_many`. It runs in the
+        current transaction and does not commit.
+        '''
+        #Create the SQL Statements
+          #SQL Statement for extracting the existing usernames
+        query1 = 'SELECT username FROM users WHERE username IN (%s)'
+          #SQL Statement to create the rows in users table
+        query2 = 'INSERT INTO users(username,password,avatar,description,visibility)\
+                  VALUES(?,?,?,?,?)'
+        usernames = list(set(user.get('username') for user in users
+                             if user.get('username') is not None))
+        #Cursor initialization
+        cur = self.con.cursor()
+        #Usernames already in the database
+        taken = set()
+        for chunk in _chunks(usernames):
+            cur.execute(query1 % ','.join('?' * len(chunk)), chunk)
+            taken.update(row['username'] for row in cur.fetchall())
+        results = []
+        pvalues = []
+        for user in users:
+            username = user.get('username')
+            if username is None or username in taken:
+                results.append(None)
+                continue
+            taken.add(username)
+            pvalues.append((username, user.get('password', None),
+                            user.get('avatar', None),
+                            user.get('description', None),
+                            user.get('visibility', None)))
+            results.append(username)
+        #The filter must know the users before they can be read
+        if self.username_filter is not None:
+            for pvalue in pvalues:
+                self.username_filter.add(pvalue[0])
+        if pvalues:
+            cur.executemany(query2, pvalues)
+        return results
 
 #exercise
 
@@ -731,15 +3172,21 @@ class Connection(object):
 
         :return exercise_id if succesfull. None otherwise    
         '''
+        return self._write('create_exercise', exercise)
+
+    def _create_exercise(self, exercise):
+        '''
+        Implementation of :py:meth:`create_exercise`. It runs in the current
+        transaction and does not commit.
+        '''
 
  #Create the SQL Statements
           #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE username = ?'
+          #(see _write_user_id)
           #SQL Statement to create the row in  users table
-        query2 = 'INSERT INTO exercise(user_id,username,type,value,valueunit,date,time,timeunit)\
-                  VALUES(?,?,?,?,?,?,?,?)'
+        query2 = 'INSERT INTO exercise(user_id,username,type,value,valueunit,date,time,timeunit,date_iso,value_si,time_si)\
+                  VALUES(?,?,?,?,?,?,?,?,?,?,?)'
 
-        _user_id = exercise.get('user_id', None)
         _username = exercise.get('username', None)
         _type = exercise.get('type', None)
         _value = exercise.get('value', None)
@@ -748,32 +3195,95 @@ class Connection(object):
         _time = exercise.get('time', None)
         _timeunit = exercise.get('timeunit', None)
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (_username,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
-        row = cur.fetchone()
+        #Extract the id associated to a nickname
+        _user_id = self._write_user_id(cur, _username)
         #If there is no user add rows in user and user profile
-        if row is not None:
+        if _user_id is not None:
             #Add the row in users table
             # Execute the statement
-            pvalue = (_user_id,_username,_type,_value,_valueunit,_date,_time,_timeunit)
+            pvalue = (_user_id,_username,_type,_value,_valueunit,_date,_time,_timeunit,iso_date(_date),
+                      units.value_si(_value, _valueunit), units.time_si(_time, _timeunit))
             cur.execute(query2, pvalue)
             #Extrat the rowid => user-id
             
             lid = cur.lastrowid
 
-            self.con.commit()
             #We do not do any comprobation and return the nickname
             return lid
         else:
             return None
 
+    def create_exercises_many(self, exercises):
+        '''
+        Create many exercises in one transaction.
+
+        The user ids of all the usernames are resolved with one query and
+        the exercises are inserted with one ``executemany``.
+
+        :param list exercises: list of dictionaries with the same structure
+            as the argument of :py:meth:`create_exercise`.
+        :return: a list with one element per exercise: the exercise_id of the
+            new exercise or None if its user does not exist.
+        '''
+        return self._write('create_exercises_many', exercises)
+
+    def _create_exercises_many(self, exercises):
+        '''
+        Implementation of :py:meth:`create_exercises_many`. It runs in the
+        current transaction and does not commit.
+        '''
+        #Create the SQL Statements
+          #SQL Statement for extracting the userids given the usernames
+        query1 = 'SELECT user_id, username FROM users WHERE username IN (%s)'
+          #SQL Statement to create the rows in exercise table
+        query2 = 'INSERT INTO exercise(user_id,username,type,value,valueunit,date,time,timeunit,date_iso,value_si,time_si)\
+                  VALUES(?,?,?,?,?,?,?,?,?,?,?)'
+          #SQL Statement to read the last exercise_id assigned
+        query3 = "SELECT seq FROM sqlite_sequence WHERE name = 'exercise'"
+        usernames = list(set(exercise.get('username') for exercise in exercises
+                             if exercise.get('username') is not None))
+        #Cursor initialization
+        cur = self.con.cursor()
+        user_ids = {}
+        for chunk in _chunks(usernames):
+            cur.execute(query1 % ','.join('?' * len(chunk)), chunk)
+            for row in cur.fetchall():
+                user_ids[row['username']] = row['user_id']
+        pvalues = []
+        for exercise in exercises:
+            _username = exercise.get('username', None)
+            if _username not in user_ids:
+                continue
+            pvalues.append((user_ids[_username], _username,
+                            exercise.get('type', None),
+                            exercise.get('value', None),
+                            exercise.get('valueunit', None),
+                            exercise.get('date', None),
+                            exercise.get('time', None),
+                            exercise.get('timeunit', None),
+                            iso_date(exercise.get('date', None)),
+                            units.value_si(exercise.get('value', None),
+                                           exercise.get('valueunit', None)),
+                            units.time_si(exercise.get('time', None),
+                                          exercise.get('timeunit', None))))
+        if not pvalues:
+            return [None] * len(exercises)
+        cur.executemany(query2, pvalues)
+        #The transaction holds the write lock, so the new rows got
+        #consecutive ids ending at the current value of the sequence
+        cur.execute(query3)
+        next_id = cur.fetchone()['seq'] - len(pvalues) + 1
+        results = []
+        for exercise in exercises:
+            if exercise.get('username', None) in user_ids:
+                results.append(next_id)
+                next_id += 1
+            else:
+                results.append(None)
+        return results
+
     def get_exercise(self, exercise_id):
         '''
         Get all information of an exercise
@@ -808,16 +3318,10 @@ class Connection(object):
          #         WHERE users.user_id = ?'
           #Variable to be used in the second query.
         user_id = None
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
         #Execute SQL Statement to retrieve the id given a nickname
         pvalue = (exercise_id,)
-        cur.execute(query1, pvalue)
         #Extract the user id
-        row = cur.fetchone()
+        row = self._fetchone(query1, pvalue, ('exercise',))
         if row is None:
             return None
  
@@ -850,15 +3354,8 @@ class Connection(object):
         #Create the SQL Statements
           #SQL Statement for retrieving the users
         query = 'SELECT exercise.* FROM exercise'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute main SQL Statement
-        cur.execute(query)
-        #Process the results
-        rows = cur.fetchall()
+        #Execute main SQL Statement and process the results
+        rows = self._fetchall(query, (), ('exercise',))
         if rows is None:
             return None
         #Process the response.
@@ -867,11 +3364,68 @@ class Connection(object):
             exercises.append(self._create_exercise_list_object(row))
         return exercises
 
-    def get_user_exercises(self,username):
+    def iter_exercises(self, batch_size=DEFAULT_FETCH_SIZE):
+        '''
+        Generator version of :py:meth:`get_exercises`. See
+        :py:meth:`iter_users`.
+
+        :param int batch_size: Number of rows fetched at a time.
+        :return: generator of dictionaries with the same keys as
+            :py:meth:`_create_exercise_list_object`
+
+        '''
+        query = 'SELECT exercise.* FROM exercise'
+        return self._iter_rows(query, (), self._create_exercise_list_object,
+                               batch_size)
+
+    def get_exercises_page(self, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        '''
+        Paginated version of :py:meth:`get_exercises`. The exercises are
+        ordered by exercise_id. See :py:meth:`get_users_page`.
+
+        '''
+        query = 'SELECT exercise.* FROM exercise'
+        return self._seek_page(query, [], (), 'exercise.exercise_id', limit,
+                               cursor, self._create_exercise_list_object,
+                               ('exercise',))
+
+    def _user_exercises_query(self, username, start, end):
+        '''
+        Builds the query used by :py:meth:`get_user_exercises` and
+        :py:meth:`iter_user_exercises`.
+
+        :return: tuple (query, pvalue)
+        :raises ValueError: if ``start`` or ``end`` are not valid dates
         '''
-        Get all of the users exercises
+        if start is None and end is None:
+            return ('SELECT exercise.* FROM exercise WHERE username= ?',
+                    (username,))
+        #Date range: seek on the (user_id, date_iso) index
+        query = 'SELECT exercise.* FROM exercise \
+                 WHERE user_id = (SELECT user_id FROM users WHERE username = ?) \
+                 AND username = ?'
+        pvalue = [username, username]
+        for value, condition in ((start, ' AND date_iso >= ?'),
+                                 (end, ' AND date_iso <= ?')):
+            if value is not None:
+                if iso_date(value) is None:
+                    raise ValueError('Wrong date %s' % value)
+                query += condition
+                pvalue.append(iso_date(value))
+        query += ' ORDER BY date_iso, exercise_id'
+        return query, tuple(pvalue)
+
+    def get_user_exercises(self, username, start=None, end=None):
+        '''
+        Get all of the users exercises. When ``start`` or ``end`` are given
+        the exercises are sorted by date.
 
         :param str username: Name of the user whose exercise are to be fetch
+        :param str start: If given only the exercises done on this date or
+            later are returned. ``dd.mm.yyyy`` or ``yyyy-mm-dd`` format.
+        :param str end: If given only the exercises done on this date or
+            before are returned.
+        :raises ValueError: if ``start`` or ``end`` are not valid dates
         :return list exercise:a list containing dictionaries with the exercise information. The
         dictionary has the following structure:
 
@@ -896,17 +3450,9 @@ class Connection(object):
         '''
         #Create the SQL Statements
           #SQL Statement for retrieving the users
-        query = 'SELECT exercise.* FROM exercise WHERE username= ?'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute main SQL Statement
-        pvalue=(username,)
-        cur.execute(query,pvalue)
-        #Process the results
-        rows = cur.fetchall()
+        query, pvalue = self._user_exercises_query(username, start, end)
+        #Execute main SQL Statement and process the results
+        rows = self._fetchall(query, pvalue, ('exercise',))
         if rows is None:
             return None
         #Process the response.
@@ -915,6 +3461,309 @@ class Connection(object):
             exercises.append(self._create_exercise_list_object(row))
         return exercises
 
+    def iter_user_exercises(self, username, batch_size=DEFAULT_FETCH_SIZE,
+                            start=None, end=None):
+        '''
+        Generator version of :py:meth:`get_user_exercises`. See
+        :py:meth:`iter_users`.
+
+        :param str username: Name of the user whose exercise are to be fetch
+        :param int batch_size: Number of rows fetched at a time.
+        :param str start: First date, see :py:meth:`get_user_exercises`
+        :param str end: Last date, see :py:meth:`get_user_exercises`
+        :return: generator of dictionaries with the same keys as
+            :py:meth:`_create_exercise_list_object`
+        :raises ValueError: if ``start`` or ``end`` are not valid dates
+
+        '''
+        query, pvalue = self._user_exercises_query(username, start, end)
+        return self._iter_rows(query, pvalue,
+                               self._create_exercise_list_object, batch_size)
+
+    def get_user_exercises_page(self, username, limit=DEFAULT_PAGE_SIZE,
+                                cursor=None):
+        '''
+        Paginated version of :py:meth:`get_user_exercises`. The exercises
+        are ordered by exercise_id. See :py:meth:`get_users_page`.
+
+        :param str username: Name of the user whose exercise are to be fetch
+
+        '''
+        query = 'SELECT exercise.* FROM exercise'
+        return self._seek_page(query, ['username = ?'], (username,),
+                               'exercise.exercise_id', limit, cursor,
+                               self._create_exercise_list_object,
+                               ('exercise',))
+
+    def get_exercise_stats(self, username, by_type=True, period=None,
+                           start=None, end=None):
+        '''
+        Aggregates the exercises of a user in the database with one
+        ``GROUP BY`` query. Weeks, months and all the dates together are
+        read from the ``exercise_rollup`` table when the date range covers
+        whole periods, so the cost does not depend on the length of the
+        history. Otherwise the exercises are read with the (user_id,
+        date_iso) index.
+
+        Values and times are added up only if they have the same unit, so
+        the groups are also split by ``valueunit`` and ``timeunit``. The
+        exercises without a valid date are not aggregated and missing values
+        and times count as 0.
+
+        :param str username: Name of the user whose exercises are aggregated
+        :param bool by_type: If True there is a group per exercise type.
+        :param str period: ``day``, ``week`` or ``month`` to have a group per
+            period, None to aggregate all the dates together.
+        :param str start: If given only the exercises done on this date or
+            later are aggregated. ``dd.mm.yyyy`` or ``yyyy-mm-dd`` format.
+        :param str end: If given only the exercises done on this date or
+            before are aggregated.
+        :raises ValueError: if ``period``, ``start`` or ``end`` are not valid
+        :return: None if the user does not exist. Otherwise a list with a
+            dictionary per group, ordered by period and type:
+
+            * ``type``: Type of the exercises or None if ``by_type`` is False
+            * ``period``: First date of the period (``yyyy-mm-dd``, or
+              ``yyyy-mm`` for months) or None if ``period`` is None
+            * ``valueunit`` and ``timeunit``: Units of the group (string)
+            * ``count``: Number of exercises (int)
+            * ``total_value``, ``average_value``, ``max_value``: Sum, mean and
+              maximum of ``value``
+            * ``total_time``, ``average_time``, ``max_time``: Sum, mean and
+              maximum of ``time``
+        '''
+        if period is not None and period not in STATS_PERIODS:
+            raise ValueError('Wrong period %s' % period)
+        dates = []
+        for value in (start, end):
+            if value is not None and iso_date(value) is None:
+                raise ValueError('Wrong date %s' % value)
+            dates.append(iso_date(value) if value is not None else None)
+        user_id = self._lookup_user_id(username)
+        if user_id is None:
+            return None
+        type_column = 'type' if by_type else 'NULL'
+        rollup = _rollup_range(period or 'month', *dates)
+        if rollup is not None:
+            #Add up the rollups of the periods
+            query = 'SELECT %s AS period, %s AS type, valueunit, timeunit, \
+                     SUM(count) AS count, SUM(total_value) AS total_value, \
+                     SUM(total_value) * 1.0 / SUM(count) AS average_value, \
+                     MAX(max_value) AS max_value, \
+                     SUM(total_time) AS total_time, \
+                     SUM(total_time) * 1.0 / SUM(count) AS average_time, \
+                     MAX(max_time) AS max_time FROM exercise_rollup \
+                     WHERE user_id = ? AND period_kind = ?' % (
+                         'period' if period else 'NULL', type_column)
+            pvalue = [user_id, period or 'month']
+            conditions = (' AND period >= ?', ' AND period <= ?')
+            dates = rollup
+        else:
+            period_column = (STATS_PERIODS[period].format('date_iso')
+                             if period else 'NULL')
+            query = 'SELECT %s AS period, %s AS type, valueunit, timeunit, \
+                     COUNT(*) AS count, \
+                     SUM(IFNULL(value, 0)) AS total_value, \
+                     TOTAL(value) / COUNT(*) AS average_value, \
+                     MAX(value) AS max_value, \
+                     SUM(IFNULL(time, 0)) AS total_time, \
+                     TOTAL(time) / COUNT(*) AS average_time, \
+                     MAX(time) AS max_time FROM exercise \
+                     WHERE user_id = ? AND date_iso IS NOT NULL' % (
+                         period_column, type_column)
+            pvalue = [user_id]
+            conditions = (' AND date_iso >= ?', ' AND date_iso <= ?')
+        for value, condition in zip(dates, conditions):
+            if value is not None:
+                query += condition
+                pvalue.append(value)
+        query += ' GROUP BY 1, 2, valueunit, timeunit \
+                   ORDER BY 1, 2, valueunit, timeunit'
+        rows = self._fetchall(query, tuple(pvalue), ('exercise',))
+        keys = ('type', 'period', 'valueunit', 'timeunit', 'count',
+                'total_value', 'average_value', 'max_value', 'total_time',
+                'average_time', 'max_time')
+        return [dict((key, row[key]) for key in keys) for row in rows]
+
+    def get_leaderboard(self, username, period='week', exercise_type=None,
+                        measure='distance', date=None,
+                        limit=DEFAULT_LEADERBOARD_SIZE):
+        '''
+        Ranks a user and its friends by the total distance or time of their
+        exercises in a week or a month.
+
+        The totals of all the members are computed with one ``GROUP BY``
+        query on the (user_id, date_iso) index and the best ``limit`` are
+        selected with a heap. If the connection has a :py:class:`QueryCache`
+        the leaderboard is cached per user and period until the users,
+        exercises or friends change.
+
+        :param str username: Name of the user
+        :param str period: ``week`` or ``month``
+        :param str exercise_type: If given only the exercises of this type
+            are added up.
+        :param str measure: ``distance`` (metres) or ``time`` (seconds), see
+            :py:data:`LEADERBOARD_MEASURES`. Exercises with an unknown unit
+            are not added up.
+        :param str date: A day of the period, ``dd.mm.yyyy`` or
+            ``yyyy-mm-dd``. Today if None.
+        :param int limit: Maximum number of users in the leaderboard
+        :raises ValueError: if ``period``, ``measure`` or ``date`` are not
+            valid
+        :return: None if the user does not exist. Otherwise a dictionary:
+
+            * ``period``: name of the period, see :py:data:`STATS_PERIODS`
+            * ``start`` and ``end``: first and last day of the period
+            * ``rank``: position of ``username`` in the whole ranking (int)
+            * ``items``: list of dictionaries with the keys ``rank``,
+              ``username``, ``total`` (float) and ``count`` (number of
+              exercises), the best first. Ties are ordered by username.
+        '''
+        if period not in ('week', 'month'):
+            raise ValueError('Wrong period %s' % period)
+        if measure not in LEADERBOARD_MEASURES:
+            raise ValueError('Wrong measure %s' % measure)
+        if date is None:
+            day = datetime.date.today()
+        else:
+            try:
+                day = datetime.datetime.strptime(iso_date(date) or '',
+                                                 '%Y-%m-%d').date()
+            except ValueError:
+                raise ValueError('Wrong date %s' % date)
+        name, first, last = _period_bounds(period, day)
+        user_id = self._lookup_user_id(username)
+        if user_id is None:
+            return None
+        tables = ('users', 'exercise', 'friends')
+        cache = self.cache
+        if cache is not None:
+            key = ('leaderboard', user_id, name, exercise_type, measure, limit)
+            leaderboard = cache.get(key)
+            if leaderboard is not None:
+                return dict(leaderboard, items=[dict(item) for item
+                                                in leaderboard['items']])
+            versions = cache.versions(tables)
+        column = LEADERBOARD_MEASURES[measure]
+        query = 'SELECT users.user_id, users.username, \
+                 TOTAL(exercise.{0}) AS total, COUNT(exercise.{0}) AS count \
+                 FROM users LEFT JOIN exercise \
+                 ON exercise.user_id = users.user_id \
+                 AND exercise.date_iso >= ? AND exercise.date_iso <= ?{1} \
+                 WHERE users.user_id IN \
+                 (SELECT ? UNION SELECT friend_id FROM friends WHERE user_id = ?) \
+                 GROUP BY users.user_id'.format(
+                     column, ' AND exercise.type = ?' if exercise_type else '')
+        pvalue = [first, last]
+        if exercise_type:
+            pvalue.append(exercise_type)
+        pvalue.extend([user_id, user_id])
+        cur = self.con.cursor()
+        cur.execute(query, pvalue)
+        members = [(-row['total'], row['username'], row['count'])
+                   for row in cur.fetchall()]
+        best = heapq.nsmallest(limit, members)
+        own = [member for member in members if member[1] == username][0]
+        leaderboard = {'period': name, 'start': first, 'end': last,
+                       'rank': sum(1 for member in members
+                                   if member < own) + 1,
+                       'items': [{'rank': rank, 'username': member,
+                                  'total': -total, 'count': count}
+                                 for rank, (total, member, count)
+                                 in enumerate(best, 1)]}
+        if cache is not None:
+            cache.put(key, dict(leaderboard, items=[
+                dict(item) for item in leaderboard['items']]), tables,
+                      versions)
+        return leaderboard
+
+    def get_feed(self, username, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        '''
+        Gets the most recent exercises of the friends of a user, the newest
+        first, one page at a time.
+
+        If the user has a timeline (see :py:meth:`set_timeline`) the page is
+        one range of the ``timeline`` primary key. Otherwise at most
+        ``limit + 1`` exercises of each friend are read with the (user_id,
+        date_iso) index, :py:data:`FEED_MERGE_CHUNK` friends per statement,
+        and they are merged with a heap. In both cases the cost of a page
+        does not depend on the length of the histories. The exercises
+        without a valid date are not in the feed.
+
+        :param str username: Name of the user
+        :param int limit: maximum number of exercises of the page
+        :param str cursor: ``next`` cursor returned by a previous call or
+            None for the first page
+        :raises ValueError: if the cursor is malformed
+        :return: None if the user does not exist. Otherwise a dictionary with
+            the keys ``items`` (list of exercises as returned by
+            :py:meth:`_create_exercise_list_object`, ordered by date and
+            exercise_id) and ``next`` (cursor of the next page or None).
+        '''
+        seek = ''
+        last = []
+        if cursor is not None:
+            direction, last = decode_cursor(cursor)
+            if (direction != 'next' or not isinstance(last, list) or
+                    len(last) != 2 or
+                    not isinstance(last[0], basestring) or
+                    not isinstance(last[1], (int, long))):
+                raise ValueError('Malformed cursor %s' % cursor)
+            #Rows before (date_iso, exercise_id) in the descending order.
+            #The first condition is the range of the index.
+            seek = ' AND {0}date_iso <= ? AND ({0}date_iso < ? \
+                    OR {0}exercise_id < ?)'
+            last = [last[0], last[0], last[1]]
+        user_id = self._lookup_user_id(username)
+        if user_id is None:
+            return None
+        tables = ('exercise', 'friends', 'timeline_users')
+        timeline = self._fetchone('SELECT user_id FROM timeline_users \
+                                   WHERE user_id = ?', (user_id,), tables)
+        if timeline is not None:
+            #CROSS JOIN keeps timeline as the outer table
+            query = 'SELECT exercise.* FROM timeline CROSS JOIN exercise \
+                     ON exercise.exercise_id = timeline.exercise_id \
+                     WHERE timeline.user_id = ?%s \
+                     ORDER BY timeline.date_iso DESC, \
+                     timeline.exercise_id DESC LIMIT ?' % seek.format(
+                         'timeline.')
+            rows = self._fetchall(query, [user_id] + last + [limit + 1],
+                                  tables)
+        else:
+            friends = self._fetchall('SELECT friend_id FROM friends \
+                                      WHERE user_id = ?', (user_id,), tables)
+            friend_ids = [row['friend_id'] for row in friends]
+            latest = 'SELECT * FROM (SELECT * FROM exercise \
+                      WHERE user_id = ? AND date_iso IS NOT NULL%s \
+                      ORDER BY date_iso DESC, exercise_id DESC LIMIT ?)' % (
+                          seek.format(''))
+            streams = {}
+            for start in xrange(0, len(friend_ids), FEED_MERGE_CHUNK):
+                chunk = friend_ids[start:start + FEED_MERGE_CHUNK]
+                pvalue = []
+                for friend_id in chunk:
+                    pvalue.extend([friend_id] + last + [limit + 1])
+                query = ' UNION ALL '.join([latest] * len(chunk))
+                for row in self._fetchall(query, pvalue, tables):
+                    #Python 2 heapq.merge has no key argument: the streams
+                    #are (key, row) tuples, the keys are unique
+                    key = (-int(row['date_iso'].replace('-', '')),
+                           -row['exercise_id'])
+                    streams.setdefault(row['user_id'], []).append((key, row))
+            for stream in streams.itervalues():
+                stream.sort()
+            rows = [row for _, row in itertools.islice(
+                heapq.merge(*streams.values()), limit + 1)]
+        more = len(rows) > limit
+        rows = rows[:limit]
+        page = {'items': [self._create_exercise_list_object(row)
+                          for row in rows], 'next': None}
+        if more:
+            page['next'] = encode_cursor('next', [rows[-1]['date_iso'],
+                                                  rows[-1]['exercise_id']])
+        return page
+
     def delete_exercise(self, exercise_id):
         '''
         Remove a specific exercise
@@ -923,19 +3772,22 @@ class Connection(object):
 
         :return: True if the exercise is deleted, False otherwise.
 
+        '''
+        return self._write('delete_exercise', exercise_id)
+
+    def _delete_exercise(self, exercise_id):
+        '''
+        Implementation of :py:meth:`delete_exercise`. It runs in the current
+        transaction and does not commit.
         '''
         #Create the SQL Statements
           #SQL Statement for deleting the user information
         query = 'DELETE FROM exercise WHERE exercise_id = ?'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to delete
         pvalue = (exercise_id,)
         cur.execute(query, pvalue)
-        self.con.commit()
         #Check that it has been deleted
         if cur.rowcount < 1:
             return False
@@ -969,6 +3821,13 @@ class Connection(object):
 
         :return: True if successful, None otherwise
 
+        '''
+        return self._write('modify_exercise', exercise_id, exercise)
+
+    def _modify_exercise(self, exercise_id, exercise):
+        '''
+        Implementation of :py:meth:`modify_exercise`. It runs in the current
+        transaction and does not commit.
         '''
                 #Create the SQL Statements
            #SQL Statement for extracting the userid given a nickname
@@ -977,7 +3836,7 @@ class Connection(object):
         #START UPDATE statement
         query1 = 'SELECT * from exercise WHERE exercise_id = ?'
         query2_start = 'UPDATE exercise SET '
-        query2_public = 'type = ?,value = ?, valueunit = ?, date = ?, time = ? , timeunit = ?'
+        query2_public = 'type = ?,value = ?, valueunit = ?, date = ?, time = ? , timeunit = ?, date_iso = ?, value_si = ?, time_si = ?'
         query2_end = ' WHERE exercise_id = ?'
           #SQL Statement to update the user_profile table
         query2 = query2_start
@@ -993,13 +3852,12 @@ class Connection(object):
         _date = exercise.get('date', None)
         _time = exercise.get('time', None)
         _timeunit = exercise.get('timeunit', None)
-        query2 += query2_public
-        pvalue_array.extend([_type,_value,_valueunit,_date,_time,_timeunit])
+        query2 += query2_public + query2_end
+        pvalue_array.extend([_type,_value,_valueunit,_date,_time,_timeunit,iso_date(_date),
+                             units.value_si(_value, _valueunit), units.time_si(_time, _timeunit),
+                             exercise_id])
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to extract the id associated to a nickname
         pvalue = (exercise_id,)
@@ -1017,7 +3875,6 @@ class Connection(object):
             print query2
             print pvalue
             cur.execute(query2, pvalue)
-            self.con.commit()
             #Check that I have modified the user
             if cur.rowcount < 1:
                 return None
@@ -1035,26 +3892,15 @@ class Connection(object):
         #Create the SQL Statements
         #SQL Statement for retrieving the users
         query = 'SELECT friends.* FROM friends WHERE user_id= ?'
-        query2= 'SELECT user_id FROM users WHERE username=?'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute main SQL Statement
-        pvalue=(username,)
-        cur.execute(query2,pvalue)
-        #Process the results
-        rows = cur.fetchone()
+        #Extract the id associated to the nickname
+        user_id = self._lookup_user_id(username)
 
-        if rows is None:
+        if user_id is None:
             return None
         #Process the response.
-        user_id=rows['user_id']
         pvalue=(user_id,)
-        cur.execute(query,pvalue)
         #Process the results
-        rows = cur.fetchall()
+        rows = self._fetchall(query, pvalue, ('friends',))
         if rows is None:
             return None
         
@@ -1063,8 +3909,309 @@ class Connection(object):
             friends.append(self._create_friends_list_object(row))
         
         return friends
+
+    def get_friend_users(self, username, fields=PUBLIC_USER_FIELDS):
+        '''
+        Get the friends of a user with their user information. Unlike
+        :py:meth:`get_friends` followed by :py:meth:`get_username` for every
+        friend, this runs one SELECT joining friends and users, so the result
+        is read in a single statement whatever the number of friends.
+
+        :param str username: username of the target user
+        :param fields: names of the fields of each friend, a subset of
+            :py:data:`USER_FIELDS`. By default the public fields.
+        :return: a list of dictionaries with the ``fields`` of each friend,
+            ordered by user id, or None if ``username`` is not in the
+            database
+        :raises ValueError: if a field is not in :py:data:`USER_FIELDS`
+        '''
+        columns, create_object = self._user_projection(
+            fields, self._create_user_list_object, 'friend')
+        #Create the SQL Statements
+          #SQL Statement for retrieving the friends. The LEFT JOINs return
+          #one row with NULL friend if the user exists but has no friends and
+          #no rows if the user does not exist.
+        query = 'SELECT friends.friend_id AS joined_friend_id, %s \
+                 FROM users \
+                 LEFT JOIN friends ON friends.user_id = users.user_id \
+                 LEFT JOIN users AS friend ON friend.user_id = friends.friend_id \
+                 WHERE users.username = ? \
+                 ORDER BY friends.friend_id' % columns
+        if self._unknown_username(username):
+            return None
+        #Execute main SQL Statement
+        pvalue = (username,)
+        rows = self._fetchall(query, pvalue, ('users', 'friends'))
+        if not rows:
+            self._filter_false_positive()
+            return None
+        friends = []
+        for row in rows:
+            if row['joined_friend_id'] is not None:
+                friends.append(create_object(row))
+        return friends
         
 
+    def _friend_graph(self):
+        '''
+        Returns the friend graph of the connection, loading it first if
+        needed, or None if the connection has no graph.
+        '''
+        graph = self.graph
+        if graph is None:
+            return None
+        if not graph.loaded:
+            cur = self.con.cursor()
+            def read_edges():
+                return cur.execute('SELECT user_id, friend_id FROM friends')
+            def read_users():
+                return cur.execute('SELECT user_id, username FROM users')
+            graph.load(read_edges, read_users)
+            if not graph.loaded:
+                #Another thread is loading it
+                return None
+        return graph
+
+    def _graph_user_id(self, graph, username):
+        '''
+        Returns the user id of ``username``, from the graph when possible.
+        '''
+        user_id = graph.user_id(username)
+        if user_id is None:
+            #Users created with append_users_many are not in the graph
+            user_id = self._lookup_user_id(username)
+        return user_id
+
+    def _graph_usernames(self, graph, user_ids):
+        '''
+        Returns the usernames of ``user_ids``, from the graph when possible.
+        '''
+        usernames = []
+        for user_id in user_ids:
+            username = graph.username(user_id)
+            if username is None:
+                username = self.get_username(user_id)
+            usernames.append(username)
+        return usernames
+
+    def get_mutual_friends(self, username, other):
+        '''
+        Get the users that are friends of both users.
+
+        With the friend graph of the Engine the answer is computed in memory
+        by intersecting the sorted friend lists. Otherwise one SELECT joins
+        the friends of both users.
+
+        :param str username: username of the first user
+        :param str other: username of the second user
+        :return: a list of usernames ordered by user id, or None if one of
+            the users is not in the database
+        '''
+        graph = self._friend_graph()
+        if graph is not None:
+            user_id = self._graph_user_id(graph, username)
+            other_id = self._graph_user_id(graph, other)
+            if user_id is None or other_id is None:
+                return None
+            return self._graph_usernames(
+                graph, graph.mutual_friends(user_id, other_id))
+        user_id = self._lookup_user_id(username)
+        other_id = self._lookup_user_id(other)
+        if user_id is None or other_id is None:
+            return None
+        query = 'SELECT users.username FROM friends AS mine \
+                 JOIN friends AS theirs ON theirs.friend_id = mine.friend_id \
+                 JOIN users ON users.user_id = mine.friend_id \
+                 WHERE mine.user_id = ? AND theirs.user_id = ? \
+                 ORDER BY mine.friend_id'
+        rows = self._fetchall(query, (user_id, other_id), ('friends', 'users'))
+        return [row['username'] for row in rows]
+
+    def get_followers(self, username):
+        '''
+        Get the users that have ``username`` as a friend.
+
+        :param str username: username of the target user
+        :return: a list of usernames ordered by user id, or None if the user
+            is not in the database
+        '''
+        graph = self._friend_graph()
+        if graph is not None:
+            user_id = self._graph_user_id(graph, username)
+            if user_id is None:
+                return None
+            return self._graph_usernames(graph, graph.followers(user_id))
+        user_id = self._lookup_user_id(username)
+        if user_id is None:
+            return None
+        query = 'SELECT users.username FROM friends \
+                 JOIN users ON users.user_id = friends.user_id \
+                 WHERE friends.friend_id = ? ORDER BY friends.user_id'
+        rows = self._fetchall(query, (user_id,), ('friends', 'users'))
+        return [row['username'] for row in rows]
+
+    def get_friend_suggestions(self, username, limit=DEFAULT_SUGGESTIONS):
+        '''
+        Suggests new friends for a user: the friends of its friends that are
+        not yet its friends, ranked by the number of its friends that have
+        them as a friend.
+
+        :param str username: username of the target user
+        :param int limit: maximum number of suggestions
+        :return: a list of dictionaries with the keys ``username`` and
+            ``common`` (number of common friends), the best suggestion
+            first, or None if the user is not in the database
+        '''
+        graph = self._friend_graph()
+        if graph is not None:
+            user_id = self._graph_user_id(graph, username)
+            if user_id is None:
+                return None
+            ranked = graph.suggestions(user_id, limit)
+            usernames = self._graph_usernames(
+                graph, [candidate for candidate, _ in ranked])
+            return [{'username': name, 'common': common}
+                    for name, (_, common) in zip(usernames, ranked)]
+        user_id = self._lookup_user_id(username)
+        if user_id is None:
+            return None
+        query = 'SELECT users.username, COUNT(*) AS common \
+                 FROM friends AS mine \
+                 JOIN friends AS theirs ON theirs.user_id = mine.friend_id \
+                 JOIN users ON users.user_id = theirs.friend_id \
+                 WHERE mine.user_id = ? AND theirs.friend_id != ? \
+                 AND theirs.friend_id NOT IN \
+                     (SELECT friend_id FROM friends WHERE user_id = ?) \
+                 GROUP BY theirs.friend_id \
+                 ORDER BY common DESC, theirs.friend_id LIMIT ?'
+        rows = self._fetchall(query, (user_id, user_id, user_id, limit),
+                              ('friends', 'users'))
+        return [{'username': row['username'], 'common': row['common']}
+                for row in rows]
+
+    def get_friend_path(self, username, other, max_depth=DEFAULT_PATH_DEPTH,
+                        max_visited=DEFAULT_PATH_VISITED):
+        '''
+        Finds the shortest chain of friends from ``username`` to ``other``,
+        following the friendships in their direction (user -> friend).
+
+        It is a bidirectional breadth first search run on the database: each
+        step expands a whole level of the smaller frontier with one
+        ``IN (...)`` query (split only if the frontier has more than
+        :py:data:`MAX_IN_VARIABLES` users), forwards through the friends of
+        the source side or backwards through the followers of the target
+        side, until both sides meet.
+
+        :param str username: username of the first user of the chain
+        :param str other: username of the last user of the chain
+        :param int max_depth: maximum length of the chain (friendships)
+        :param int max_visited: maximum number of users visited. It bounds
+            the cost when the search reaches users with many friends: the
+            queries of a level read at most the rows left in the budget.
+            If it runs out in the middle of a level, the chain found, if
+            any, may not be the shortest.
+        :return: None if one of the users is not in the database. Otherwise
+            a dictionary with the keys:
+
+            * ``path``: list of usernames from ``username`` to ``other``, or
+              None if no chain was found
+            * ``visited``: number of users visited (int)
+            * ``complete``: False if the search stopped because of
+              ``max_depth`` or ``max_visited`` (bool)
+        '''
+        source = self._lookup_user_id(username)
+        target = self._lookup_user_id(other)
+        if source is None or target is None:
+            return None
+        forward_query = 'SELECT user_id, friend_id FROM friends \
+                         WHERE user_id IN (%s) ORDER BY user_id, friend_id \
+                         LIMIT ?'
+        backward_query = 'SELECT user_id, friend_id FROM friends \
+                          WHERE friend_id IN (%s) ORDER BY friend_id, user_id \
+                          LIMIT ?'
+        #user => (previous user in the chain, distance to the side origin)
+        forward = {source: (None, 0)}
+        backward = {target: (None, 0)}
+        forward_frontier = [source]
+        backward_frontier = [target]
+        depth = 0
+        meeting = None if source != target else source
+        complete = True
+        cur = self.con.cursor()
+        while meeting is None and forward_frontier and backward_frontier:
+            if (depth >= max_depth or
+                    len(forward) + len(backward) > max_visited):
+                complete = False
+                break
+            depth += 1
+            #Expand the smaller frontier
+            if len(forward_frontier) <= len(backward_frontier):
+                query, frontier = forward_query, forward_frontier
+                visited, others = forward, backward
+                edge = lambda row: (row['user_id'], row['friend_id'])
+            else:
+                query, frontier = backward_query, backward_frontier
+                visited, others = backward, forward
+                edge = lambda row: (row['friend_id'], row['user_id'])
+            next_frontier = []
+            best = None
+            for chunk in _chunks(frontier):
+                #Every row visits one user at most. One extra row tells if
+                #the level was cut off.
+                budget = max_visited - len(forward) - len(backward)
+                if budget <= 0:
+                    complete = False
+                    break
+                cur.execute(query % ','.join('?' * len(chunk)),
+                            list(chunk) + [budget + 1])
+                rows = cur.fetchall()
+                if len(rows) > budget:
+                    complete = False
+                    rows = rows[:budget]
+                for row in rows:
+                    previous, node = edge(row)
+                    if node in visited:
+                        continue
+                    distance = visited[previous][1] + 1
+                    visited[node] = (previous, distance)
+                    next_frontier.append(node)
+                    if node in others:
+                        length = distance + others[node][1]
+                        if best is None or length < best:
+                            best, meeting = length, node
+            if frontier is forward_frontier:
+                forward_frontier = next_frontier
+            else:
+                backward_frontier = next_frontier
+            if not complete:
+                break
+        result = {'path': None, 'visited': len(forward) + len(backward),
+                  'complete': complete}
+        if meeting is None:
+            return result
+        #Chain of ids: source ... meeting ... target
+        ids = []
+        node = meeting
+        while node is not None:
+            ids.append(node)
+            node = forward[node][0]
+        ids.reverse()
+        node = backward[meeting][0]
+        while node is not None:
+            ids.append(node)
+            node = backward[node][0]
+        #Usernames of the chain with one query
+        names = {}
+        unique = list(set(ids))
+        for chunk in _chunks(unique):
+            cur.execute('SELECT user_id, username FROM users \
+                         WHERE user_id IN (%s)' % ','.join('?' * len(chunk)),
+                        chunk)
+            for row in cur.fetchall():
+                names[row['user_id']] = row['username']
+        result['path'] = [names[user_id] for user_id in ids]
+        return result
+
     def add_friend(self, username, friendname):
         '''
         Add a new friend to the user
@@ -1074,39 +4221,41 @@ class Connection(object):
 
         :return True if succesful, None otherwise
         '''
+        return self._write('add_friend', username, friendname)
+
+    def _add_friend(self, username, friendname):
+        '''
+        Implementation of :py:meth:`add_friend`. It runs in the current
+        transaction and does not commit.
+        '''
         #Create the SQL Statements
           #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE username = ?'
+          #(see _write_user_id)
           #SQL Statement to create the row in  users table
         query2 = 'INSERT INTO friends(user_id,friend_id)\
                   VALUES(?,?)'
           #SQL Statement to create the row in user_profile table
 
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
-        user = cur.fetchone()
-        user_id=user['user_id']
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (friendname,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
-        friend = cur.fetchone()
-        friend_id=friend['user_id']
+        #Extract the ids associated to the nicknames
+        user_id = self._write_user_id(cur, username)
+        friend_id = self._write_user_id(cur, friendname)
         #If there is no user add rows in user and user profile
         
         if user_id is None or friend_id is None:
             return None
         pvalue = (user_id, friend_id)
         cur.execute(query2, pvalue)
-        self.con.commit()
+        if self.timeline_friends is not None:
+            #The timeline_users_insert trigger fills the timeline
+            cur.execute('INSERT OR IGNORE INTO timeline_users(user_id) \
+                         SELECT ? WHERE (SELECT COUNT(*) FROM friends \
+                         WHERE user_id = ?) >= ?',
+                        (user_id, user_id, self.timeline_friends))
+        if self.graph is not None:
+            self._commit_on(self.graph.add_edge, user_id, friend_id)
             #We do not do any comprobation and return the nickname
         return True
 
@@ -1121,46 +4270,73 @@ class Connection(object):
 
         :return: True if the user is deleted, False otherwise.
 
+        '''
+        return self._write('delete_friend', username, friendname)
+
+    def _delete_friend(self, username, friendname):
+        '''
+        Implementation of :py:meth:`delete_friend`. It runs in the current
+        transaction and does not commit.
         '''
         #Create the SQL Statements
           #SQL Statement for deleting the user information
         query2 = 'DELETE FROM friends WHERE user_id = ? AND friend_id =?'
        #Create the SQL Statements
           #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE username = ?'
+          #(see _write_user_id)
           #SQL Statement to create the row in  users table
 
           #SQL Statement to create the row in user_profile table
 
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
-        user = cur.fetchone()
-        user_id=user['user_id']
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (friendname,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
-        friend = cur.fetchone()
-        friend_id=friend['user_id']
+        #Extract the ids associated to the nicknames
+        user_id = self._write_user_id(cur, username)
+        friend_id = self._write_user_id(cur, friendname)
         #If there is no user add rows in user and user profile
         
         if user_id is None or friend_id is None:
             return None
         pvalue = (user_id, friend_id)
         cur.execute(query2, pvalue)
-        self.con.commit()
 
                 #Check that it has been deleted
         if cur.rowcount < 1:
             return False
+        if self.graph is not None:
+            self._commit_on(self.graph.remove_edge, user_id, friend_id)
+        return True
+
+    def set_timeline(self, username, enabled=True):
+        '''
+        Enables or disables the timeline of a user. The feed of a user with
+        a timeline is read from the ``timeline`` table, which the triggers
+        fill when its friends create exercises (fan-out on write). It is
+        worth it for users with many friends. See :py:meth:`get_feed`.
+
+        :param str username: Name of the user
+        :param bool enabled: True to enable the timeline, False to disable
+            it and delete its rows.
+        :return: True if successful, None if the user does not exist
+        '''
+        return self._write('set_timeline', username, enabled)
+
+    def _set_timeline(self, username, enabled=True):
+        '''
+        Implementation of :py:meth:`set_timeline`. It runs in the current
+        transaction and does not commit.
+        '''
+        cur = self.con.cursor()
+        user_id = self._write_user_id(cur, username)
+        if user_id is None:
+            return None
+        #The timeline_users triggers fill or empty the timeline
+        if enabled:
+            query = 'INSERT OR IGNORE INTO timeline_users(user_id) VALUES(?)'
+        else:
+            query = 'DELETE FROM timeline_users WHERE user_id = ?'
+        cur.execute(query, (user_id,))
         return True
 
 
@@ -1191,21 +4367,8 @@ class Connection(object):
                 * test_get_user_id
                 * test_get_user_id_unknown_user
         '''
-        query = 'SELECT user_id from users WHERE username = ?'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute the  main statement
-        pvalue = (username,)
-        cur.execute(query, pvalue)
-        #Extract the results. Just one row expected.
-        row = cur.fetchone()
-        if row is None:
-            return None
-        else:
-            return row["user_id"]
+        #The identity map saves the query for known usernames
+        return self._lookup_user_id(username)
 
     def contains_user(self, username):
         '''
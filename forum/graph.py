@@ -0,0 +1,353 @@
+'''
+Created on 18.10.2026
+
+In-memory friend graph used by the database API to answer the friend
+queries (mutual friends, suggestions, followers) without querying the
+database.
+
+@authors: Toni Narhi & Ville Kemppainen
+'''
+
+import threading, heapq
+from array import array
+from bisect import bisect_left
+
+#Number of edge changes kept outside the CSR arrays before they are rebuilt
+DEFAULT_COMPACT_THRESHOLD = 1024
+
+
+class Adjacency(object):
+    '''
+    Adjacency lists of a directed graph in compressed sparse row (CSR)
+    format: the sorted neighbours of node ``n`` are
+    ``targets[offsets[n]:offsets[n + 1]]``. Nodes are non negative integers.
+
+    The arrays are immutable. Added and removed edges are kept in small
+    per-node sets (the delta) until :py:class:`FriendGraph` rebuilds the
+    arrays.
+
+    :param edges: iterable of tuples (source, target)
+    '''
+    def __init__(self, edges=()):
+        super(Adjacency, self).__init__()
+        edges = sorted(set(edges))
+        nodes = edges[-1][0] + 1 if edges else 0
+        self.offsets = array('l', [0]) * (nodes + 1)
+        self.targets = array('l', [target for _, target in edges])
+        for source, _ in edges:
+            self.offsets[source + 1] += 1
+        for node in range(nodes):
+            self.offsets[node + 1] += self.offsets[node]
+        self._added = {}
+        self._removed = {}
+        self.delta = 0
+
+    def _base(self, node):
+        '''
+        Sorted neighbours of ``node`` in the CSR arrays.
+        '''
+        if node + 1 >= len(self.offsets):
+            return self.targets[0:0]
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def _in_base(self, source, target):
+        base = self._base(source)
+        index = bisect_left(base, target)
+        return index < len(base) and base[index] == target
+
+    def neighbours(self, node):
+        '''
+        :return: sorted sequence with the neighbours of ``node``
+        '''
+        base = self._base(node)
+        added = self._added.get(node)
+        removed = self._removed.get(node)
+        if not added and not removed:
+            return base
+        neighbours = set(base)
+        if removed:
+            neighbours -= removed
+        if added:
+            neighbours |= added
+        return sorted(neighbours)
+
+    def has_edge(self, source, target):
+        if target in self._added.get(source, ()):
+            return True
+        if target in self._removed.get(source, ()):
+            return False
+        return self._in_base(source, target)
+
+    def add(self, source, target):
+        '''
+        Adds the edge ``source`` -> ``target`` to the delta.
+        '''
+        removed = self._removed.get(source)
+        if removed and target in removed:
+            removed.discard(target)
+            self.delta -= 1
+        elif not self._in_base(source, target):
+            added = self._added.setdefault(source, set())
+            if target not in added:
+                added.add(target)
+                self.delta += 1
+
+    def remove(self, source, target):
+        '''
+        Removes the edge ``source`` -> ``target`` using the delta.
+        '''
+        added = self._added.get(source)
+        if added and target in added:
+            added.discard(target)
+            self.delta -= 1
+        elif self._in_base(source, target):
+            removed = self._removed.setdefault(source, set())
+            if target not in removed:
+                removed.add(target)
+                self.delta += 1
+
+    def edges(self):
+        '''
+        Generator of all the edges (source, target), including the delta.
+        '''
+        nodes = set(range(len(self.offsets) - 1))
+        nodes.update(self._added)
+        for source in nodes:
+            for target in self.neighbours(source):
+                yield source, target
+
+    def edge_count(self):
+        count = len(self.targets)
+        for added in self._added.itervalues():
+            count += len(added)
+        for removed in self._removed.itervalues():
+            count -= len(removed)
+        return count
+
+
+def intersect(first, second):
+    '''
+    :return: list with the values present in both sorted sequences
+    '''
+    result = []
+    i = j = 0
+    while i < len(first) and j < len(second):
+        if first[i] == second[j]:
+            result.append(first[i])
+            i += 1
+            j += 1
+        elif first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class FriendGraph(object):
+    '''
+    Thread safe in-memory copy of the ``friends`` table. A row (user_id,
+    friend_id) is the edge user_id -> friend_id. The out edges (friends) and
+    the in edges (followers) are stored in two :py:class:`Adjacency` objects,
+    together with the usernames of the users.
+
+    The graph is empty until :py:meth:`load` reads the table. The changes
+    made while it is loading are replayed after the load, so none is lost.
+
+    :param int compact_threshold: Number of edge changes after which the
+        CSR arrays are rebuilt.
+    '''
+    def __init__(self, compact_threshold=DEFAULT_COMPACT_THRESHOLD):
+        super(FriendGraph, self).__init__()
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self.loaded = False
+        #Changes received during a load, None if there is no load running
+        self._pending = None
+        self._out = Adjacency()
+        self._in = Adjacency()
+        self._usernames = {}
+        self._user_ids = {}
+        self._metrics = {'loads': 0, 'compactions': 0}
+
+    def load(self, read_edges, read_users):
+        '''
+        Loads the graph. Returns at once if another thread is loading it.
+
+        :param read_edges: function returning the (user_id, friend_id) rows
+            of the ``friends`` table
+        :param read_users: function returning the (user_id, username) rows of
+            the ``users`` table
+        '''
+        with self._lock:
+            if self._pending is not None:
+                return
+            self._pending = []
+        try:
+            edges = [tuple(row) for row in read_edges()]
+            users = [tuple(row) for row in read_users()]
+            out_edges = Adjacency(edges)
+            in_edges = Adjacency((target, source) for source, target in edges)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            self._out, self._in = out_edges, in_edges
+            self._usernames = dict(users)
+            self._user_ids = dict((username, user_id)
+                                  for user_id, username in users)
+            self.loaded = True
+            pending, self._pending = self._pending, None
+            for method, args in pending:
+                method(*args)
+            self._metrics['loads'] += 1
+
+    def invalidate(self):
+        '''
+        Discards the graph, it must be loaded again.
+        '''
+        with self._lock:
+            self.loaded = False
+            self._out = Adjacency()
+            self._in = Adjacency()
+            self._usernames = {}
+            self._user_ids = {}
+
+    def _change(self, method, args):
+        '''
+        Applies a change, or queues it if the graph is loading. Must be
+        called holding the lock.
+        '''
+        if self._pending is not None:
+            self._pending.append((method, args))
+        if self.loaded:
+            method(*args)
+            if self._out.delta + self._in.delta > self.compact_threshold:
+                self._compact()
+
+    def _compact(self):
+        '''
+        Rebuilds the CSR arrays with the delta. Must be called holding the
+        lock.
+        '''
+        self._out = Adjacency(self._out.edges())
+        self._in = Adjacency(self._in.edges())
+        self._metrics['compactions'] += 1
+
+    def _add_edge(self, user_id, friend_id):
+        self._out.add(user_id, friend_id)
+        self._in.add(friend_id, user_id)
+
+    def _remove_edge(self, user_id, friend_id):
+        self._out.remove(user_id, friend_id)
+        self._in.remove(friend_id, user_id)
+
+    def _remove_user(self, user_id):
+        for friend_id in list(self._out.neighbours(user_id)):
+            self._remove_edge(user_id, friend_id)
+        for follower_id in list(self._in.neighbours(user_id)):
+            self._remove_edge(follower_id, user_id)
+        username = self._usernames.pop(user_id, None)
+        self._user_ids.pop(username, None)
+
+    def _set_username(self, user_id, username):
+        self._usernames[user_id] = username
+        self._user_ids[username] = user_id
+
+    def add_edge(self, user_id, friend_id):
+        '''
+        Adds the friendship user_id -> friend_id.
+        '''
+        with self._lock:
+            self._change(self._add_edge, (user_id, friend_id))
+
+    def remove_edge(self, user_id, friend_id):
+        '''
+        Removes the friendship user_id -> friend_id.
+        '''
+        with self._lock:
+            self._change(self._remove_edge, (user_id, friend_id))
+
+    def remove_user(self, user_id):
+        '''
+        Removes a user and all its friendships in both directions.
+        '''
+        with self._lock:
+            self._change(self._remove_user, (user_id,))
+
+    def set_username(self, user_id, username):
+        '''
+        Stores the username of a new user.
+        '''
+        with self._lock:
+            self._change(self._set_username, (user_id, username))
+
+    def user_id(self, username):
+        '''
+        :return: the user id of ``username`` or None if it is not known
+        '''
+        with self._lock:
+            return self._user_ids.get(username)
+
+    def username(self, user_id):
+        '''
+        :return: the username of ``user_id`` or None if it is not known
+        '''
+        with self._lock:
+            return self._usernames.get(user_id)
+
+    def friends(self, user_id):
+        '''
+        :return: sorted list with the ids of the friends of ``user_id``
+        '''
+        with self._lock:
+            return list(self._out.neighbours(user_id))
+
+    def followers(self, user_id):
+        '''
+        :return: sorted list with the ids of the users that have
+            ``user_id`` as a friend
+        '''
+        with self._lock:
+            return list(self._in.neighbours(user_id))
+
+    def mutual_friends(self, user_id, other_id):
+        '''
+        :return: sorted list with the ids of the friends of both users
+        '''
+        with self._lock:
+            return intersect(self._out.neighbours(user_id),
+                             self._out.neighbours(other_id))
+
+    def suggestions(self, user_id, limit):
+        '''
+        Friends of the friends of ``user_id`` that are not yet its friends,
+        ranked by the number of friends of ``user_id`` that have them as a
+        friend (common neighbours).
+
+        :return: list of at most ``limit`` tuples (user id, common
+            neighbours), the best first. Ties are ordered by user id.
+        '''
+        with self._lock:
+            friends = self._out.neighbours(user_id)
+            known = set(friends)
+            counts = {}
+            for friend_id in friends:
+                for candidate in self._out.neighbours(friend_id):
+                    if candidate != user_id and candidate not in known:
+                        counts[candidate] = counts.get(candidate, 0) + 1
+        return heapq.nsmallest(limit, counts.iteritems(),
+                               key=lambda item: (-item[1], item[0]))
+
+    def metrics(self):
+        '''
+        :return: dictionary with the number of ``users`` and ``edges``, the
+            size of the ``delta`` and the counters ``loads`` and
+            ``compactions``
+        '''
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['users'] = len(self._usernames)
+            metrics['edges'] = self._out.edge_count()
+            metrics['delta'] = self._out.delta + self._in.delta
+            return metrics
@@ -28,6 +28,10 @@ APIARY_PROFILES_URL = "STUDENT_APIARY_PROJECT/reference/profiles/"
 APIARY_RELS_URL = "STUDENT_APIARY_PROJECT/reference/link-relations/"
 
 USER_SCHEMA_URL = "/forum/schema/user/"
+
+#Default and maximum number of items in a page of a collection
+USERS_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 PRIVATE_PROFILE_SCHEMA_URL = "/forum/schema/private-profile/"
 LINK_RELATIONS_URL = "/forum/link-relations/"
 
@@ -37,7 +41,14 @@ app.debug = True
 # Set the database Engine. In order to modify the database file (e.g. for
 # testing) provide the database path   app.config to modify the
 #database to be used (for instance for testing)
-app.config.update({"Engine": database.Engine()})
+#The API is the only writer of its database file, so the usernames can be
+#kept in the identity map, the username filter and the friend graph of the
+#Engine, and the query cache (leaderboards) is invalidated by its writes
+#Users with many friends get a timeline, so their feed is read in one range
+ENGINE_OPTIONS = {"query_cache": True, "identity_map": True,
+                  "username_filter": True, "friend_graph": True,
+                  "timeline_friends": database.DEFAULT_TIMELINE_FRIENDS}
+app.config.update({"Engine": database.Engine(**ENGINE_OPTIONS)})
 #Start the RESTful API.
 api = Api(app)
 
@@ -302,11 +313,17 @@ def connect_db():
     """
     Creates a database connection before the request is proccessed.
 
+    GET requests get a read-only connection, so they never take the write
+    lock and can run in parallel with the writes.
+
     The connection is stored in the application context variable flask.g .
     Hence it is accessible from the request object.
     """
 
-    g.con = app.config["Engine"].connect()
+    if request.method in ("GET", "HEAD"):
+        g.con = app.config["Engine"].connect_readonly()
+    else:
+        g.con = app.config["Engine"].connect()
 
 #HOOKS
 @app.teardown_request
@@ -330,16 +347,39 @@ class Users(Resource):
 
     def get(self):
         """
-        Gets a list of all the users in the database.
+        Gets a page of the users in the database.
 
+        Query parameters:
+         * limit: maximum number of users in the page (default 50)
+         * cursor: cursor taken from the next or prev control of a page
+
+        Returns 400 if limit or cursor are not valid.
         Returns 404 if users don't exist. Otherwise returns 200
 
 
         """
+        #PARSE THE QUERY PARAMETERS
+        cursor = request.args.get("cursor")
+        try:
+            limit = int(request.args.get("limit", USERS_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            return create_error_response(400, "Wrong limit",
+                                         "limit must be between 1 and %d"
+                                         % MAX_PAGE_SIZE)
         #PERFORM OPERATIONS
         #Create the users list
-        users_db = g.con.get_users()
-        if not users_db:
+        try:
+            #The avatars are only in the user resource, the list is read
+            #from the covering index users_list_idx
+            page = g.con.get_users_page(limit, cursor,
+                                        database.LIST_USER_FIELDS)
+        except ValueError:
+            return create_error_response(400, "Wrong cursor",
+                                         "The cursor is not valid")
+        users_db = page["items"]
+        if not users_db and cursor is None:
             return create_error_response(404, "No users")
 
         #FILTER AND GENERATE THE RESPONSE
@@ -349,6 +389,13 @@ class Users(Resource):
         envelope.add_control("self", href=api.url_for(Users))
  
         envelope.add_control_add_user()
+        #keyset pagination controls
+        if page["next"] is not None:
+            envelope.add_control("next", href=api.url_for(
+                Users, cursor=page["next"], limit=limit))
+        if page["prev"] is not None:
+            envelope.add_control("prev", href=api.url_for(
+                Users, cursor=page["prev"], limit=limit))
         #not yet implemented
         #envelope.add_control_list_exercises()
 
@@ -361,7 +408,6 @@ class Users(Resource):
             item = ForumObject(
                 username=user["username"],
                 description = user["description"],
-                avatar=user["avatar"],
                 visibility=user["visibility"]
             )
             #add controls to each object in the list
@@ -434,13 +480,13 @@ class Users(Resource):
         if (response == None):
             return create_error_response(415, "Data restriction failed, user already exists"
                                         )
-        #Get user info
-        userinfo=g.con.get_user(username)
+        #The response is built from the written values, there is no need to
+        #read the user again
         envelope = ForumObject(
-                username=userinfo["username"],
-                description = userinfo["description"],
-                avatar=userinfo["avatar"],
-                visibility=userinfo["visibility"]
+                username=username,
+                description = description,
+                avatar=avatar,
+                visibility=visibility
             )
         #Controls
         envelope.add_control("self", href=api.url_for(User,username=username))       
@@ -466,7 +512,7 @@ class User(Resource):
 
         #PERFORM OPERATIONS
 
-        user_db = g.con.get_user(username)
+        user_db = g.con.get_user(username, database.PUBLIC_USER_FIELDS)
         if not user_db:
             return create_error_response(404, "Unknown user",
                                          "There is no a user with name %s"
@@ -534,23 +580,19 @@ class User(Resource):
             return create_error_response(400, "Wrong request format")                                          
         else:
   
+            #modify_user returns None if there is no user with that name
             if not g.con.modify_user(username,request_body ):
-                return create_error_response(500, "Internal error",
-                                         "User information for %s cannot be updated" % messageid
-                                        )
-        user_db = g.con.get_user(username)
-        if not user_db:
-            return create_error_response(404, "Unknown user",
-                                         "There is no a user with name %s"
-                                         % username)
+                return create_error_response(404, "Unknown user",
+                                             "There is no a user with name %s"
+                                             % username)
         #FILTER AND GENERATE RESPONSE
-        #Create the envelope:
+        #Create the envelope from the written values:
 
         envelope = ForumObject(
-                username=user_db["username"],
-                description = user_db["description"],
-                avatar=user_db["avatar"],
-                visibility=user_db["visibility"]
+                username=username,
+                description = description,
+                avatar=avatar,
+                visibility=visibility
             )
         envelope.add_control("self", href=api.url_for(User,username=username)) 
         envelope.add_control_modify_user(username)
@@ -568,7 +610,8 @@ class Friends(Resource):
         """
         Get all of the users friends
         """
-        friends = g.con.get_friends(username)
+        #One query returns the friends with their usernames
+        friends = g.con.get_friend_users(username, ["username"])
         
         if not friends:
             return create_error_response(404, "Unknown user",
@@ -585,7 +628,7 @@ class Friends(Resource):
         items = envelope["items"] = []
 
         for user in friends:
-            username=g.con.get_username(user["friend_id"])
+            username=user["username"]
             item = ForumObject(
                 username=username
                 
@@ -650,6 +693,299 @@ class Friends(Resource):
         return '',204
     
 
+
+def create_username_list(envelope, usernames):
+    """
+    Adds the items of a list of usernames to ``envelope``. Each item has a
+    self control pointing to the user.
+    """
+    items = envelope["items"] = []
+    for username in usernames:
+        item = ForumObject(username=username)
+        item.add_control("self", href=api.url_for(User, username=username))
+        items.append(item)
+    return items
+
+
+class MutualFriends(Resource):
+    """
+    Users that are friends of both users.
+    """
+
+    def get(self, username, other):
+        """
+        Gets the common friends of two users.
+
+        Returns 404 if one of the users does not exist. Otherwise returns 200
+        """
+        mutual = g.con.get_mutual_friends(username, other)
+        if mutual is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s or %s"
+                                         % (username, other))
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(
+            MutualFriends, username=username, other=other))
+        envelope.add_control("up", href=api.url_for(Friends,
+                                                    username=username))
+        create_username_list(envelope, mutual)
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
+
+class Followers(Resource):
+    """
+    Users that have a user as a friend.
+    """
+
+    def get(self, username):
+        """
+        Gets the followers of a user.
+
+        Returns 404 if the user does not exist. Otherwise returns 200
+        """
+        followers = g.con.get_followers(username)
+        if followers is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s"
+                                         % username)
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(Followers,
+                                                      username=username))
+        envelope.add_control("up", href=api.url_for(User, username=username))
+        create_username_list(envelope, followers)
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
+
+class FriendSuggestions(Resource):
+    """
+    Friends of the friends of a user that are not yet its friends.
+    """
+
+    def get(self, username):
+        """
+        Gets friend suggestions for a user, ranked by the number of common
+        friends.
+
+        Query parameters:
+         * limit: maximum number of suggestions (default 10)
+
+        Returns 400 if limit is not valid.
+        Returns 404 if the user does not exist. Otherwise returns 200
+        """
+        try:
+            limit = int(request.args.get("limit",
+                                         database.DEFAULT_SUGGESTIONS))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            return create_error_response(400, "Wrong limit",
+                                         "limit must be between 1 and %d"
+                                         % MAX_PAGE_SIZE)
+        suggestions = g.con.get_friend_suggestions(username, limit)
+        if suggestions is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s"
+                                         % username)
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(FriendSuggestions,
+                                                      username=username))
+        envelope.add_control("up", href=api.url_for(User, username=username))
+        items = create_username_list(
+            envelope, [suggestion["username"] for suggestion in suggestions])
+        for item, suggestion in zip(items, suggestions):
+            item["common"] = suggestion["common"]
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
+
+class FriendPath(Resource):
+    """
+    Shortest chain of friends between two users.
+    """
+
+    def get(self, username, other):
+        """
+        Gets the shortest chain of friends from username to other. The items
+        are the users of the chain in order, both ends included.
+
+        Query parameters:
+         * max_depth: maximum length of the chain (default and maximum 6)
+
+        Returns 400 if max_depth is not valid.
+        Returns 404 if one of the users does not exist or if there is no chain
+        within max_depth. Otherwise returns 200
+        """
+        try:
+            max_depth = int(request.args.get("max_depth",
+                                             database.DEFAULT_PATH_DEPTH))
+        except ValueError:
+            max_depth = 0
+        if not 0 < max_depth <= database.DEFAULT_PATH_DEPTH:
+            return create_error_response(400, "Wrong max_depth",
+                                         "max_depth must be between 1 and %d"
+                                         % database.DEFAULT_PATH_DEPTH)
+        result = g.con.get_friend_path(username, other, max_depth)
+        if result is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s or %s"
+                                         % (username, other))
+        if result["path"] is None:
+            if result["complete"]:
+                message = "%s is not connected to %s" % (username, other)
+            else:
+                message = "No chain found within the search limits"
+            return create_error_response(404, "No path", message)
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(
+            FriendPath, username=username, other=other))
+        envelope.add_control("up", href=api.url_for(Friends,
+                                                    username=username))
+        create_username_list(envelope, result["path"])
+        envelope["length"] = len(result["path"]) - 1
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
+
+class ExerciseStats(Resource):
+    """
+    Aggregated exercises of a user.
+    """
+
+    def get(self, username):
+        """
+        Gets the totals, counts, averages and maxima of the values and times
+        of the exercises of a user. The items are the groups.
+
+        Query parameters:
+         * period: day, week or month to group by period (default none)
+         * by_type: false to aggregate all the types together (default true)
+         * start: first date, dd.mm.yyyy or yyyy-mm-dd
+         * end: last date, dd.mm.yyyy or yyyy-mm-dd
+
+        Returns 400 if a query parameter is not valid.
+        Returns 404 if the user does not exist. Otherwise returns 200
+        """
+        period = request.args.get("period")
+        by_type = request.args.get("by_type", "true").lower() not in ("false",
+                                                                      "0")
+        try:
+            stats = g.con.get_exercise_stats(username, by_type, period,
+                                             request.args.get("start"),
+                                             request.args.get("end"))
+        except ValueError, e:
+            return create_error_response(400, "Wrong query parameter", str(e))
+        if stats is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s"
+                                         % username)
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(ExerciseStats,
+                                                      username=username))
+        envelope.add_control("up", href=api.url_for(User, username=username))
+        envelope["items"] = [ForumObject(**group) for group in stats]
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
+
+class Leaderboard(Resource):
+    """
+    Ranking of a user and its friends.
+    """
+
+    def get(self, username):
+        """
+        Ranks the user and its friends by the total distance or time of
+        their exercises in a week or a month. The items are the best users.
+
+        Query parameters:
+         * type: exercise type to rank, for example run (default all types)
+         * period: week or month (default week)
+         * measure: distance (metres) or time (seconds) (default distance)
+         * date: a day of the period, dd.mm.yyyy or yyyy-mm-dd (default today)
+         * limit: maximum number of users (default 10)
+
+        Returns 400 if a query parameter is not valid.
+        Returns 404 if the user does not exist. Otherwise returns 200
+        """
+        try:
+            limit = int(request.args.get("limit",
+                                         database.DEFAULT_LEADERBOARD_SIZE))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            return create_error_response(400, "Wrong limit",
+                                         "limit must be between 1 and %d"
+                                         % MAX_PAGE_SIZE)
+        try:
+            leaderboard = g.con.get_leaderboard(
+                username, request.args.get("period", "week"),
+                request.args.get("type"),
+                request.args.get("measure", "distance"),
+                request.args.get("date"), limit)
+        except ValueError, e:
+            return create_error_response(400, "Wrong query parameter", str(e))
+        if leaderboard is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s"
+                                         % username)
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(Leaderboard,
+                                                      username=username))
+        envelope.add_control("up", href=api.url_for(User, username=username))
+        for key in ("period", "start", "end", "rank"):
+            envelope[key] = leaderboard[key]
+        entries = leaderboard["items"]
+        items = create_username_list(
+            envelope, [entry["username"] for entry in entries])
+        for item, entry in zip(items, entries):
+            for key in ("rank", "total", "count"):
+                item[key] = entry[key]
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
+
+class Feed(Resource):
+    """
+    Latest exercises of the friends of a user.
+    """
+
+    def get(self, username):
+        """
+        Gets a page of the exercises of the friends of a user, the newest
+        first.
+
+        Query parameters:
+         * limit: maximum number of exercises in the page (default 50)
+         * cursor: cursor taken from the next control of a page
+
+        Returns 400 if limit or cursor are not valid.
+        Returns 404 if the user does not exist. Otherwise returns 200
+        """
+        cursor = request.args.get("cursor")
+        try:
+            limit = int(request.args.get("limit", database.DEFAULT_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            return create_error_response(400, "Wrong limit",
+                                         "limit must be between 1 and %d"
+                                         % MAX_PAGE_SIZE)
+        try:
+            page = g.con.get_feed(username, limit, cursor)
+        except ValueError:
+            return create_error_response(400, "Wrong cursor",
+                                         "The cursor is not valid")
+        if page is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with name %s"
+                                         % username)
+        envelope = ForumObject()
+        envelope.add_control("self", href=api.url_for(Feed,
+                                                      username=username))
+        envelope.add_control("up", href=api.url_for(User, username=username))
+        if page["next"] is not None:
+            envelope.add_control("next", href=api.url_for(
+                Feed, username=username, cursor=page["next"], limit=limit))
+        envelope["items"] = [ForumObject(**exercise)
+                             for exercise in page["items"]]
+        return Response(json.dumps(envelope), 200, mimetype=MASON+";")
+
 #######################################################################################
 
 
@@ -665,6 +1001,24 @@ api.add_resource(User, "/exercisetracker/api/users/<username>/",
 
 api.add_resource(Friends,"/exercisetracker/api/users/<username>/friends",
                  endpoint="friends")
+api.add_resource(MutualFriends,
+                 "/exercisetracker/api/users/<username>/friends/mutual/<other>",
+                 endpoint="mutual_friends")
+api.add_resource(Followers, "/exercisetracker/api/users/<username>/followers",
+                 endpoint="followers")
+api.add_resource(FriendSuggestions,
+                 "/exercisetracker/api/users/<username>/suggestions",
+                 endpoint="suggestions")
+api.add_resource(FriendPath,
+                 "/exercisetracker/api/users/<username>/path/<other>",
+                 endpoint="friend_path")
+api.add_resource(ExerciseStats, "/exercisetracker/api/users/<username>/stats",
+                 endpoint="stats")
+api.add_resource(Leaderboard,
+                 "/exercisetracker/api/users/<username>/leaderboard",
+                 endpoint="leaderboard")
+api.add_resource(Feed, "/exercisetracker/api/users/<username>/feed",
+                 endpoint="feed")
 ###
 #TODO TONI
 # sama ku ylempn on tehty userille. Exercise add_controls funktiot ei toimi ennen tt
@@ -0,0 +1,130 @@
+'''
+Created on 18.10.2026
+
+Registry of the units of the exercise values and times. The database API
+uses it to store every exercise also in canonical SI units: metres in
+``exercise.value_si`` and seconds in ``exercise.time_si``.
+
+@authors: Toni Narhi & Ville Kemppainen
+'''
+
+#Dimensions of the units
+DISTANCE = 'distance'
+DURATION = 'duration'
+
+
+class UnitRegistry(object):
+    '''
+    Units known by the API, each one with its dimension and the factor that
+    converts it to the SI unit of the dimension (metres or seconds).
+
+    Unit names are case insensitive and the surrounding whitespace is
+    ignored, so ``' KM'`` is ``km``.
+    '''
+    def __init__(self):
+        super(UnitRegistry, self).__init__()
+        self._units = {}
+
+    @staticmethod
+    def normalize(unit):
+        '''
+        :return: the name of ``unit`` used as key of the registry, or None if
+            ``unit`` is not a string
+        '''
+        if not isinstance(unit, basestring):
+            return None
+        return unit.strip().lower()
+
+    def register(self, unit, dimension, factor, aliases=()):
+        '''
+        Adds a unit and its aliases.
+
+        :param str unit: name of the unit, for example ``km``
+        :param str dimension: :py:data:`DISTANCE` or :py:data:`DURATION`
+        :param float factor: value of one ``unit`` in SI units
+        :param aliases: other names of the unit
+        '''
+        for name in (unit,) + tuple(aliases):
+            self._units[self.normalize(name)] = (dimension, float(factor))
+
+    def lookup(self, unit):
+        '''
+        :return: tuple (dimension, factor) of ``unit`` or None if the unit is
+            not known
+        '''
+        return self._units.get(self.normalize(unit))
+
+    def units(self, dimension):
+        '''
+        :return: dictionary with the factors of the unit names of
+            ``dimension``
+        '''
+        return dict((name, factor)
+                    for name, (unit_dimension, factor) in self._units.iteritems()
+                    if unit_dimension == dimension)
+
+    def to_si(self, value, unit, dimension):
+        '''
+        Converts ``value`` from ``unit`` to the SI unit of ``dimension``.
+
+        :return: the value as a float, or None if ``unit`` is not a known
+            unit of ``dimension`` or ``value`` is not a number (strings are
+            not converted, like in SQL)
+        '''
+        found = self.lookup(unit)
+        if found is None or found[0] != dimension:
+            return None
+        if (isinstance(value, bool) or
+                not isinstance(value, (int, long, float))):
+            return None
+        return value * found[1]
+
+    def sql_to_si(self, value, unit, dimension):
+        '''
+        SQL version of :py:meth:`to_si` for the known units, used by the
+        migrations and triggers that fill the SI columns without Python.
+
+        :param str value: the column or expression holding the value
+        :param str unit: the column or expression holding the unit
+        '''
+        cases = ' '.join("WHEN '%s' THEN %r" % (name.replace("'", "''"),
+                                                 factor)
+                         for name, factor in sorted(self.units(dimension)
+                                                    .iteritems()))
+        return ("CASE WHEN typeof({0}) IN ('integer', 'real') "
+                "THEN {0} * CASE lower(trim({1})) {2} END END").format(
+                    value, unit, cases)
+
+
+#Units accepted in exercise.valueunit and exercise.timeunit. Unknown units,
+#for instance 'sm', are kept as they are but have no SI value.
+REGISTRY = UnitRegistry()
+REGISTRY.register('m', DISTANCE, 1, ('meter', 'meters', 'metre', 'metres'))
+REGISTRY.register('km', DISTANCE, 1000, ('kilometer', 'kilometers',
+                                         'kilometre', 'kilometres'))
+REGISTRY.register('cm', DISTANCE, 0.01)
+REGISTRY.register('mm', DISTANCE, 0.001)
+REGISTRY.register('mi', DISTANCE, 1609.344, ('mile', 'miles'))
+REGISTRY.register('yd', DISTANCE, 0.9144, ('yard', 'yards'))
+REGISTRY.register('ft', DISTANCE, 0.3048, ('foot', 'feet'))
+REGISTRY.register('s', DURATION, 1, ('sec', 'second', 'seconds'))
+REGISTRY.register('ms', DURATION, 0.001)
+REGISTRY.register('min', DURATION, 60, ('mins', 'minute', 'minutes'))
+REGISTRY.register('h', DURATION, 3600, ('hr', 'hrs', 'hour', 'hours'))
+REGISTRY.register('d', DURATION, 86400, ('day', 'days'))
+
+
+def value_si(value, unit):
+    '''
+    :return: the distance ``value`` in metres or None if it cannot be
+        converted
+    '''
+    return REGISTRY.to_si(value, unit, DISTANCE)
+
+
+def time_si(time, unit):
+    '''
+    :return: the duration ``time`` in seconds or None if it cannot be
+        converted
+    '''
+    return REGISTRY.to_si(time, unit, DURATION)
@@ -7,7 +7,7 @@ import forum.resources as resources
 import forum.database as database
 
 DB_PATH = "db/forum_test.db"
-ENGINE = database.Engine(DB_PATH)
+ENGINE = database.Engine(DB_PATH, count_statements=True)
 
 MASONJSON = "application/vnd.mason+json"
 JSON = "application/json"
@@ -65,6 +65,23 @@ class ResourcesAPITestCase(unittest.TestCase):
         ENGINE.clear()
         self.app_context.pop()
 
+    def count_statements(self, request, *args, **kwargs):
+        """
+        Sends a request with the test client method ``request`` and returns
+        the response and the number of SELECT, INSERT, UPDATE and DELETE
+        statements executed while handling it.
+        """
+        engine = resources.app.config["Engine"]
+        before = engine.statement_counts()
+        resp = request(*args, **kwargs)
+        after = engine.statement_counts()
+        counts = {}
+        for kind in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            executed = after.get(kind, 0) - before.get(kind, 0)
+            if executed:
+                counts[kind] = executed
+        return resp, counts
+
 
 class UsersTestCase (ResourcesAPITestCase):
     user_1_request = {
@@ -99,9 +116,11 @@ class UsersTestCase (ResourcesAPITestCase):
         """
         print "("+self.test_get_users.__name__+")", self.test_get_users.__doc__
         #Check that I receive status code 200
-        resp = self.client.get(flask.url_for("users"))
+        resp, counts = self.count_statements(self.client.get,
+                                             flask.url_for("users"))
        
         self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 1})
 
         # Check that I receive a collection and adequate href
         data = json.loads(resp.data)
@@ -117,7 +136,7 @@ class UsersTestCase (ResourcesAPITestCase):
         
         for item in items:
             self.assertIn("username", item)
-            self.assertIn("avatar", item)
+            self.assertNotIn("avatar", item)
             self.assertIn("description", item)
             self.assertIn("visibility", item)
             self.assertIn("@controls", item)
@@ -125,6 +144,38 @@ class UsersTestCase (ResourcesAPITestCase):
             self.assertIn("href", item["@controls"]["self"])
             self.assertEquals(item["@controls"]["self"]["href"], resources.api.url_for(resources.Users, username=item["username"], _external=False))
 
+    def test_get_users_readonly(self):
+        """
+        Checks that GET users uses a read-only connection
+        """
+        print "("+self.test_get_users_readonly.__name__+")", self.test_get_users_readonly.__doc__
+        before = ENGINE.pool_metrics(readonly=True)["checkouts"]
+        resp = self.client.get(flask.url_for("users"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(ENGINE.pool_metrics(readonly=True)["checkouts"],
+                          before + 1)
+
+    def test_get_users_paginated(self):
+        """
+        Checks that GET users returns pages with next and prev controls
+        """
+        print "("+self.test_get_users_paginated.__name__+")", self.test_get_users_paginated.__doc__
+        resp = self.client.get(flask.url_for("users", limit=3))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals(len(data["items"]), 3)
+        self.assertNotIn("prev", data["@controls"])
+        resp = self.client.get(data["@controls"]["next"]["href"])
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals(len(data["items"]), initial_users - 3)
+        self.assertNotIn("next", data["@controls"])
+        self.assertIn("prev", data["@controls"])
+        resp = self.client.get(flask.url_for("users", limit=0))
+        self.assertEquals(resp.status_code, 400)
+        resp = self.client.get(flask.url_for("users", cursor="garbage"))
+        self.assertEquals(resp.status_code, 400)
+
     def test_add_user(self):
         """
         Checks that the user is added correctly
@@ -133,16 +184,28 @@ class UsersTestCase (ResourcesAPITestCase):
         print "("+self.test_add_user.__name__+")", self.test_add_user.__doc__
 
         # With a complete request
-        resp = self.client.post(resources.api.url_for(resources.Users),
-                                headers={"Content-Type": JSON},
-                                data=json.dumps(self.user_1_request)
-                               )
+        resp, counts = self.count_statements(
+            self.client.post, resources.api.url_for(resources.Users),
+            headers={"Content-Type": JSON},
+            data=json.dumps(self.user_1_request))
         
         self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"INSERT": 1})
         data = json.loads(resp.data)
         
         controls = data["@controls"]
         self.assertIn("self", controls)
+        self.assertEquals(data["username"], self.user_1_request["username"])
+        self.assertEquals(data["description"],
+                          self.user_1_request["description"])
+
+        # The same user again
+        resp, counts = self.count_statements(
+            self.client.post, resources.api.url_for(resources.Users),
+            headers={"Content-Type": JSON},
+            data=json.dumps(self.user_1_request))
+        self.assertEquals(resp.status_code, 415)
+        self.assertEquals(counts, {"INSERT": 1})
 
 class UserTestCase (ResourcesAPITestCase):
     user_1_request = {
@@ -185,10 +248,12 @@ class UserTestCase (ResourcesAPITestCase):
         print "("+self.test_get_user.__name__+")", self.test_get_user.__doc__
         #Check that I receive status code 200
   
-        resp = self.client.get(flask.url_for("user",username="Mystery"))
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("user",username="Mystery"))
 
         
         self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 1})
 
         # Check that I receive a collection and adequate href
         data = json.loads(resp.data)
@@ -206,16 +271,31 @@ class UserTestCase (ResourcesAPITestCase):
         print "("+self.test_modify_user.__name__+")", self.test_modify_user.__doc__
 
         # With a complete request
-        resp = self.client.put(flask.url_for("user",username="Mystery"),
-                                headers={"Content-Type": JSON},
-                                data=json.dumps(self.user_1_request)
-                               )
+        resp, counts = self.count_statements(
+            self.client.put, flask.url_for("user",username="Mystery"),
+            headers={"Content-Type": JSON},
+            data=json.dumps(self.user_1_request))
         
         self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"UPDATE": 1})
         data = json.loads(resp.data)
         
         controls = data["@controls"]
         self.assertIn("self", controls)
+        self.assertEquals(data["description"],
+                          self.user_1_request["description"])
+        #Only Mystery is modified
+        con = ENGINE.connect()
+        self.assertNotEquals(con.get_user("M")["description"],
+                             self.user_1_request["description"])
+        con.close()
+
+        # Unknown user
+        request = dict(self.user_1_request, username="Batty")
+        resp = self.client.put(flask.url_for("user",username="Batty"),
+                               headers={"Content-Type": JSON},
+                               data=json.dumps(request))
+        self.assertEquals(resp.status_code, 404)
 
     def test_delete_user(self):
         """
@@ -252,10 +332,16 @@ class FriendsTestCase (ResourcesAPITestCase):
         
         print "("+self.test_get_friends.__name__+")", self.test_get_friends.__doc__
 
-        resp = self.client.get(flask.url_for("friends",username="Mystery"),
-                                headers={"Content-Type": JSON},
-                                data = json.dumps("Mystery"))
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("friends",username="Mystery"),
+            headers={"Content-Type": JSON},
+            data = json.dumps("Mystery"))
         self.assertEquals(resp.status_code, 200)
+        #One query whatever the number of friends
+        self.assertEquals(counts, {"SELECT": 1})
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Mystery", "M", "Dakka"])
 
     
     def test_add_friend(self):
@@ -280,6 +366,312 @@ class FriendsTestCase (ResourcesAPITestCase):
         self.assertEquals(resp.status_code, 204)
     
         
+class FriendGraphTestCase (ResourcesAPITestCase):
+
+    def test_get_mutual_friends(self):
+        """
+        Checks the mutual friends of two users
+        """
+        print "("+self.test_get_mutual_friends.__name__+")", self.test_get_mutual_friends.__doc__
+        resp = self.client.get(flask.url_for("mutual_friends",
+                                             username="Mystery",
+                                             other="Dakka"))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Mystery"])
+        resp = self.client.get(flask.url_for("mutual_friends",
+                                             username="Mystery",
+                                             other="Batty"))
+        self.assertEquals(resp.status_code, 404)
+
+    def test_get_followers(self):
+        """
+        Checks the followers of a user
+        """
+        print "("+self.test_get_followers.__name__+")", self.test_get_followers.__doc__
+        resp = self.client.get(flask.url_for("followers", username="Mystery"))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Mystery", "Dakka", "Sekoitus"])
+        self.assertIn("self", data["items"][0]["@controls"])
+        resp = self.client.get(flask.url_for("followers", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+
+    def test_get_suggestions(self):
+        """
+        Checks the friend suggestions of a user
+        """
+        print "("+self.test_get_suggestions.__name__+")", self.test_get_suggestions.__doc__
+        resp = self.client.get(flask.url_for("suggestions",
+                                             username="Sekoitus", limit=1))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals(len(data["items"]), 1)
+        self.assertEquals(data["items"][0]["username"], "M")
+        self.assertEquals(data["items"][0]["common"], 1)
+        resp = self.client.get(flask.url_for("suggestions",
+                                             username="Sekoitus", limit=0))
+        self.assertEquals(resp.status_code, 400)
+
+    def test_get_friend_path(self):
+        """
+        Checks the shortest chain of friends between two users
+        """
+        print "("+self.test_get_friend_path.__name__+")", self.test_get_friend_path.__doc__
+        resp = self.client.get(flask.url_for("friend_path",
+                                             username="Sekoitus", other="M"))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Sekoitus", "Mystery", "M"])
+        self.assertEquals(data["length"], 2)
+        resp = self.client.get(flask.url_for("friend_path",
+                                             username="Sekoitus", other="M",
+                                             max_depth=1))
+        self.assertEquals(resp.status_code, 404)
+        resp = self.client.get(flask.url_for("friend_path",
+                                             username="M", other="Mystery"))
+        self.assertEquals(resp.status_code, 404)
+        resp = self.client.get(flask.url_for("friend_path",
+                                             username="M", other="Batty"))
+        self.assertEquals(resp.status_code, 404)
+        resp = self.client.get(flask.url_for("friend_path",
+                                             username="M", other="Mystery",
+                                             max_depth=100))
+        self.assertEquals(resp.status_code, 400)
+
+class ExerciseStatsTestCase (ResourcesAPITestCase):
+
+    def test_get_stats(self):
+        """
+        Checks the aggregated exercises of a user
+        """
+        print "("+self.test_get_stats.__name__+")", self.test_get_stats.__doc__
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("stats", username="M",
+                                           period="month"))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals([(item["period"], item["type"], item["count"],
+                            item["total_value"]) for item in data["items"]],
+                          [("2012-12", "jog", 1, 1010000),
+                           ("2012-12", "run", 1, 101)])
+        self.assertEquals(counts, {"SELECT": 2})
+        resp = self.client.get(flask.url_for("stats", username="M",
+                                             by_type="false"))
+        data = json.loads(resp.data)
+        self.assertEquals(len(data["items"]), 1)
+        self.assertEquals(data["items"][0]["count"], 2)
+        resp = self.client.get(flask.url_for("stats", username="M",
+                                             period="year"))
+        self.assertEquals(resp.status_code, 400)
+        resp = self.client.get(flask.url_for("stats", username="M",
+                                             start="yesterday"))
+        self.assertEquals(resp.status_code, 400)
+        resp = self.client.get(flask.url_for("stats", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+
+class LeaderboardTestCase (ResourcesAPITestCase):
+
+    def test_get_leaderboard(self):
+        """
+        Checks the leaderboard of a user and its friends
+        """
+        print "("+self.test_get_leaderboard.__name__+")", self.test_get_leaderboard.__doc__
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("leaderboard", username="Mystery",
+                                           type="run", period="week",
+                                           date="12.12.2012"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 2})
+        data = json.loads(resp.data)
+        self.assertEquals(data["period"], "2012-12-10")
+        self.assertEquals(data["rank"], 3)
+        self.assertEquals([(item["rank"], item["username"], item["total"])
+                           for item in data["items"]],
+                          [(1, "M", 101.0), (2, "Dakka", 0.0),
+                           (3, "Mystery", 0.0)])
+        self.assertIn("self", data["items"][0]["@controls"])
+        for args in ({"period": "year"}, {"measure": "speed"},
+                     {"date": "yesterday"}, {"limit": 0}):
+            resp = self.client.get(flask.url_for("leaderboard",
+                                                 username="Mystery", **args))
+            self.assertEquals(resp.status_code, 400)
+        resp = self.client.get(flask.url_for("leaderboard", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+
+class FeedTestCase (ResourcesAPITestCase):
+
+    def test_get_feed(self):
+        """
+        Checks the pages of the feed of a user
+        """
+        print "("+self.test_get_feed.__name__+")", self.test_get_feed.__doc__
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("feed", username="Mystery",
+                                           limit=2))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 4})
+        data = json.loads(resp.data)
+        self.assertEquals([item["exercise_id"] for item in data["items"]],
+                          [4, 2])
+        self.assertEquals(data["items"][0]["username"], "Mystery")
+        resp = self.client.get(data["@controls"]["next"]["href"])
+        data = json.loads(resp.data)
+        self.assertEquals([item["exercise_id"] for item in data["items"]],
+                          [1])
+        self.assertNotIn("next", data["@controls"])
+        for args in ({"limit": 0}, {"cursor": "cursor"}):
+            resp = self.client.get(flask.url_for("feed", username="Mystery",
+                                                 **args))
+            self.assertEquals(resp.status_code, 400)
+        resp = self.client.get(flask.url_for("feed", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+
+class ProductionEngineTestCase (ResourcesAPITestCase):
+    """
+    Repeats the user, friend and feed requests with an Engine created with
+    the options of the API (resources.ENGINE_OPTIONS): the query cache, the
+    identity map, the username filter, the friend graph and the timelines.
+    """
+
+    def setUp(self):
+        super(ProductionEngineTestCase, self).setUp()
+        self.engine = database.Engine(DB_PATH, count_statements=True,
+                                      **resources.ENGINE_OPTIONS)
+        resources.app.config["Engine"] = self.engine
+
+    def tearDown(self):
+        resources.app.config["Engine"] = ENGINE
+        self.engine.pool.dispose()
+        super(ProductionEngineTestCase, self).tearDown()
+
+    def test_get_user(self):
+        """
+        Checks that unknown users are answered by the username filter and
+        known users by the cache until they are modified
+        """
+        print "("+self.test_get_user.__name__+")", self.test_get_user.__doc__
+        #The first lookup builds the username filter
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("user", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+        self.assertEquals(counts, {"SELECT": 1})
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("user", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+        self.assertEquals(counts, {})
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("user", username="Mystery"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 1})
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("user", username="Mystery"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {})
+        #The writes of the API invalidate the cached user
+        request = dict(UserTestCase.user_1_request)
+        resp = self.client.put(flask.url_for("user", username="Mystery"),
+                               headers={"Content-Type": JSON},
+                               data=json.dumps(request))
+        self.assertEquals(resp.status_code, 200)
+        resp = self.client.get(flask.url_for("user", username="Mystery"))
+        self.assertEquals(json.loads(resp.data)["description"],
+                          request["description"])
+        resp = self.client.delete(flask.url_for("user", username="Mystery"),
+                                  headers={"Content-Type": JSON})
+        self.assertEquals(resp.status_code, 204)
+        resp = self.client.get(flask.url_for("user", username="Mystery"))
+        self.assertEquals(resp.status_code, 404)
+
+    def test_get_friends(self):
+        """
+        Checks the friends, followers, suggestions and chains of friends
+        answered by the friend graph
+        """
+        print "("+self.test_get_friends.__name__+")", self.test_get_friends.__doc__
+        #One more statement builds the username filter
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("friends", username="Mystery"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 1 + 1})
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Mystery", "M", "Dakka"])
+        #The first graph request loads the friendships and the usernames
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("mutual_friends",
+                                           username="Mystery",
+                                           other="Dakka"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 2})
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Mystery"])
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("followers", username="Mystery"))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {})
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Mystery", "Dakka", "Sekoitus"])
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("suggestions",
+                                           username="Sekoitus", limit=1))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {})
+        data = json.loads(resp.data)
+        self.assertEquals([(item["username"], item["common"])
+                           for item in data["items"]], [("M", 1)])
+        resp = self.client.get(flask.url_for("friend_path",
+                                             username="Sekoitus", other="M"))
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEquals([item["username"] for item in data["items"]],
+                          ["Sekoitus", "Mystery", "M"])
+        #A new friendship is seen by the graph
+        resp = self.client.post(flask.url_for("friends", username="Dakka"),
+                                headers={"Content-Type": JSON},
+                                data=json.dumps(FriendsTestCase.aa))
+        self.assertEquals(resp.status_code, 204)
+        resp = self.client.get(flask.url_for("followers",
+                                             username="Sekoitus"))
+        data = json.loads(resp.data)
+        self.assertIn("Dakka", [item["username"] for item in data["items"]])
+        for endpoint in ("friends", "followers", "suggestions"):
+            resp = self.client.get(flask.url_for(endpoint, username="Batty"))
+            self.assertEquals(resp.status_code, 404)
+
+    def test_get_feed(self):
+        """
+        Checks the pages of the feed of a user read through the cache
+        """
+        print "("+self.test_get_feed.__name__+")", self.test_get_feed.__doc__
+        #One more statement builds the username filter
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("feed", username="Mystery",
+                                           limit=2))
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(counts, {"SELECT": 4 + 1})
+        data = json.loads(resp.data)
+        self.assertEquals([item["exercise_id"] for item in data["items"]],
+                          [4, 2])
+        resp, counts = self.count_statements(
+            self.client.get, flask.url_for("feed", username="Mystery",
+                                           limit=2))
+        self.assertEquals(counts, {})
+        data = json.loads(resp.data)
+        self.assertEquals([item["exercise_id"] for item in data["items"]],
+                          [4, 2])
+        resp = self.client.get(data["@controls"]["next"]["href"])
+        data = json.loads(resp.data)
+        self.assertEquals([item["exercise_id"] for item in data["items"]],
+                          [1])
+        resp = self.client.get(flask.url_for("feed", username="Batty"))
+        self.assertEquals(resp.status_code, 404)
+
 #TODO TONI
 #tee exercise testit. user testit on kesken. lisn ne myhemmin 
 if __name__ == "__main__":
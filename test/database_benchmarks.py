@@ -0,0 +1,315 @@
+'''
+Created on 18.10.2026
+
+Benchmarks for the database API. They are not unit tests and they are not
+run by the test suites. Run them with:
+
+    python -m test.database_benchmarks
+
+@author: Toni Narhi, Ville Kemppainen
+'''
+import threading, time, sys
+from forum import database, units, analytics
+
+#Path to the database file, different from the deployment db
+DB_PATH = 'db/forum_bench.db'
+
+#Seconds each concurrency scenario runs
+DURATION = 2.0
+READER_THREADS = 4
+WRITER_THREADS = 2
+
+BENCH_EXERCISE = {'username': 'Mystery',
+                  'type': 'run',
+                  'value': 100,
+                  'valueunit': 'km',
+                  'date': '12.12.2012',
+                  'time': 500,
+                  'timeunit': 'h'}
+
+
+def create_engine(profile='balanced', **kwargs):
+    '''
+    Creates an empty database populated with *db/forum_data_dump.sql* and
+    returns an Engine using it.
+    '''
+    engine = database.Engine(DB_PATH, profile=profile, **kwargs)
+    engine.remove_database()
+    engine.create_tables()
+    engine.populate_tables()
+    return engine
+
+
+def run_threads(targets, duration):
+    '''
+    Runs every function of ``targets`` in its own thread until ``duration``
+    seconds have passed. Each function receives a function telling if it
+    must stop and returns the number of operations done.
+
+    :return: list with the number of operations done by each function
+    '''
+    deadline = time.time() + duration
+    results = [0] * len(targets)
+
+    def stop():
+        return time.time() >= deadline
+
+    def runner(index, target):
+        results[index] = target(stop)
+
+    threads = [threading.Thread(target=runner, args=(index, target))
+               for index, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def bench_profile_concurrency(profile, group_commit=False):
+    '''
+    Readers list exercises while writers insert exercises using the storage
+    profile ``profile``.
+
+    :return: tuple (reads per second, writes per second)
+    '''
+    engine = create_engine(profile, pool_size=READER_THREADS + WRITER_THREADS,
+                           group_commit=group_commit)
+
+    def reader(stop):
+        done = 0
+        while not stop():
+            con = engine.connect()
+            try:
+                con.get_user_exercises('Mystery')
+                con.get_users()
+            finally:
+                con.close()
+            done += 1
+        return done
+
+    def writer(stop):
+        done = 0
+        while not stop():
+            con = engine.connect()
+            try:
+                con.create_exercise(BENCH_EXERCISE)
+            finally:
+                con.close()
+            done += 1
+        return done
+
+    targets = [reader] * READER_THREADS + [writer] * WRITER_THREADS
+    results = run_threads(targets, DURATION)
+    engine.remove_database()
+    reads = sum(results[:READER_THREADS]) / DURATION
+    writes = sum(results[READER_THREADS:]) / DURATION
+    return reads, writes
+
+
+def bench_write_burst(profile, group_commit):
+    '''
+    Many threads insert exercises at the same time, with or without the
+    group commit writer.
+
+    :return: writes per second
+    '''
+    threads = WRITER_THREADS * 4
+    engine = create_engine(profile, pool_size=threads,
+                           group_commit=group_commit)
+
+    def writer(stop):
+        done = 0
+        con = engine.connect()
+        try:
+            while not stop():
+                con.create_exercise(BENCH_EXERCISE)
+                done += 1
+        finally:
+            con.close()
+        return done
+
+    results = run_threads([writer] * threads, DURATION)
+    engine.remove_database()
+    return sum(results) / DURATION
+
+
+def bench_bulk_insert(rows):
+    '''
+    Inserts ``rows`` users and ``rows`` exercises one by one and with the
+    bulk methods.
+
+    :return: dictionary with the seconds taken by each method
+    '''
+    users = [{'username': 'bench%d' % index, 'password': 'pwd',
+              'avatar': 101, 'description': 'bench user', 'visibility': 0}
+             for index in range(rows)]
+    exercises = [BENCH_EXERCISE] * rows
+    timings = {}
+    for name, bulk in (('single', False), ('many', True)):
+        engine = create_engine()
+        con = engine.connect()
+        start = time.time()
+        if bulk:
+            con.append_users_many(users)
+        else:
+            for user in users:
+                con.append_user(user['username'], user)
+        timings['append_users ' + name] = time.time() - start
+        start = time.time()
+        if bulk:
+            con.create_exercises_many(exercises)
+        else:
+            for exercise in exercises:
+                con.create_exercise(exercise)
+        timings['create_exercises ' + name] = time.time() - start
+        con.close()
+        engine.remove_database()
+    return timings
+
+
+def row_memory(rows):
+    '''
+    Approximate bytes used by the objects of ``rows``: the container of every
+    row plus its distinct value objects. Values shared by several rows, like
+    interned units, are counted once.
+    '''
+    total = 0
+    seen = set()
+    for row in rows:
+        total += sys.getsizeof(row)
+        values = row.values() if isinstance(row, dict) else row
+        for value in values:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+
+def bench_compact_rows(rows, repeat=3):
+    '''
+    Lists ``rows`` exercises with dictionaries and with compact rows.
+
+    :return: dictionary with a tuple (rows per second, bytes per row) for
+        each representation
+    '''
+    engine = create_engine()
+    con = engine.connect()
+    con.create_exercises_many([BENCH_EXERCISE] * rows)
+    con.close()
+    results = {}
+    for name, compact in (('dict', False), ('compact', True)):
+        bench_engine = database.Engine(DB_PATH, compact_rows=compact)
+        con = bench_engine.connect()
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            exercises = con.get_exercises()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        count = len(exercises)
+        results[name] = (count / best, row_memory(exercises) / float(count))
+        con.close()
+        bench_engine.pool.dispose()
+    engine.remove_database()
+    return results
+
+
+def fill_exercises(engine, rows, users=1000, batch=100000):
+    '''
+    Adds ``users`` users and ``rows`` exercises spread over them, several
+    types and units and two years of dates.
+    '''
+    con = engine.connect()
+    names = ['bench%d' % index for index in range(users)]
+    con.append_users_many([{'username': name, 'password': 'pwd',
+                            'avatar': 101, 'description': 'bench user',
+                            'visibility': 0} for name in names])
+    types = ('run', 'walk', 'swim', 'bike')
+    for first in range(0, rows, batch):
+        exercises = []
+        for index in range(first, min(first + batch, rows)):
+            exercises.append({'username': names[index % users],
+                              'type': types[index % len(types)],
+                              'value': index % 5000,
+                              'valueunit': 'km' if index % 3 else 'm',
+                              'date': '%d.%d.%d' % (index % 28 + 1,
+                                                    index % 12 + 1,
+                                                    2011 + index % 2),
+                              'time': index % 90,
+                              'timeunit': 'min'})
+        con.create_exercises_many(exercises)
+    con.close()
+
+
+def bench_analytics(rows):
+    '''
+    Total distance per user and type of ``rows`` exercises, adding up the
+    dictionaries of iter_exercises and with the NumPy columns.
+
+    :return: dictionary with the seconds taken by each path
+    '''
+    engine = create_engine()
+    fill_exercises(engine, rows)
+    con = engine.connect()
+    timings = {}
+    start = time.time()
+    totals = {}
+    for exercise in con.iter_exercises():
+        value = units.value_si(exercise['value'], exercise['valueunit'])
+        if value is not None:
+            key = (exercise['user_id'], exercise['type'])
+            totals[key] = totals.get(key, 0) + value
+    timings['dict rows'] = time.time() - start
+    start = time.time()
+    columns = analytics.load_exercises(con)
+    timings['numpy load'] = time.time() - start
+    start = time.time()
+    columns.sum('value_si', ('user', 'type'))
+    timings['numpy group by'] = time.time() - start
+    con.close()
+    engine.remove_database()
+    return timings
+
+
+def main():
+    print 'Storage profiles: %d readers and %d writers during %.1f s' % (
+        READER_THREADS, WRITER_THREADS, DURATION)
+    print '%-12s %12s %12s' % ('profile', 'reads/s', 'writes/s')
+    for profile in ('default', 'durable', 'balanced', 'throughput'):
+        reads, writes = bench_profile_concurrency(profile)
+        print '%-12s %12.1f %12.1f' % (profile, reads, writes)
+    print
+    print 'Group commit: %d writers during %.1f s' % (WRITER_THREADS * 4,
+                                                      DURATION)
+    print '%-12s %12s %12s' % ('profile', 'single', 'grouped')
+    for profile in ('durable', 'balanced'):
+        single = bench_write_burst(profile, False)
+        grouped = bench_write_burst(profile, True)
+        print '%-12s %12.1f %12.1f' % (profile, single, grouped)
+    print
+    rows = 5000
+    print 'Bulk insert of %d rows' % rows
+    timings = bench_bulk_insert(rows)
+    for name in sorted(timings):
+        print '%-24s %8.3f s' % (name, timings[name])
+    print
+    rows = 100000
+    print 'Listing %d exercises' % rows
+    print '%-12s %12s %12s' % ('rows', 'rows/s', 'bytes/row')
+    results = bench_compact_rows(rows)
+    for name in ('dict', 'compact'):
+        print '%-12s %12.0f %12.1f' % ((name,) + results[name])
+    print
+    if analytics.numpy is None:
+        print 'Analytics skipped: NumPy is not installed'
+        return
+    for rows in (1000000, 10000000):
+        print 'Distance per user and type of %d exercises' % rows
+        timings = bench_analytics(rows)
+        for name in ('dict rows', 'numpy load', 'numpy group by'):
+            print '%-24s %8.3f s' % (name, timings[name])
+
+
+if __name__ == '__main__':
+    main()
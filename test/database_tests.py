@@ -4,14 +4,16 @@ Modified on 09.03.2017
 
 @author: Toni Nrhi, Ville Kemppainen
 '''
-import unittest, sqlite3
+import unittest, sqlite3, threading
 from forum import database
+from forum.bloom import BloomFilter
+from forum import units, analytics
 
 ###Own Implemantation starts
 
 #Path to the database file, different from the deployment db
 DB_PATH = 'db/forum.db'
-ENGINE = database.Engine(DB_PATH)
+ENGINE = database.Engine(DB_PATH, count_statements=True)
 
 #CONSTANTS DEFINING DIFFERENT USERS AND USER PROPERTIES
 USER1_NICKNAME = 'Mystery'
@@ -196,6 +198,54 @@ class UserDBAPITestCase(unittest.TestCase):
             elif user['username'] == USER2_NICKNAME:
                 self.assertDictContainsSubset(user, USER2)
 
+    def test_get_users_page(self):
+        '''
+        Test that get_users_page walks the users forward and backward
+        '''
+        print '('+self.test_get_users_page.__name__+')', \
+              self.test_get_users_page.__doc__
+        users = self.connection.get_users()
+        page1 = self.connection.get_users_page(limit=3)
+        self.assertEquals(page1['items'], users[:3])
+        self.assertIsNone(page1['prev'])
+        page2 = self.connection.get_users_page(limit=3, cursor=page1['next'])
+        self.assertEquals(page2['items'], users[3:])
+        self.assertIsNone(page2['next'])
+        back = self.connection.get_users_page(limit=3, cursor=page2['prev'])
+        self.assertEquals(back['items'], users[:3])
+        self.assertIsNone(back['prev'])
+        self.assertEquals(back['next'], page1['next'])
+        for cursor in ('garbage', database.encode_cursor('next', {}),
+                       database.encode_cursor('prev', '3'),
+                       database.encode_cursor('next', True)):
+            self.assertRaises(ValueError, self.connection.get_users_page, 3,
+                              cursor)
+
+    def test_get_users_fields(self):
+        '''
+        Test that the user methods return only the requested fields
+        '''
+        print '('+self.test_get_users_fields.__name__+')', \
+              self.test_get_users_fields.__doc__
+        fields = database.LIST_USER_FIELDS
+        users = self.connection.get_users(fields)
+        self.assertEquals(len(users), INITIAL_SIZE)
+        for user in users:
+            self.assertEquals(sorted(user.keys()), sorted(fields))
+        self.assertEquals(list(self.connection.iter_users(fields=fields)),
+                          users)
+        self.assertEquals(self.connection.get_users_page(fields=fields)['items'],
+                          users)
+        user = self.connection.get_user(USER1_NICKNAME, ['username', 'avatar'])
+        self.assertEquals(user, {'username': USER1_NICKNAME, 'avatar': 101})
+        self.assertRaises(ValueError, self.connection.get_users,
+                          ['username', 'user_id; DROP TABLE users'])
+        #The listing does not read the table rows
+        cur = self.connection.con.cursor()
+        cur.execute('EXPLAIN QUERY PLAN SELECT users.user_id, users.username, '
+                    'users.description, users.visibility FROM users')
+        self.assertIn('COVERING INDEX users_list_idx', cur.fetchone()[-1])
+
     def test_delete_user(self):
         '''
         Test that the user Mystery is deleted
@@ -338,6 +388,37 @@ class UserDBAPITestCase(unittest.TestCase):
                                       resp2)
 
 
+    def test_append_users_many(self):
+        '''
+        Test that many users are added with one call
+        '''
+        print '('+self.test_append_users_many.__name__+')', \
+              self.test_append_users_many.__doc__
+        other = dict(NEW_USER, username='other')
+        resp = self.connection.append_users_many([NEW_USER, USER1, other,
+                                                  NEW_USER])
+        self.assertEquals(resp, [NEW_USER_NICKNAME, None, 'other', None])
+        self.assertDictContainsSubset(NEW_USER,
+                                      self.connection.get_user(NEW_USER_NICKNAME))
+        self.assertEquals(len(self.connection.get_users()), INITIAL_SIZE + 2)
+
+    def test_create_exercises_many(self):
+        '''
+        Test that many exercises are created with one call
+        '''
+        print '('+self.test_create_exercises_many.__name__+')', \
+              self.test_create_exercises_many.__doc__
+        wrong = dict(NEW_EXERCISE, username=USER_WRONG_NICKNAME)
+        resp = self.connection.create_exercises_many([NEW_EXERCISE, wrong,
+                                                      NEW_EXERCISE])
+        self.assertIsNone(resp[1])
+        self.assertEquals(resp[2], resp[0] + 1)
+        for exercise_id in (resp[0], resp[2]):
+            self.assertDictContainsSubset(NEW_EXERCISE,
+                                          self.connection.get_exercise(exercise_id))
+        self.assertEquals(len(self.connection.get_exercises()),
+                          EXERCISE_SIZE + 2)
+
     def test_get_exercise(self):
         '''
         Test get_exercise with EXERCISE1_ID
@@ -386,6 +467,226 @@ class UserDBAPITestCase(unittest.TestCase):
                 self.assertDictContainsSubset(exercise, EXERCISE2)
 
 
+    def test_iter_exercises(self):
+        '''
+        Test that the exercise generators return the same rows as the lists
+        '''
+        print '('+self.test_iter_exercises.__name__+')', \
+              self.test_iter_exercises.__doc__
+        exercises = self.connection.iter_exercises(batch_size=3)
+        self.assertNotIsInstance(exercises, list)
+        self.assertEquals(list(exercises), self.connection.get_exercises())
+        exercises = self.connection.iter_user_exercises(USER2_NICKNAME,
+                                                        batch_size=1)
+        self.assertEquals(list(exercises),
+                          self.connection.get_user_exercises(USER2_NICKNAME))
+        users = self.connection.iter_users(batch_size=1)
+        self.assertEquals(list(users), self.connection.get_users())
+
+    def test_get_user_exercises_page(self):
+        '''
+        Test that get_user_exercises_page returns only the user exercises
+        '''
+        print '('+self.test_get_user_exercises_page.__name__+')', \
+              self.test_get_user_exercises_page.__doc__
+        page = self.connection.get_user_exercises_page(USER2_NICKNAME, 1)
+        self.assertEquals(page['items'], [EXERCISE2])
+        page = self.connection.get_user_exercises_page(USER2_NICKNAME, 1,
+                                                       page['next'])
+        self.assertEquals(page['items'], [EXERCISE3])
+        self.assertIsNone(page['next'])
+        page = self.connection.get_exercises_page(2)
+        self.assertEquals(len(page['items']), 2)
+
+    def test_get_user_exercises_date_range(self):
+        '''
+        Test that get_user_exercises filters and sorts by date
+        '''
+        print '('+self.test_get_user_exercises_date_range.__name__+')', \
+              self.test_get_user_exercises_date_range.__doc__
+        older = dict(NEW_EXERCISE, date='3.2.2011')
+        newer = dict(NEW_EXERCISE, date='1.1.2013')
+        older_id = self.connection.create_exercise(older)
+        newer_id = self.connection.create_exercise(newer)
+        exercises = self.connection.get_user_exercises(USER1_NICKNAME,
+                                                       start='01.01.2011')
+        self.assertEquals([exercise['exercise_id'] for exercise in exercises],
+                          [older_id, EXERCISE1_ID, newer_id])
+        exercises = self.connection.get_user_exercises(USER1_NICKNAME,
+                                                       start='2012-01-01',
+                                                       end='31.12.2012')
+        self.assertEquals(exercises, [EXERCISE1])
+        exercises = self.connection.iter_user_exercises(USER1_NICKNAME,
+                                                        end='2011-12-31')
+        self.assertEquals([exercise['date'] for exercise in exercises],
+                          ['3.2.2011'])
+        self.assertRaises(ValueError, self.connection.get_user_exercises,
+                          USER1_NICKNAME, 'yesterday')
+
+    def test_get_exercise_stats(self):
+        '''
+        Test get_exercise_stats grouped by type and by period
+        '''
+        print '('+self.test_get_exercise_stats.__name__+')', \
+              self.test_get_exercise_stats.__doc__
+        for date, value, time in (('13.12.2012', 200, 2),
+                                  ('1.1.2013', 300, 3)):
+            self.connection.create_exercise(dict(
+                EXERCISE2, username=USER2_NICKNAME, date=date, value=value,
+                time=time))
+        stats = self.connection.get_exercise_stats(USER2_NICKNAME)
+        self.assertEquals([group['type'] for group in stats], ['jog', 'run'])
+        run = stats[1]
+        self.assertEquals((run['count'], run['total_value'], run['max_value'],
+                           run['total_time'], run['max_time']),
+                          (3, 601, 300, 6, 3))
+        self.assertAlmostEquals(run['average_value'], 601 / 3.0)
+        self.assertIsNone(run['period'])
+        self.assertEquals((run['valueunit'], run['timeunit']), ('m', 'h'))
+        #Weeks start on Monday: 12.12.2012 is a Wednesday
+        stats = self.connection.get_exercise_stats(USER2_NICKNAME,
+                                                   by_type=False,
+                                                   period='week')
+        self.assertEquals([(group['period'], group['type'], group['count'])
+                           for group in stats],
+                          [('2012-12-10', None, 3), ('2012-12-31', None, 1)])
+        stats = self.connection.get_exercise_stats(USER2_NICKNAME,
+                                                   period='month',
+                                                   end='31.12.2012')
+        self.assertEquals([(group['period'], group['type'],
+                            group['total_value']) for group in stats],
+                          [('2012-12', 'jog', 1010000), ('2012-12', 'run', 301)])
+        stats = self.connection.get_exercise_stats(USER2_NICKNAME,
+                                                   period='day',
+                                                   start='2013-01-01')
+        self.assertEquals([(group['period'], group['count'])
+                           for group in stats], [('2013-01-01', 1)])
+        self.assertEquals(self.connection.get_exercise_stats(
+            USER2_NICKNAME, start='2014-01-01'), [])
+        self.assertIsNone(self.connection.get_exercise_stats(
+            USER_WRONG_NICKNAME))
+        self.assertRaises(ValueError, self.connection.get_exercise_stats,
+                          USER2_NICKNAME, period='year')
+        self.assertRaises(ValueError, self.connection.get_exercise_stats,
+                          USER2_NICKNAME, start='yesterday')
+
+    def test_rollups(self):
+        '''
+        Test that the exercise rollups follow the writes and give the same
+        stats as the exercises
+        '''
+        print '('+self.test_rollups.__name__+')', \
+              self.test_rollups.__doc__
+        self.assertEquals(ENGINE.check_rollups(), [])
+        for date, value in (('13.12.2012', 200), ('31.12.2012', 300),
+                            ('1.1.2013', 400)):
+            self.connection.create_exercise(dict(
+                EXERCISE2, username=USER2_NICKNAME, date=date, value=value))
+        self.assertEquals(ENGINE.check_rollups(), [])
+        #The maximum is removed
+        self.assertTrue(self.connection.delete_exercise(EXERCISE3['exercise_id']))
+        self.assertEquals(ENGINE.check_rollups(), [])
+        self.assertTrue(self.connection.modify_exercise(
+            EXERCISE1_ID, dict(MODIFIED_EXERCISE1, date='2.1.2013')))
+        self.assertEquals(ENGINE.check_rollups(), [])
+        #Whole periods are read from the rollups, the rest from the exercises
+        for period, start, end, other_start, other_end in (
+                ('month', '1.12.2012', '31.1.2013', '30.11.2012', None),
+                ('week', '2012-12-10', '2013-01-06', '2012-12-09', '7.1.2013'),
+                (None, None, '2012-12-31', None, '2012-12-30')):
+            stats = self.connection.get_exercise_stats(USER2_NICKNAME,
+                                                       period=period,
+                                                       start=start, end=end)
+            self.assertTrue(stats)
+            self.assertEquals(stats, self.connection.get_exercise_stats(
+                USER2_NICKNAME, period=period, start=other_start,
+                end=other_end if period else '2012-12-31'))
+        stats = self.connection.get_exercise_stats(USER2_NICKNAME,
+                                                   period='week')
+        self.assertEquals([(group['period'], group['count'],
+                            group['max_value']) for group in stats],
+                          [('2012-12-10', 2, 200), ('2012-12-31', 2, 400)])
+        self.assertTrue(self.connection.delete_user(USER2_NICKNAME))
+        self.assertEquals(ENGINE.check_rollups(), [])
+        #Broken rollups are found and rebuilt
+        con = sqlite3.connect(DB_PATH)
+        with con:
+            con.execute('UPDATE exercise_rollup SET total_value = 0')
+        con.close()
+        self.assertTrue(ENGINE.check_rollups())
+        self.assertEquals(ENGINE.rebuild_rollups(), 4)
+        self.assertEquals(ENGINE.check_rollups(), [])
+
+    def test_date_iso(self):
+        '''
+        Test that every exercise has its date in ISO format
+        '''
+        print '('+self.test_date_iso.__name__+')', \
+              self.test_date_iso.__doc__
+        self.assertEquals(database.iso_date('1.1.2012'), '2012-01-01')
+        self.assertEquals(database.iso_date('2012-1-31'), '2012-01-31')
+        self.assertIsNone(database.iso_date('12.13.2012'))
+        self.assertIsNone(database.iso_date('30.2.2012'))
+        self.assertIsNone(database.iso_date('2012-04-31'))
+        self.assertIsNone(database.iso_date('1.1.0'))
+        self.assertIsNone(database.iso_date(None))
+        exercise_id = self.connection.create_exercise(NEW_EXERCISE)
+        self.connection.modify_exercise(EXERCISE1_ID,
+                                        dict(MODIFIED_EXERCISE1,
+                                             date='5.6.2013'))
+        cur = self.connection.con.cursor()
+        cur.execute('SELECT exercise_id, date_iso FROM exercise')
+        dates = dict((row[0], row[1]) for row in cur.fetchall())
+        #Rows of the dump are filled by the trigger
+        self.assertEquals(dates, {1: '2012-12-12', 2: '2012-12-12',
+                                  3: '2012-01-01', EXERCISE1_ID: '2013-06-05',
+                                  exercise_id: '2012-12-12'})
+        #The trigger checks the ranges like iso_date
+        for date, expected in (('29.2.2012', '2012-02-29'),
+                               ('30.2.2012', None), ('45.13.2012', None),
+                               ('1.1.0000', None)):
+            cur.execute("INSERT INTO exercise(user_id, username, date) \
+                         VALUES(1, 'Mystery', ?)", (date,))
+            cur.execute('SELECT date_iso FROM exercise WHERE exercise_id = ?',
+                        (cur.lastrowid,))
+            self.assertEquals(cur.fetchone()[0], expected)
+            self.assertEquals(database.iso_date(date), expected)
+
+    def test_units_si(self):
+        '''
+        Test that every exercise has its value and time in SI units and that
+        the original units are returned
+        '''
+        print '('+self.test_units_si.__name__+')', \
+              self.test_units_si.__doc__
+        self.assertEquals(units.value_si(3, ' KM'), 3000.0)
+        self.assertEquals(units.time_si(90, 'min'), 5400.0)
+        self.assertIsNone(units.value_si(3, 'h'))
+        self.assertIsNone(units.value_si(3, 'sm'))
+        self.assertIsNone(units.value_si('3', 'm'))
+        exercise_id = self.connection.create_exercise(NEW_EXERCISE)
+        many_id = self.connection.create_exercises_many(
+            [dict(NEW_EXERCISE, value=5, valueunit='mi', timeunit='s')])[0]
+        self.connection.modify_exercise(EXERCISE1_ID, MODIFIED_EXERCISE1)
+        cur = self.connection.con.cursor()
+        cur.execute('SELECT exercise_id, value_si, time_si FROM exercise')
+        si = dict((row[0], (row[1], row[2])) for row in cur.fetchall())
+        #Rows of the dump are filled by the trigger. 'sm' and 'kh' are not
+        #known units
+        self.assertEquals(si, {1: (101.0, 3600.0),
+                               2: (1010000.0, 3600.0),
+                               3: (222000.0, 1010 * 3600.0),
+                               EXERCISE1_ID: (None, None),
+                               exercise_id: (100000.0, 500 * 3600.0),
+                               many_id: (5 * 1609.344, 500.0)})
+        #The trigger also follows updates made without Connection
+        cur.execute("UPDATE exercise SET valueunit = 'km' WHERE exercise_id = 1")
+        cur.execute('SELECT value_si FROM exercise WHERE exercise_id = 1')
+        self.assertEquals(cur.fetchone()[0], 101000.0)
+        self.connection.con.commit()
+        self.assertEquals(self.connection.get_exercise(EXERCISE1_ID),
+                          MODIFIED_EXERCISE1)
+
     def test_delete_exercise(self):
         '''
         Test that the exercise with EXERCISE1_ID is deleted
@@ -462,6 +763,223 @@ class UserDBAPITestCase(unittest.TestCase):
         friends = self.connection.get_friends(USER1_NICKNAME)
         self.assertEquals(len(friends), 3)
 
+    def test_get_friend_users(self):
+        '''
+        Test get_friend_users with USER1_NICKNAME, a user without friends and
+        an unknown user
+        '''
+        print '('+self.test_get_friend_users.__name__+')', \
+              self.test_get_friend_users.__doc__
+        friends = self.connection.get_friend_users(USER1_NICKNAME)
+        expected = [self.connection.get_username(friend['friend_id'])
+                    for friend in self.connection.get_friends(USER1_NICKNAME)]
+        self.assertEquals([friend['username'] for friend in friends], expected)
+        for friend in friends:
+            self.assertEquals(sorted(friend.keys()),
+                              sorted(database.PUBLIC_USER_FIELDS))
+        friends = self.connection.get_friend_users(USER1_NICKNAME,
+                                                   ['username'])
+        self.assertEquals(friends[0], {'username': USER1_NICKNAME})
+        #USER2 has no friends
+        self.assertEquals(self.connection.get_friend_users(USER2_NICKNAME), [])
+        self.assertIsNone(
+            self.connection.get_friend_users(USER_WRONG_NICKNAME))
+
+    def test_get_friend_path(self):
+        '''
+        Test get_friend_path with the friends of the database, a chain of
+        new users and the search budgets
+        '''
+        print '('+self.test_get_friend_path.__name__+')', \
+              self.test_get_friend_path.__doc__
+        path = self.connection.get_friend_path('Sekoitus', USER2_NICKNAME)
+        self.assertEquals(path['path'], ['Sekoitus', USER1_NICKNAME,
+                                         USER2_NICKNAME])
+        self.assertTrue(path['complete'])
+        self.assertEquals(self.connection.get_friend_path(
+            'Dakka', 'Dakka')['path'], ['Dakka'])
+        #USER2 has no friends
+        path = self.connection.get_friend_path(USER2_NICKNAME, USER1_NICKNAME)
+        self.assertIsNone(path['path'])
+        self.assertTrue(path['complete'])
+        self.assertIsNone(self.connection.get_friend_path(
+            USER1_NICKNAME, USER_WRONG_NICKNAME))
+        #Chain chain0 -> chain1 -> ... -> chain7
+        names = ['chain%d' % index for index in range(8)]
+        for name in names:
+            user = dict(NEW_USER, username=name)
+            self.assertEquals(self.connection.append_user(name, user), name)
+        for first, second in zip(names, names[1:]):
+            self.assertTrue(self.connection.add_friend(first, second))
+        path = self.connection.get_friend_path(names[0], names[-1])
+        self.assertIsNone(path['path'])
+        self.assertFalse(path['complete'])
+        #One query per user, one per level and one for the usernames
+        before = ENGINE.statement_counts()
+        path = self.connection.get_friend_path(names[0], names[-1], 7)
+        after = ENGINE.statement_counts()
+        self.assertEquals(path['path'], names)
+        self.assertEquals(after['SELECT'] - before['SELECT'], 2 + 7 + 1)
+        path = self.connection.get_friend_path(names[0], names[-1], 7, 3)
+        self.assertIsNone(path['path'])
+        self.assertFalse(path['complete'])
+        self.assertEquals(path['visited'], 3)
+        #The budget also stops the search inside the level of a hub
+        hubs = ['hub%d' % index for index in range(20)]
+        self.connection.append_users_many([dict(NEW_USER, username=name)
+                                           for name in hubs])
+        for name in hubs[1:]:
+            self.connection.add_friend(hubs[0], name)
+        before = ENGINE.statement_counts()
+        path = self.connection.get_friend_path(hubs[0], names[0], 6, 5)
+        after = ENGINE.statement_counts()
+        self.assertIsNone(path['path'])
+        self.assertFalse(path['complete'])
+        self.assertEquals(path['visited'], 5)
+        self.assertEquals(after['SELECT'] - before['SELECT'], 2 + 1)
+        #The 19 friends of hub0 fill the budget exactly: nothing is cut off
+        path = self.connection.get_friend_path(hubs[0], hubs[-1], 6, 2 + 19)
+        self.assertEquals(path['path'], [hubs[0], hubs[-1]])
+        self.assertTrue(path['complete'])
+        self.assertEquals(path['visited'], 21)
+        #One less and hub19, the last friend, is not read
+        path = self.connection.get_friend_path(hubs[0], hubs[-1], 6, 2 + 18)
+        self.assertIsNone(path['path'])
+        self.assertFalse(path['complete'])
+        self.assertEquals(path['visited'], 20)
+
+    def test_get_leaderboard(self):
+        '''
+        Test get_leaderboard of USER1_NICKNAME and its friends
+        '''
+        print '('+self.test_get_leaderboard.__name__+')', \
+              self.test_get_leaderboard.__doc__
+        leaderboard = self.connection.get_leaderboard(USER1_NICKNAME,
+                                                      date='12.12.2012')
+        self.assertEquals((leaderboard['period'], leaderboard['start'],
+                           leaderboard['end'], leaderboard['rank']),
+                          ('2012-12-10', '2012-12-10', '2012-12-16', 2))
+        self.assertEquals([(item['rank'], item['username'], item['total'],
+                            item['count']) for item in leaderboard['items']],
+                          [(1, USER2_NICKNAME, 1010101.0, 2),
+                           (2, USER1_NICKNAME, 1.0, 1),
+                           (3, 'Dakka', 0.0, 0)])
+        #Ties are ordered by username
+        leaderboard = self.connection.get_leaderboard(
+            USER1_NICKNAME, 'month', 'run', date='2012-12-31', limit=2)
+        self.assertEquals(leaderboard['period'], '2012-12')
+        self.assertEquals([item['username'] for item in leaderboard['items']],
+                          [USER2_NICKNAME, 'Dakka'])
+        self.assertEquals(leaderboard['rank'], 3)
+        leaderboard = self.connection.get_leaderboard(
+            USER1_NICKNAME, measure='time', date='12.12.2012')
+        self.assertEquals(leaderboard['items'][0]['total'], 7200.0)
+        #Sekoitus has only one friend, USER1
+        leaderboard = self.connection.get_leaderboard('Sekoitus',
+                                                      date='1.1.2012')
+        self.assertEquals([item['username'] for item in leaderboard['items']],
+                          ['Sekoitus', USER1_NICKNAME])
+        self.assertIsNone(self.connection.get_leaderboard(USER_WRONG_NICKNAME))
+        self.assertRaises(ValueError, self.connection.get_leaderboard,
+                          USER1_NICKNAME, 'year')
+        self.assertRaises(ValueError, self.connection.get_leaderboard,
+                          USER1_NICKNAME, measure='speed')
+        self.assertRaises(ValueError, self.connection.get_leaderboard,
+                          USER1_NICKNAME, date='31.2.2012')
+
+    def _feed_ids(self, username, limit):
+        '''
+        Walks all the pages of the feed of ``username``
+
+        :return: tuple (exercise ids of the pages, expected exercise ids)
+        '''
+        ids = []
+        cursor = None
+        while True:
+            page = self.connection.get_feed(username, limit, cursor)
+            self.assertTrue(len(page['items']) <= limit)
+            ids.extend(exercise['exercise_id'] for exercise in page['items'])
+            cursor = page['next']
+            if cursor is None:
+                break
+        friends = set(friend['friend_id']
+                      for friend in self.connection.get_friends(username))
+        expected = sorted(((database.iso_date(exercise['date']),
+                            exercise['exercise_id'])
+                           for exercise in self.connection.get_exercises()
+                           if exercise['user_id'] in friends and
+                           database.iso_date(exercise['date'])),
+                          reverse=True)
+        return ids, [exercise_id for _, exercise_id in expected]
+
+    def test_get_feed(self):
+        '''
+        Test get_feed of USER1_NICKNAME with and without timeline
+        '''
+        print '('+self.test_get_feed.__name__+')', \
+              self.test_get_feed.__doc__
+        page = self.connection.get_feed(USER1_NICKNAME, 2)
+        self.assertEquals([exercise['exercise_id'] for exercise
+                           in page['items']], [4, 2])
+        page = self.connection.get_feed(USER1_NICKNAME, 2, page['next'])
+        self.assertEquals([exercise['exercise_id'] for exercise
+                           in page['items']], [1])
+        self.assertIsNone(page['next'])
+        for date in ('1.1.2013', '5.6.2011', '12.12.2012', 'someday'):
+            self.connection.create_exercise(dict(NEW_EXERCISE, date=date,
+                                                 username='Dakka'))
+        #Statements of a page: user id, timeline_users, friends, exercises
+        before = ENGINE.statement_counts().get('SELECT', 0)
+        self.connection.get_feed(USER1_NICKNAME)
+        self.assertEquals(ENGINE.statement_counts()['SELECT'] - before, 4)
+        ids, expected = self._feed_ids(USER1_NICKNAME, 100)
+        self.assertEquals(len(ids), 6)
+        self.assertEquals(ids, expected)
+        self.assertEquals(self._feed_ids(USER1_NICKNAME, 1), (ids, expected))
+        #The timeline gives the same pages and follows the writes
+        self.assertTrue(self.connection.set_timeline(USER1_NICKNAME))
+        self.assertEquals(self._feed_ids(USER1_NICKNAME, 1)[0], ids)
+        #Statements of a page: user id, timeline_users, timeline
+        before = ENGINE.statement_counts().get('SELECT', 0)
+        self.connection.get_feed(USER1_NICKNAME)
+        self.assertEquals(ENGINE.statement_counts()['SELECT'] - before, 3)
+        writes = [(self.connection.add_friend, USER1_NICKNAME, 'Sekoitus'),
+                  (self.connection.create_exercise, NEW_EXERCISE),
+                  (self.connection.modify_exercise, ids[0],
+                   dict(NEW_EXERCISE, date='1.1.2010')),
+                  (self.connection.delete_exercise, ids[1]),
+                  (self.connection.delete_friend, USER1_NICKNAME, 'Dakka'),
+                  (self.connection.delete_user, USER2_NICKNAME)]
+        for write in writes:
+            write[0](*write[1:])
+            for limit in (2, 100):
+                ids, expected = self._feed_ids(USER1_NICKNAME, limit)
+                self.assertEquals(ids, expected)
+        self.assertEquals(ids[-1], 3)
+        self.assertTrue(self.connection.set_timeline(USER1_NICKNAME, False))
+        self.assertEquals(self._feed_ids(USER1_NICKNAME, 1)[0], ids)
+        cur = self.connection.con.cursor()
+        cur.execute('SELECT COUNT(*) FROM timeline')
+        self.assertEquals(cur.fetchone()[0], 0)
+        #An engine with timeline_friends enables it from 3 friends
+        engine = database.Engine(DB_PATH, pool_size=0, timeline_friends=3)
+        connection = engine.connect()
+        self.assertTrue(connection.add_friend('Dakka', 'Sekoitus'))
+        cur.execute('SELECT user_id FROM timeline_users')
+        self.assertEquals(cur.fetchall(), [])
+        self.assertTrue(connection.add_friend('Dakka', 'Dakka'))
+        connection.close()
+        cur.execute('SELECT user_id FROM timeline_users')
+        self.assertEquals([tuple(row) for row in cur.fetchall()], [(3,)])
+        ids, expected = self._feed_ids('Dakka', 2)
+        self.assertEquals(ids, expected)
+        self.assertIsNone(self.connection.get_feed(USER_WRONG_NICKNAME))
+        self.assertIsNone(self.connection.set_timeline(USER_WRONG_NICKNAME))
+        for cursor in ('cursor', database.encode_cursor('prev', ids[0]),
+                       database.encode_cursor('next', ids[0])):
+            self.assertRaises(ValueError, self.connection.get_feed,
+                              USER1_NICKNAME, 2, cursor)
+
     def test_add_friend(self):
         '''
         Test add_friends with USER2_NICKNAME (as a user) and USER1_NICKNAME (as a friend)
@@ -489,8 +1007,846 @@ class UserDBAPITestCase(unittest.TestCase):
         #Check that the users has been really deleted throug a get
         resp2 = self.connection.get_friends(USER1_NICKNAME)
         self.assertEquals(len(resp2), 2)
+
+    def test_no_pragma_per_call(self):
+        '''
+        Test that the API methods do not run PRAGMA statements per call
+        '''
+        print '('+self.test_no_pragma_per_call.__name__+')', \
+              self.test_no_pragma_per_call.__doc__
+        before = ENGINE.statement_counts()
+        self.connection.get_users()
+        self.connection.get_user(USER1_NICKNAME)
+        self.connection.get_friends(USER1_NICKNAME)
+        self.connection.get_exercise(EXERCISE1_ID)
+        self.connection.create_exercise(NEW_EXERCISE)
+        after = ENGINE.statement_counts()
+        self.assertEquals(after.get('PRAGMA', 0), before.get('PRAGMA', 0))
+        self.assertTrue(after['SELECT'] > before.get('SELECT', 0))
+        self.assertTrue(self.connection.check_foreign_keys_status())
+        #The statements are only counted on request
+        engine = database.Engine(DB_PATH, pool_size=0)
+        connection = engine.connect()
+        self.assertNotIsInstance(connection.con, database.CountingConnection)
+        self.assertIsNone(engine.statement_counts())
+        connection.close()
+
+    def test_readonly_connection(self):
+        '''
+        Test that a read-only connection reads but cannot write
+        '''
+        print '('+self.test_readonly_connection.__name__+')', \
+              self.test_readonly_connection.__doc__
+        connection = ENGINE.connect_readonly()
+        self.assertEquals(len(connection.get_users()), INITIAL_SIZE)
+        self.assertRaises(sqlite3.OperationalError, connection.append_user,
+                          NEW_USER_NICKNAME, NEW_USER)
+        cur = connection.con.cursor()
+        cur.execute('PRAGMA query_only')
+        self.assertEquals(cur.fetchone()[0], 1)
+        connection.close()
+        self.assertIsNone(self.connection.get_user(NEW_USER_NICKNAME))
 ###Own implementation ends
- 
+
+class EngineOptionTestCase(unittest.TestCase):
+    '''
+    Base of the test cases of an Engine created with ENGINE_OPTIONS. Every
+    test gets the populated database, the Engine in self.engine and one of
+    its connections in self.connection.
+    '''
+    #Keyword arguments of the Engine besides DB_PATH
+    ENGINE_OPTIONS = {}
+
+    @classmethod
+    def setUpClass(cls):
+        ''' Creates the database structure. Removes first any preexisting
+            database file
+        '''
+        print "Testing ", cls.__name__
+        ENGINE.remove_database()
+        ENGINE.create_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        '''Remove the testing database'''
+        print "Testing ENDED for ", cls.__name__
+        ENGINE.remove_database()
+
+    def setUp(self):
+        '''
+        Populates the database and creates the Engine and a connection
+        '''
+        ENGINE.populate_tables()
+        self.engine = database.Engine(DB_PATH, **self.ENGINE_OPTIONS)
+        self.connection = self.engine.connect()
+
+    def tearDown(self):
+        '''
+        Close the connection, stop the Engine and remove all records from
+        database
+        '''
+        self.connection.close()
+        self.engine.stop_writer()
+        self.engine.pool.dispose()
+        ENGINE.clear()
+
+class ConnectionPoolTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the connection pool of the Engine.
+    '''
+    ENGINE_OPTIONS = {'pool_size': 2}
+
+    def setUp(self):
+        '''
+        Creates an Engine with a small pool and no connection in use
+        '''
+        self.engine = database.Engine(DB_PATH, **self.ENGINE_OPTIONS)
+        self.engine.pool.wait_timeout = 0.1
+
+    def tearDown(self):
+        '''
+        Close the pooled connections
+        '''
+        self.engine.pool.dispose()
+
+    def test_connection_is_reused(self):
+        '''
+        Test that a closed Connection gives its sqlite3 connection back
+        '''
+        print '('+self.test_connection_is_reused.__name__+')', \
+              self.test_connection_is_reused.__doc__
+        connection = self.engine.connect()
+        con = connection.con
+        connection.close()
+        connection = self.engine.connect()
+        self.assertIs(connection.con, con)
+        connection.close()
+        metrics = self.engine.pool_metrics()
+        self.assertEquals(metrics['creations'], 1)
+        self.assertEquals(metrics['hits'], 1)
+        self.assertEquals(metrics['idle'], 1)
+
+    def test_pool_is_bounded(self):
+        '''
+        Test that checkout fails when every connection is in use
+        '''
+        print '('+self.test_pool_is_bounded.__name__+')', \
+              self.test_pool_is_bounded.__doc__
+        connection1 = self.engine.connect()
+        connection2 = self.engine.connect()
+        self.assertRaises(sqlite3.OperationalError, self.engine.connect)
+        self.assertEquals(self.engine.pool_metrics()['waits'], 1)
+        connection1.close()
+        connection2.close()
+        self.assertEquals(self.engine.pool_metrics()['size'], 2)
+
+    def test_idle_connections_are_evicted(self):
+        '''
+        Test that connections idle longer than the timeout are closed
+        '''
+        print '('+self.test_idle_connections_are_evicted.__name__+')', \
+              self.test_idle_connections_are_evicted.__doc__
+        self.engine.pool.idle_timeout = 0
+        connection = self.engine.connect()
+        connection.close()
+        metrics = self.engine.pool_metrics()
+        self.assertEquals(metrics['evictions'], 1)
+        self.assertEquals(metrics['size'], 0)
+
+    def test_broken_connection_is_discarded(self):
+        '''
+        Test that a pooled connection failing the health check is replaced
+        '''
+        print '('+self.test_broken_connection_is_discarded.__name__+')', \
+              self.test_broken_connection_is_discarded.__doc__
+        connection = self.engine.connect()
+        con = connection.con
+        connection.close()
+        con.close()
+        connection = self.engine.connect()
+        self.assertIsNot(connection.con, con)
+        self.assertEquals(connection.get_users(), [])
+        connection.close()
+        self.assertEquals(self.engine.pool_metrics()['discarded'], 1)
+
+    def test_storage_profile(self):
+        '''
+        Test that the storage profile is applied to new connections
+        '''
+        print '('+self.test_storage_profile.__name__+')', \
+              self.test_storage_profile.__doc__
+        engine = database.Engine(DB_PATH, profile='throughput')
+        connection = engine.connect()
+        cur = connection.con.cursor()
+        cur.execute('PRAGMA journal_mode')
+        self.assertEquals(cur.fetchone()[0], 'wal')
+        cur.execute('PRAGMA synchronous')
+        self.assertEquals(cur.fetchone()[0], 1)
+        cur.execute('PRAGMA wal_autocheckpoint')
+        self.assertEquals(cur.fetchone()[0], 10000)
+        connection.close()
+        engine.pool.dispose()
+        self.assertRaises(ValueError, database.Engine, DB_PATH,
+                          profile='fastest')
+
+class MigrationTestCase(unittest.TestCase):
+    '''
+    Test cases for the schema migrations.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    @classmethod
+    def tearDownClass(cls):
+        '''Remove the testing database'''
+        print "Testing ENDED for ", cls.__name__
+        ENGINE.remove_database()
+
+    def setUp(self):
+        '''
+        Creates the version 0 of the schema with the initial data
+        '''
+        ENGINE.remove_database()
+        ENGINE.create_users_table()
+        ENGINE.create_exercise_table()
+        ENGINE.create_friends_table()
+        ENGINE.populate_tables()
+
+    def _indexes(self):
+        con = sqlite3.connect(DB_PATH)
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = set(row[0] for row in cur.fetchall())
+        con.close()
+        return indexes
+
+    def test_migrate(self):
+        '''
+        Test that migrate applies all the migrations to an existing database
+        '''
+        print '('+self.test_migrate.__name__+')', \
+              self.test_migrate.__doc__
+        self.assertEquals(ENGINE.schema_version(), 0)
+        latest = database.MIGRATIONS[-1][0]
+        applied = ENGINE.migrate()
+        self.assertEquals(applied, range(1, latest + 1))
+        self.assertEquals(ENGINE.schema_version(), latest)
+        self.assertIn('friends_friend_id_idx', self._indexes())
+        #The rollups of the existing exercises are filled
+        self.assertEquals(ENGINE.check_rollups(), [])
+        #The data is kept
+        connection = ENGINE.connect()
+        self.assertEquals(len(connection.get_users()), INITIAL_SIZE)
+        connection.close()
+        #Nothing left to apply
+        self.assertEquals(ENGINE.migrate(), [])
+
+    def test_migrate_target(self):
+        '''
+        Test that migrate stops at the target version
+        '''
+        print '('+self.test_migrate_target.__name__+')', \
+              self.test_migrate_target.__doc__
+        self.assertEquals(ENGINE.migrate(target=0), [])
+        self.assertNotIn('exercise_username_idx', self._indexes())
+        self.assertEquals(ENGINE.migrate(target=1), [1])
+        self.assertIn('exercise_username_idx', self._indexes())
+
+    def test_migrate_invalid_dates(self):
+        '''
+        Test that migration 7 removes the impossible dates and keeps the
+        rollups in sync
+        '''
+        print '('+self.test_migrate_invalid_dates.__name__+')', \
+              self.test_migrate_invalid_dates.__doc__
+        ENGINE.migrate(target=6)
+        connection = ENGINE.connect()
+        cur = connection.con.cursor()
+        cur.execute("UPDATE exercise SET date = '30.2.2012', \
+                     date_iso = '2012-02-30' WHERE exercise_id = 3")
+        connection.close()
+        self.assertEquals(ENGINE.migrate(), [7])
+        self.assertEquals(ENGINE.check_rollups(), [])
+        connection = ENGINE.connect()
+        cur = connection.con.cursor()
+        cur.execute('SELECT date_iso FROM exercise WHERE exercise_id = 3')
+        self.assertIsNone(cur.fetchone()[0])
+        #The triggers run in the same order: modify_exercise keeps the
+        #rollups
+        connection.modify_exercise(3, dict(MODIFIED_EXERCISE1,
+                                           date='1.3.2012'))
+        self.assertEquals(ENGINE.check_rollups(), [])
+        connection.close()
+
+class GroupCommitTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the writer thread of the Engine.
+    '''
+    ENGINE_OPTIONS = {'group_commit': True, 'commit_interval': 0.05,
+                      'friend_graph': True}
+
+    def test_writes_are_grouped(self):
+        '''
+        Test that concurrent writes are committed together
+        '''
+        print '('+self.test_writes_are_grouped.__name__+')', \
+              self.test_writes_are_grouped.__doc__
+        ids = []
+
+        def create():
+            connection = self.engine.connect()
+            ids.append(connection.create_exercise(NEW_EXERCISE))
+            connection.close()
+        threads = [threading.Thread(target=create) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(ids)), 5)
+        metrics = self.engine.writer.metrics()
+        self.assertEquals(metrics['operations'], 5)
+        self.assertTrue(metrics['commits'] < 5)
+        connection = self.engine.connect()
+        self.assertEquals(len(connection.get_exercises()), EXERCISE_SIZE + 5)
+        connection.close()
+
+    def test_error_is_returned_to_caller(self):
+        '''
+        Test that a failing write raises in the caller and is rolled back
+        '''
+        print '('+self.test_error_is_returned_to_caller.__name__+')', \
+              self.test_error_is_returned_to_caller.__doc__
+        connection = self.engine.connect()
+        #Mystery is already a friend of M
+        self.assertRaises(sqlite3.IntegrityError, connection.add_friend,
+                          USER1_NICKNAME, USER2_NICKNAME)
+        self.assertTrue(connection.delete_friend(USER1_NICKNAME,
+                                                 USER2_NICKNAME))
+        self.assertEquals(len(connection.get_friends(USER1_NICKNAME)), 2)
+        connection.close()
+        self.assertEquals(self.engine.writer.metrics()['failures'], 1)
+
+    def test_commit_callback_error_is_returned_to_caller(self):
+        '''
+        Test that an error after the commit raises in the caller and the
+        writer keeps running
+        '''
+        print '('+self.test_commit_callback_error_is_returned_to_caller.__name__+')', \
+              self.test_commit_callback_error_is_returned_to_caller.__doc__
+
+        def add_edge(user_id, friend_id):
+            raise RuntimeError('add_edge')
+        self.engine.friend_graph.add_edge = add_edge
+        self.assertRaises(RuntimeError, self.connection.add_friend,
+                          USER2_NICKNAME, USER1_NICKNAME)
+        self.assertTrue(self.connection.delete_friend(USER1_NICKNAME,
+                                                      USER2_NICKNAME))
+        metrics = self.engine.writer.metrics()
+        self.assertEquals(metrics['operations'], 2)
+        self.assertEquals(metrics['failures'], 1)
+
+class CompactRowsTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the compact rows of an Engine created with compact_rows.
+    '''
+    ENGINE_OPTIONS = {'compact_rows': True}
+
+    def setUp(self):
+        '''
+        Also opens a connection returning dictionaries
+        '''
+        super(CompactRowsTestCase, self).setUp()
+        self.dict_connection = ENGINE.connect()
+
+    def tearDown(self):
+        '''
+        Also closes the connection returning dictionaries
+        '''
+        self.dict_connection.close()
+        super(CompactRowsTestCase, self).tearDown()
+
+    def test_compact_rows_have_same_values(self):
+        '''
+        Test that compact rows contain the same values as the dictionaries
+        '''
+        print '('+self.test_compact_rows_have_same_values.__name__+')', \
+              self.test_compact_rows_have_same_values.__doc__
+        exercises = self.connection.get_exercises()
+        expected = self.dict_connection.get_exercises()
+        self.assertEquals(len(exercises), EXERCISE_SIZE)
+        for exercise, dictionary in zip(exercises, expected):
+            self.assertIsInstance(exercise, database.CompactRow)
+            self.assertEquals(exercise.asdict(), dictionary)
+            self.assertEquals(exercise.username, dictionary['username'])
+            self.assertEquals(exercise[0], dictionary['exercise_id'])
+            self.assertEquals(exercise.asdict()['type'], dictionary['type'])
+        user = self.connection.get_user(USER1_NICKNAME)
+        self.assertEquals(user.asdict(),
+                          self.dict_connection.get_user(USER1_NICKNAME))
+        self.assertEquals(user['avatar'], 101)
+        self.assertEquals(user.get('missing', 'default'), 'default')
+        self.assertRaises(IndexError, lambda: user['missing'])
+        users = self.connection.get_users(database.LIST_USER_FIELDS)
+        self.assertEquals(users[0].keys(), list(database.LIST_USER_FIELDS))
+        page = self.connection.get_users_page(2, None,
+                                              database.LIST_USER_FIELDS)
+        self.assertEquals([item.asdict() for item in page['items']],
+                          self.dict_connection.get_users_page(
+                              2, None, database.LIST_USER_FIELDS)['items'])
+        #The classes of the rows are cached up to a maximum
+        cached = dict(database._compact_row_types)
+        try:
+            for index in range(database.MAX_COMPACT_ROW_TYPES + 10):
+                row_type = database.compact_row_type(('column%d' % index,))
+                self.assertEquals(row_type._columns, ('column%d' % index,))
+            self.assertEquals(len(database._compact_row_types),
+                              database.MAX_COMPACT_ROW_TYPES)
+        finally:
+            database._compact_row_types.clear()
+            database._compact_row_types.update(cached)
+
+    def test_units_are_interned(self):
+        '''
+        Test that the unit strings are shared by all the compact rows
+        '''
+        print '('+self.test_units_are_interned.__name__+')', \
+              self.test_units_are_interned.__doc__
+        for _ in range(3):
+            self.connection.create_exercise(NEW_EXERCISE)
+        exercises = [exercise for exercise
+                     in self.connection.iter_user_exercises(USER1_NICKNAME)
+                     if exercise['valueunit'] == 'km']
+        self.assertTrue(len(exercises) >= 3)
+        self.assertEquals(len(set(id(exercise['valueunit'])
+                                  for exercise in exercises)), 1)
+        self.assertEquals(type(exercises[0]), type(exercises[1]))
+
+class QueryCacheTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the query cache of an Engine created with query_cache.
+    '''
+    ENGINE_OPTIONS = {'count_statements': True, 'query_cache': True,
+                      'query_cache_size': 4}
+
+    def test_repeated_reads_are_cached(self):
+        '''
+        Test that a repeated read does not execute any statement
+        '''
+        print '('+self.test_repeated_reads_are_cached.__name__+')', \
+              self.test_repeated_reads_are_cached.__doc__
+        user = self.connection.get_user(USER1_NICKNAME)
+        before = self.engine.statement_counts()
+        self.assertEquals(self.connection.get_user(USER1_NICKNAME), user)
+        self.assertEquals(self.engine.statement_counts(), before)
+        metrics = self.engine.cache_metrics()
+        self.assertEquals(metrics['hits'], 1)
+        self.assertEquals(metrics['misses'], 1)
+        self.assertEquals(metrics['size'], 1)
+        #Read-only connections share the cache
+        connection = self.engine.connect_readonly()
+        self.assertEquals(connection.get_user(USER1_NICKNAME), user)
+        connection.close()
+        self.assertEquals(self.engine.cache_metrics()['hits'], 2)
+
+    def test_writes_invalidate(self):
+        '''
+        Test that the mutating methods invalidate the entries of their tables
+        '''
+        print '('+self.test_writes_invalidate.__name__+')', \
+              self.test_writes_invalidate.__doc__
+        self.connection.get_user(USER1_NICKNAME)
+        self.connection.get_exercises()
+        self.connection.modify_user(USER1_NICKNAME, MODIFIED_USER1)
+        self.assertEquals(self.connection.get_user(USER1_NICKNAME)['password'],
+                          MODIFIED_USER1['password'])
+        self.connection.get_exercises()
+        metrics = self.engine.cache_metrics()
+        self.assertEquals(metrics['invalidations'], 1)
+        self.assertEquals(metrics['hits'], 1)
+        self.connection.create_exercise(NEW_EXERCISE)
+        self.assertEquals(len(self.connection.get_exercises()),
+                          EXERCISE_SIZE + 1)
+        #Changes made without the connections are seen after Engine.clear
+        ENGINE.clear()
+        self.engine.populate_tables()
+        self.assertEquals(len(self.connection.get_exercises()), EXERCISE_SIZE)
+
+    def test_leaderboard_cache(self):
+        '''
+        Test that a leaderboard is cached until an exercise or a friend changes
+        '''
+        print '('+self.test_leaderboard_cache.__name__+')', \
+              self.test_leaderboard_cache.__doc__
+        leaderboard = self.connection.get_leaderboard(USER1_NICKNAME,
+                                                      date='12.12.2012')
+        before = self.engine.statement_counts()
+        self.assertEquals(self.connection.get_leaderboard(USER1_NICKNAME,
+                                                          date='12.12.2012'),
+                          leaderboard)
+        self.assertEquals(self.engine.statement_counts(), before)
+        self.connection.create_exercise(dict(NEW_EXERCISE, value=2000))
+        leaderboard = self.connection.get_leaderboard(USER1_NICKNAME,
+                                                      date='12.12.2012')
+        self.assertEquals(leaderboard['rank'], 1)
+        self.assertTrue(self.connection.delete_friend(USER1_NICKNAME,
+                                                      USER2_NICKNAME))
+        leaderboard = self.connection.get_leaderboard(USER1_NICKNAME,
+                                                      date='12.12.2012')
+        self.assertEquals([item['username'] for item in leaderboard['items']],
+                          [USER1_NICKNAME, 'Dakka'])
+
+    def test_lru_and_ttl(self):
+        '''
+        Test that the least recently used and the expired entries are removed
+        '''
+        print '('+self.test_lru_and_ttl.__name__+')', \
+              self.test_lru_and_ttl.__doc__
+        for user in (USER1_NICKNAME, USER2_NICKNAME, 'Dakka', 'Sekoitus',
+                     USER_WRONG_NICKNAME):
+            self.connection.get_user_id(user)
+        metrics = self.engine.cache_metrics()
+        self.assertEquals(metrics['evictions'], 1)
+        self.assertEquals(metrics['size'], 4)
+        #The first one was evicted
+        self.connection.get_user_id(USER1_NICKNAME)
+        self.assertEquals(self.engine.cache_metrics()['hits'], 0)
+        self.engine.query_cache.ttl = 0
+        self.connection.get_users()
+        self.connection.get_users()
+        metrics = self.engine.cache_metrics()
+        self.assertEquals(metrics['expirations'], 1)
+        self.assertEquals(metrics['hits'], 0)
+
+class IdentityMapTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the identity map of an Engine created with identity_map.
+    '''
+    ENGINE_OPTIONS = {'count_statements': True, 'identity_map': True,
+                      'identity_map_size': 3}
+
+    def test_lookups_are_mapped(self):
+        '''
+        Test that known and unknown usernames are resolved without queries
+        '''
+        print '('+self.test_lookups_are_mapped.__name__+')', \
+              self.test_lookups_are_mapped.__doc__
+        self.assertEquals(self.connection.get_user_id(USER1_NICKNAME), 1)
+        self.assertIsNone(self.connection.get_user_id(USER_WRONG_NICKNAME))
+        before = self.engine.statement_counts()
+        self.assertEquals(self.connection.get_user_id(USER1_NICKNAME), 1)
+        self.assertIsNone(self.connection.get_user_id(USER_WRONG_NICKNAME))
+        self.assertEquals(self.connection.get_username(1), USER1_NICKNAME)
+        self.assertEquals(len(self.connection.get_friends(USER1_NICKNAME)), 3)
+        after = self.engine.statement_counts()
+        #Only the friends query
+        self.assertEquals(after['SELECT'] - before['SELECT'], 1)
+        metrics = self.engine.identity_metrics()
+        self.assertEquals(metrics['hits'], 3)
+        self.assertEquals(metrics['negative_hits'], 1)
+        #The map is bounded
+        for user in (USER2_NICKNAME, 'Dakka', 'Sekoitus'):
+            self.connection.get_user_id(user)
+        metrics = self.engine.identity_metrics()
+        self.assertEquals(metrics['size'], 3)
+        self.assertEquals(metrics['evictions'], 2)
+
+    def test_writes_invalidate(self):
+        '''
+        Test that append_user and delete_user invalidate their usernames
+        '''
+        print '('+self.test_writes_invalidate.__name__+')', \
+              self.test_writes_invalidate.__doc__
+        self.assertIsNone(self.connection.get_user_id(NEW_USER_NICKNAME))
+        self.connection.append_user(NEW_USER_NICKNAME, NEW_USER)
+        user_id = self.connection.get_user_id(NEW_USER_NICKNAME)
+        self.assertIsNotNone(user_id)
+        self.assertEquals(self.connection.get_username(user_id),
+                          NEW_USER_NICKNAME)
+        self.assertTrue(self.connection.delete_user(NEW_USER_NICKNAME))
+        self.assertIsNone(self.connection.get_user_id(NEW_USER_NICKNAME))
+        self.assertIsNone(self.connection.get_username(user_id))
+        #Unknown users are not an error
+        self.assertIsNone(self.connection.add_friend(NEW_USER_NICKNAME,
+                                                     USER1_NICKNAME))
+        self.assertIsNone(self.connection.create_exercise(
+            dict(NEW_EXERCISE, username=NEW_USER_NICKNAME)))
+
+class UsernameFilterTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the username filter of an Engine created with
+    username_filter.
+    '''
+    ENGINE_OPTIONS = {'count_statements': True, 'username_filter': True}
+
+    def test_bloom_filter(self):
+        '''
+        Test that the Bloom filter has no false negatives and few false
+        positives
+        '''
+        print '('+self.test_bloom_filter.__name__+')', \
+              self.test_bloom_filter.__doc__
+        bloom = BloomFilter(1000, 0.01)
+        for index in range(1000):
+            bloom.add('user%d' % index)
+        for index in range(1000):
+            self.assertIn('user%d' % index, bloom)
+        self.assertIn(u'user1', bloom)
+        false_positives = sum(1 for index in range(10000)
+                              if 'other%d' % index in bloom)
+        self.assertTrue(false_positives < 300)
+        self.assertAlmostEquals(bloom.estimated_error_rate(), 0.01, 2)
+        self.assertRaises(ValueError, BloomFilter, 0)
+
+    def test_unknown_users_skip_database(self):
+        '''
+        Test that unknown usernames are answered without queries
+        '''
+        print '('+self.test_unknown_users_skip_database.__name__+')', \
+              self.test_unknown_users_skip_database.__doc__
+        self.assertEquals(self.connection.get_user_id(USER1_NICKNAME), 1)
+        before = self.engine.statement_counts()
+        for index in range(100):
+            self.assertIsNone(self.connection.get_user('ghost%d' % index))
+            self.assertFalse(self.connection.contains_user('ghost%d' % index))
+        after = self.engine.statement_counts()
+        metrics = self.engine.filter_metrics()
+        self.assertEquals(metrics['rebuilds'], 1)
+        self.assertEquals(metrics['usernames'], INITIAL_SIZE)
+        self.assertEquals(after['SELECT'] - before['SELECT'],
+                          metrics['false_positives'])
+        self.assertTrue(metrics['false_positive_rate'] < 0.1)
+        self.assertTrue(metrics['estimated_false_positive_rate'] < 0.01)
+
+    def test_writes_update_filter(self):
+        '''
+        Test that new users pass the filter and deletes trigger a rebuild
+        '''
+        print '('+self.test_writes_update_filter.__name__+')', \
+              self.test_writes_update_filter.__doc__
+        self.assertFalse(self.connection.contains_user(NEW_USER_NICKNAME))
+        self.connection.append_user(NEW_USER_NICKNAME, NEW_USER)
+        self.assertTrue(self.connection.contains_user(NEW_USER_NICKNAME))
+        self.connection.append_users_many([{'username': 'bulk'}])
+        self.assertIsNotNone(self.connection.get_user('bulk'))
+        #Each new user is counted once, failed inserts are not counted
+        self.assertEquals(self.engine.filter_metrics()['usernames'],
+                          INITIAL_SIZE + 2)
+        self.assertIsNone(self.connection.append_user(NEW_USER_NICKNAME,
+                                                      NEW_USER))
+        self.connection.append_users_many([{'username': 'bulk'}])
+        self.assertEquals(self.engine.filter_metrics()['usernames'],
+                          INITIAL_SIZE + 2)
+        self.engine.username_filter.rebuild_deletes = 1
+        self.connection.delete_user(NEW_USER_NICKNAME)
+        self.assertFalse(self.connection.contains_user(NEW_USER_NICKNAME))
+        metrics = self.engine.filter_metrics()
+        self.assertEquals(metrics['rebuilds'], 2)
+        self.assertEquals(metrics['usernames'], INITIAL_SIZE + 1)
+
+class FriendGraphTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the friend graph of an Engine created with friend_graph.
+    '''
+    ENGINE_OPTIONS = {'count_statements': True, 'friend_graph': True}
+
+    def setUp(self):
+        '''
+        Also opens a connection without the graph
+        '''
+        super(FriendGraphTestCase, self).setUp()
+        self.sql_connection = ENGINE.connect()
+
+    def tearDown(self):
+        '''
+        Also closes the connection without the graph
+        '''
+        self.sql_connection.close()
+        super(FriendGraphTestCase, self).tearDown()
+
+    def assertSameAnswers(self):
+        '''
+        Checks that the graph and the SQL queries give the same answers
+        '''
+        users = [user['username'] for user in self.sql_connection.get_users()]
+        for username in users:
+            self.assertEquals(self.connection.get_followers(username),
+                              self.sql_connection.get_followers(username))
+            self.assertEquals(
+                self.connection.get_friend_suggestions(username),
+                self.sql_connection.get_friend_suggestions(username))
+            for other in users:
+                self.assertEquals(
+                    self.connection.get_mutual_friends(username, other),
+                    self.sql_connection.get_mutual_friends(username, other))
+
+    def test_graph_queries(self):
+        '''
+        Test mutual friends, followers and suggestions
+        '''
+        print '('+self.test_graph_queries.__name__+')', \
+              self.test_graph_queries.__doc__
+        self.assertEquals(self.connection.get_mutual_friends(USER1_NICKNAME,
+                                                             'Dakka'),
+                          [USER1_NICKNAME])
+        self.assertEquals(self.connection.get_followers(USER1_NICKNAME),
+                          [USER1_NICKNAME, 'Dakka', 'Sekoitus'])
+        self.assertEquals(self.connection.get_friend_suggestions('Sekoitus'),
+                          [{'username': USER2_NICKNAME, 'common': 1},
+                           {'username': 'Dakka', 'common': 1}])
+        self.assertEquals(self.connection.get_friend_suggestions('Sekoitus',
+                                                                 1),
+                          [{'username': USER2_NICKNAME, 'common': 1}])
+        self.assertIsNone(self.connection.get_followers(USER_WRONG_NICKNAME))
+        self.assertIsNone(self.connection.get_mutual_friends(
+            USER1_NICKNAME, USER_WRONG_NICKNAME))
+        self.assertSameAnswers()
+
+    def test_failed_commit_discards_changes(self):
+        '''
+        Test that a write whose commit fails does not change the graph later
+        '''
+        print '('+self.test_failed_commit_discards_changes.__name__+')', \
+              self.test_failed_commit_discards_changes.__doc__
+        self.assertSameAnswers()
+        def commit():
+            raise sqlite3.OperationalError('database is locked')
+        self.connection.con.commit = commit
+        try:
+            self.assertRaises(sqlite3.OperationalError,
+                              self.connection.add_friend, USER2_NICKNAME,
+                              'Dakka')
+        finally:
+            del self.connection.con.commit
+        self.connection.append_user(NEW_USER_NICKNAME, NEW_USER)
+        self.assertSameAnswers()
+        #Once loaded the graph does not query the database
+        before = self.engine.statement_counts()
+        self.connection.get_friend_suggestions('Sekoitus')
+        self.connection.get_mutual_friends(USER1_NICKNAME, 'Dakka')
+        self.assertEquals(self.engine.statement_counts(), before)
+        metrics = self.engine.graph_metrics()
+        self.assertEquals(metrics['loads'], 1)
+        self.assertEquals(metrics['edges'], 5)
+
+    def test_incremental_updates(self):
+        '''
+        Test that the graph follows add_friend, delete_friend and delete_user
+        '''
+        print '('+self.test_incremental_updates.__name__+')', \
+              self.test_incremental_updates.__doc__
+        self.connection.get_followers(USER1_NICKNAME)
+        self.engine.friend_graph.compact_threshold = 4
+        self.assertTrue(self.connection.add_friend('Sekoitus', 'Dakka'))
+        self.assertTrue(self.connection.add_friend(USER2_NICKNAME, 'Dakka'))
+        self.assertTrue(self.connection.delete_friend(USER1_NICKNAME,
+                                                      USER2_NICKNAME))
+        self.assertSameAnswers()
+        self.connection.append_user(NEW_USER_NICKNAME, NEW_USER)
+        self.assertTrue(self.connection.add_friend(NEW_USER_NICKNAME,
+                                                   'Dakka'))
+        self.assertEquals(self.connection.get_followers('Dakka'),
+                          [USER1_NICKNAME, USER2_NICKNAME, 'Sekoitus',
+                           NEW_USER_NICKNAME])
+        self.assertTrue(self.engine.graph_metrics()['compactions'] > 0)
+        self.assertTrue(self.connection.delete_user(USER1_NICKNAME))
+        self.assertSameAnswers()
+        #A failed write does not change the graph
+        self.assertRaises(sqlite3.IntegrityError, self.connection.add_friend,
+                          'Sekoitus', 'Dakka')
+        self.assertSameAnswers()
+
+@unittest.skipIf(analytics.numpy is None, 'NumPy is not installed')
+class AnalyticsTestCase(EngineOptionTestCase):
+    '''
+    Test cases for the columnar analytics of forum.analytics.
+    '''
+    def setUp(self):
+        '''
+        Also adds exercises to USER2 on three days
+        '''
+        super(AnalyticsTestCase, self).setUp()
+        self.connection.create_exercises_many([
+            dict(EXERCISE2, date='13.12.2012', value=2, valueunit='km'),
+            dict(EXERCISE2, date='15.12.2012', value=500),
+            dict(EXERCISE2, date='15.12.2012', value=3, valueunit='sm')])
+
+    def test_load_exercises(self):
+        '''
+        Test that the columns have the exercises read in several chunks
+        '''
+        print '('+self.test_load_exercises.__name__+')', \
+              self.test_load_exercises.__doc__
+        columns = analytics.load_exercises(self.connection, chunk_size=2)
+        self.assertEquals(len(columns), EXERCISE_SIZE + 3)
+        self.assertEquals(sorted(columns.exercise_id.tolist()),
+                          sorted(exercise['exercise_id'] for exercise
+                                 in self.connection.get_exercises()))
+        self.assertEquals(sorted(set(columns.users)), [1, 2, 4])
+        self.assertIn('run', columns.types)
+        #'sm' is not a known unit
+        self.assertEquals(analytics.numpy.isnan(columns.value_si).sum(), 1)
+        columns = analytics.load_exercises(self.connection,
+                                           start='13.12.2012')
+        self.assertEquals(len(columns), 3)
+        self.assertRaises(ValueError, analytics.load_exercises,
+                          self.connection, 'yesterday')
+        #An impossible date written without the Connection is not a day
+        self.connection.con.execute(
+            "INSERT INTO exercise(user_id, username, type, date, date_iso) \
+             VALUES(1, 'Mystery', 'run', '30.2.2012', '2012-02-30')")
+        columns = analytics.load_exercises(self.connection, chunk_size=2)
+        self.assertEquals(len(columns), EXERCISE_SIZE + 4)
+        self.assertEquals(analytics.numpy.isnat(columns.date).sum(), 1)
+        self.assertEquals(sum(columns.count('month').values()),
+                          EXERCISE_SIZE + 3)
+
+    def test_aggregations(self):
+        '''
+        Test the vectorized group by against the dictionaries of the
+        Connection
+        '''
+        print '('+self.test_aggregations.__name__+')', \
+              self.test_aggregations.__doc__
+        columns = analytics.load_exercises(self.connection)
+        expected = {}
+        for exercise in self.connection.get_exercises():
+            value = units.value_si(exercise['value'], exercise['valueunit'])
+            if value is not None:
+                key = (exercise['user_id'], exercise['type'])
+                expected[key] = expected.get(key, 0) + value
+        self.assertEquals(columns.sum('value_si', ('user', 'type')), expected)
+        self.assertEquals(columns.count('week'), {'2011-12-26': 1,
+                                                  '2012-12-10': 6})
+        self.assertEquals(columns.count(('user', 'month'))[(2, '2012-12')], 5)
+        self.assertEquals(columns.mean('time_si', 'type')['run'], 3600.0)
+        runs = [101.0, 2000.0, 500.0]
+        percentiles = columns.percentile('value_si', 50, ('user', 'type'))
+        self.assertEquals(percentiles[(2, 'run')],
+                          analytics.numpy.percentile(runs, 50))
+        self.assertEquals(columns.percentile('value_si', 100, 'user')[2],
+                          1010000.0)
+        self.assertRaises(ValueError, columns.sum, 'value', 'user')
+        self.assertRaises(ValueError, columns.sum, 'value_si', 'year')
+        self.assertRaises(ValueError, columns.percentile, 'value_si', 101,
+                          'user')
+
+    def test_rolling_sum(self):
+        '''
+        Test the totals of a sliding window of days
+        '''
+        print '('+self.test_rolling_sum.__name__+')', \
+              self.test_rolling_sum.__doc__
+        columns = analytics.load_exercises(self.connection,
+                                           start='12.12.2012')
+        days, totals = columns.rolling_sum('value_si', 2, ('user', 'type'))
+        self.assertEquals([str(day) for day in days],
+                          ['2012-12-12', '2012-12-13', '2012-12-14',
+                           '2012-12-15'])
+        self.assertEquals(totals[(2, 'run')].tolist(),
+                          [101.0, 2101.0, 2000.0, 500.0])
+        self.assertEquals(totals[(1, 'jump')].tolist(), [1.0, 1.0, 0, 0])
+
 if __name__ == '__main__':
     print 'Start running user tests'
     unittest.main()